@@ -0,0 +1,180 @@
+import csv
+import json
+import tempfile
+from datetime import datetime
+
+from bson.decimal128 import Decimal128
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+
+from ..mongo import get_collection
+from ..pagination import PaginationError, date_range_filter
+from ..sample_status import parse_testdetails
+
+try:
+    import openpyxl
+except ImportError:  # XLSX exports need openpyxl; CSV works without it
+    openpyxl = None
+
+EXPORT_BATCH_SIZE = 1000
+
+BILLING_COLUMNS = ["company_id", "date", "employee_id", "barcode", "paymentMode", "netAmount", "tests"]
+SAMPLE_COLUMNS = [
+    "company_id", "barcode", "created_date", "test_id", "testname", "samplestatus", "specimen_type",
+    "batch_number", "collected_by", "samplecollected_time", "transferred_by", "sampletransferred_time",
+    "received_by", "received_time", "remarks",
+]
+INVESTIGATION_COLUMNS = ["company_id", "date", "barcode", "employee_id", "gender", "age", "status"]
+# Vitals captured at the camp; override per request with ?vitals=a,b
+DEFAULT_VITAL_COLUMNS = ["height_cm", "weight_kg", "bmi", "bp", "spo2"]
+
+
+class _Echo:
+    """File-like object whose write() hands the line back, so csv.writer can feed a stream."""
+
+    def write(self, value):
+        return value
+
+
+def _cell(value):
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    if isinstance(value, datetime):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        # Local wall-clock time; XLSX cells cannot carry a time zone
+        return timezone.localtime(value).replace(tzinfo=None)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        # Keep spreadsheet apps from evaluating exported text as a formula
+        return "'" + value
+    return value
+
+
+def _export_response(request, name, columns, rows):
+    """Stream rows as CSV, or build a write-only XLSX in a temp file, depending on ?file_format=."""
+    file_format = (request.GET.get("file_format") or "csv").lower()
+    stamp = timezone.localtime().strftime("%Y%m%d-%H%M%S")
+    filename = f"{name}-{stamp}.{file_format}"
+
+    if file_format == "xlsx":
+        if openpyxl is None:
+            return Response({"error": "XLSX export requires openpyxl; use file_format=csv"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet(name)
+        sheet.append(columns)
+        for row in rows:
+            sheet.append([_cell(v) for v in row])
+        spool = tempfile.TemporaryFile()
+        workbook.save(spool)
+        spool.seek(0)
+        return FileResponse(
+            spool, as_attachment=True, filename=filename,
+            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+    if file_format != "csv":
+        return Response({"error": "file_format must be csv or xlsx"}, status=status.HTTP_400_BAD_REQUEST)
+
+    writer = csv.writer(_Echo())
+
+    def _lines():
+        yield "\ufeff"  # BOM so Excel opens UTF-8 correctly
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow([_cell(v) for v in row])
+
+    response = StreamingHttpResponse(_lines(), content_type="text/csv; charset=utf-8")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _export_query(request, date_field):
+    company_id = request.GET.get("company_id")
+    if not company_id:
+        raise PaginationError("company_id is required")
+    query = date_range_filter(request, date_field)
+    query["company_id"] = company_id
+    return query
+
+
+def _cursor(collection_name, query, projection, sort_field):
+    # Server-side cursor read in batches; nothing is held beyond the current batch
+    return get_collection(collection_name).find(query, projection) \
+        .sort([(sort_field, 1), ("_id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+
+
+@api_view(['GET'])
+def export_billing(request):
+    """Billing rows for a company. Params: company_id, date_from/date_to, file_format=csv|xlsx."""
+    try:
+        query = _export_query(request, "date")
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    def rows():
+        for doc in _cursor("core_billing", query, {**{f: 1 for f in BILLING_COLUMNS[:-1]}, "testdetails": 1}, "date"):
+            try:
+                tests = parse_testdetails(doc.get("testdetails"))
+            except ValueError:
+                tests = []
+            names = "; ".join(str(t.get("testname") or t.get("test_id") or "") for t in tests if isinstance(t, dict))
+            yield [doc.get(c) for c in BILLING_COLUMNS[:-1]] + [names]
+
+    return _export_response(request, "billing", BILLING_COLUMNS, rows())
+
+
+@api_view(['GET'])
+def export_sample_tests(request):
+    """One row per test on each sample. Params: company_id, date_from/date_to, file_format=csv|xlsx."""
+    try:
+        query = _export_query(request, "created_date")
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    def rows():
+        projection = {"company_id": 1, "barcode": 1, "created_date": 1, "testdetails": 1}
+        for doc in _cursor("core_sample", query, projection, "created_date"):
+            try:
+                tests = parse_testdetails(doc.get("testdetails"))
+            except ValueError:
+                tests = []
+            for test in tests:
+                if not isinstance(test, dict):
+                    continue
+                yield [doc.get(c) for c in SAMPLE_COLUMNS[:3]] + [test.get(c) for c in SAMPLE_COLUMNS[3:]]
+
+    return _export_response(request, "sample-tests", SAMPLE_COLUMNS, rows())
+
+
+@api_view(['GET'])
+def export_investigation_vitals(request):
+    """
+    Investigation vitals, one column per vital.
+    Params: company_id, date_from/date_to, vitals=a,b, file_format=csv|xlsx.
+    """
+    try:
+        query = _export_query(request, "date")
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    vital_columns = [v.strip() for v in request.GET.get("vitals", "").split(",") if v.strip()] or DEFAULT_VITAL_COLUMNS
+
+    def rows():
+        projection = {**{f: 1 for f in INVESTIGATION_COLUMNS}, "vitals": 1}
+        for doc in _cursor("core_investigation", query, projection, "date"):
+            vitals = doc.get("vitals")
+            if isinstance(vitals, str):
+                try:
+                    vitals = json.loads(vitals)
+                except ValueError:
+                    vitals = {}
+            if not isinstance(vitals, dict):
+                vitals = {}
+            yield [doc.get(c) for c in INVESTIGATION_COLUMNS] + [vitals.get(v) for v in vital_columns]
+
+    return _export_response(request, "investigation-vitals", INVESTIGATION_COLUMNS + vital_columns, rows())
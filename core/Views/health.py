@@ -0,0 +1,13 @@
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from rest_framework import status
+
+from ..mongo import pool_stats
+
+
+@api_view(['GET'])
+def mongo_pool_stats(request):
+    """
+    Pool sizing and live connection pool counters for the worker serving this request.
+    """
+    return Response(pool_stats(), status=status.HTTP_200_OK)
@@ -2,27 +2,45 @@ from rest_framework.decorators import api_view
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.response import Response
 from rest_framework import status
-from pymongo import MongoClient
-import os
+from rest_framework.renderers import JSONRenderer
+from ..mongo import get_collection
+from ..precompressed import PrecompressedBody
+from ..test_catalog import test_catalog
 import logging
+import threading
 from django.utils import timezone
 import json
+from bson.decimal128 import Decimal128
 from ..serializers import PackageSerializer
+from .. import package_catalog
 from dotenv import load_dotenv
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-# MongoDB config
-MONGO_URI = os.getenv("GLOBAL_DB_HOST")
-client = MongoClient(MONGO_URI)
+# Use StoreTrust DB, collection patient_billing
+STORETRUST_DB = "StoreTrust"
+PACKAGE_BILLING_COLLECTION = "patient_billing"
 
-# MongoDB databases & collections
-diagnostics_db = client["Diagnostics"]
-core_test_collection = diagnostics_db["core_test"]
 
-# Use StoreTrust DB, collection patient_billing
-storetrust_db = client["StoreTrust"]
-package_billing_collection = storetrust_db["patient_billing"]
+_core_test_lock = threading.Lock()
+_core_test_body = None
+_core_test_version = None
+
+
+def _core_test_response_body():
+    """Serialized + compressed catalog, rebuilt only when the catalog snapshot version changes."""
+    global _core_test_body, _core_test_version
+    snapshot = test_catalog.snapshot()
+    with _core_test_lock:
+        if _core_test_body is None or _core_test_version != snapshot.version:
+            test_list = [
+                {"name": t["name"], "MRP": t["MRP"], "L2L_Rate_Card": t["L2L_Rate_Card"]}
+                for t in snapshot.tests
+            ]
+            body = JSONRenderer().render({"status": "success", "tests": test_list})
+            _core_test_body = PrecompressedBody(body, last_modified=snapshot.modified_at)
+            _core_test_version = snapshot.version
+        return _core_test_body
 
 
 @csrf_exempt
@@ -30,18 +48,10 @@ package_billing_collection = storetrust_db["patient_billing"]
 def get_core_test(request):
     """
     Fetch all test names along with MRP and L2L Rate from Diagnostics.core_test MongoDB collection
+    Served with ETag/Last-Modified (304 on revalidation) and precompressed gzip/brotli bodies.
     """
     try:
-        tests = list(core_test_collection.find({}, {"test_name": 1, "MRP": 1, "L2L_Rate_Card": 1, "_id": 0}))
-        test_list = [
-            {
-                "name": t.get("test_name", ""),
-                "MRP": t.get("MRP", 0),
-                "L2L_Rate_Card": t.get("L2L_Rate_Card", 0)
-            }
-            for t in tests if t.get("test_name")
-        ]
-        return Response({"status": "success", "tests": test_list}, status=status.HTTP_200_OK)
+        return _core_test_response_body().response(request)
 
     except Exception as e:
         logger.error(f"Error in get_core_test: {str(e)}")
@@ -52,7 +62,7 @@ def get_core_test(request):
 @api_view(['POST'])
 def create_package(request):
     """
-    Save selected tests into Django DB and MongoDB (StoreTrust.patient_billing)
+    Save selected tests as a package in core_package and MongoDB (StoreTrust.patient_billing)
     Store unique test names with sequential keys, and total_amount
     """
     try:
@@ -66,18 +76,29 @@ def create_package(request):
                 "message": "Amount and tests are required"
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        # Save each test in Django DB
-        saved_packages = []
-        for t in tests:
-            serializer = PackageSerializer(data={
-                "test_name": t.get("name"),
-                "amount": t.get("total")
-            })
-            if serializer.is_valid():
-                package_obj = serializer.save()
-                saved_packages.append(PackageSerializer(package_obj).data)
-            else:
-                logger.warning(f"Validation failed for test {t.get('name')}: {serializer.errors}")
+        # Normalise investigations once here so get_packages can serve them as stored
+        investigations = package_catalog.clean_investigations([
+            {"testname": t.get("name"), "test_id": t.get("test_id")} for t in tests
+        ])
+        serializer = PackageSerializer(data={
+            "package_name": data.get("package_name"),
+            "investigations": investigations,
+            "totalAmount": amount,
+            "created_by": data.get("created_by"),
+        })
+        if not serializer.is_valid():
+            return Response({"status": "error", "message": serializer.errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Stored with native arrays, matching the existing core_package documents
+        package_doc = dict(serializer.validated_data)
+        package_doc["totalAmount"] = Decimal128(package_doc["totalAmount"])  # numeric for revenue $group
+        package_doc["created_date"] = timezone.now()
+        package_result = get_collection(package_catalog.PACKAGE_COLLECTION).insert_one(package_doc)
+        package_doc["_id"] = str(package_result.inserted_id)
+        package_doc["totalAmount"] = str(package_doc["totalAmount"])
+        package_catalog.packages_changed()
+        saved_packages = [package_doc]
 
         # Remove duplicates and create sequential items
         unique_tests = []
@@ -96,7 +117,7 @@ def create_package(request):
             "total_amount": amount,
             "created_at": timezone.now()
         }
-        result = package_billing_collection.insert_one(mongo_data)
+        result = get_collection(PACKAGE_BILLING_COLLECTION, STORETRUST_DB).insert_one(mongo_data)
         mongo_data["_id"] = str(result.inserted_id)
 
         return Response({
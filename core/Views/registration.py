@@ -3,29 +3,19 @@ from rest_framework.response import Response
 from rest_framework import status
 from ..models import EmployeeRegistration
 from ..serializers import EmployeeRegistrationSerializer
+from ..barcode_index import barcode_range_index
+from .. import barcode_allocation
+from .. import package_catalog
+from .. import rollups
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 import logging
 import traceback
 import os
-from pymongo import MongoClient
-import certifi
+from ..mongo import get_db, get_collection
 
-from dotenv import load_dotenv
-load_dotenv()
 logger = logging.getLogger(__name__)
 
-# MongoDB Config
-MONGO_URI = os.getenv("GLOBAL_DB_HOST")
-DB_NAME = "Corporatehealthcheckup"
-REGISTER_COLLECTION = "corporatehealthcheckup_register"
-BARCODERANGE_COLLECTION = "core_barcoderange"
-
-client = MongoClient(MONGO_URI)
-mongo_db = client[DB_NAME]
-register_collection = mongo_db[REGISTER_COLLECTION]
-barcoderange_collection = mongo_db[BARCODERANGE_COLLECTION]
-
 
 @csrf_exempt
 @api_view(['POST'])
@@ -54,14 +44,7 @@ def check_barcode_exists(request):
         barcode_int = int(barcode)
 
         # ✅ Check if barcode lies within any range in core_barcoderange
-        matching_range = barcoderange_collection.find_one({
-            "$expr": {
-                "$and": [
-                    {"$lte": [{"$toInt": "$startbarcode"}, barcode_int]},
-                    {"$gte": [{"$toInt": "$endbarcode"}, barcode_int]}
-                ]
-            }
-        })
+        matching_range = barcode_range_index.find_range(barcode_int)
 
         if matching_range:
             return Response({
@@ -92,10 +75,6 @@ def validate_barcode(request, barcode):
     Validate barcode: check if it's within any range in core_barcoderange
     """
     try:
-        client = MongoClient(MONGO_URI)
-        db = client[DB_NAME]
-        collection = db[BARCODERANGE_COLLECTION]
-
         if not barcode.isdigit():
             return Response({
                 "status": "error",
@@ -107,14 +86,7 @@ def validate_barcode(request, barcode):
         barcode_int = int(barcode)
 
         # Check if barcode is in any range
-        matching_range = collection.find_one({
-            "$expr": {
-                "$and": [
-                    {"$lte": [{"$toInt": "$startbarcode"}, barcode_int]},
-                    {"$gte": [{"$toInt": "$endbarcode"}, barcode_int]}
-                ]
-            }
-        })
+        matching_range = barcode_range_index.find_range(barcode_int)
 
         if matching_range:
             return Response({
@@ -141,6 +113,141 @@ def validate_barcode(request, barcode):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+MAX_BULK_BARCODES = int(os.getenv("MAX_BULK_BARCODES", 10000))
+
+
+@csrf_exempt
+@api_view(['POST'])
+def validate_barcodes_bulk(request):
+    """
+    Validate a list of barcodes in one request: range validity comes from the
+    in-process range index and "already used" from a single Billing lookup.
+    """
+    try:
+        barcodes = request.data.get("barcodes")
+
+        if not isinstance(barcodes, list) or not barcodes:
+            return Response({
+                "status": "error",
+                "message": "barcodes must be a non-empty list."
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(barcodes) > MAX_BULK_BARCODES:
+            return Response({
+                "status": "error",
+                "message": f"At most {MAX_BULK_BARCODES} barcodes can be validated per request."
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        barcodes = [str(b).strip() for b in barcodes]
+        numeric = list({b for b in barcodes if b.isdigit()})
+
+        # One round trip for every barcode already billed
+        used = set()
+        if numeric:
+            used = set(get_collection("core_billing").distinct("barcode", {"barcode": {"$in": numeric}}))
+
+        results = []
+        summary = {"valid": 0, "invalid": 0, "used": 0}
+        for barcode in barcodes:
+            if not barcode.isdigit():
+                results.append({
+                    "barcode": barcode,
+                    "valid": False,
+                    "in_range": False,
+                    "used": False,
+                    "message": "Invalid barcode format. Only numeric values allowed."
+                })
+                summary["invalid"] += 1
+                continue
+
+            matching_range = barcode_range_index.find_range(barcode)
+            is_used = barcode in used
+            is_valid = matching_range is not None and not is_used
+
+            if is_valid:
+                message = f"Barcode {barcode} is valid and available."
+            elif matching_range is None:
+                message = f"Barcode {barcode} is not in any valid stock range."
+            else:
+                message = f"Barcode {barcode} is already used in billing."
+
+            results.append({
+                "barcode": barcode,
+                "valid": is_valid,
+                "in_range": matching_range is not None,
+                "used": is_used,
+                "range_id": matching_range["range_id"] if matching_range else None,
+                "message": message
+            })
+            summary["valid" if is_valid else "invalid"] += 1
+            if is_used:
+                summary["used"] += 1
+
+        return Response({
+            "status": "success",
+            "count": len(results),
+            "summary": summary,
+            "results": results
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        logger.error(f"Error in validate_barcodes_bulk: {str(e)}\n{traceback.format_exc()}")
+        return Response({
+            "status": "error",
+            "message": f"Internal server error: {str(e)}"
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@csrf_exempt
+@api_view(['POST'])
+def allocate_barcodes(request):
+    """
+    Reserve the next unused barcode(s) from the configured ranges.
+    """
+    try:
+        count = int(request.data.get("count", 1))
+        if count < 1 or count > MAX_BULK_BARCODES:
+            return Response({
+                "status": "error",
+                "message": f"count must be between 1 and {MAX_BULK_BARCODES}."
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        barcodes = barcode_allocation.allocate(
+            count,
+            range_id=request.data.get("range_id"),
+            actor=request.data.get("created_by")
+        )
+        return Response({
+            "status": "success",
+            "count": len(barcodes),
+            "barcodes": barcodes
+        }, status=status.HTTP_201_CREATED)
+
+    except (TypeError, ValueError):
+        return Response({"status": "error", "message": "count must be an integer."},
+                        status=status.HTTP_400_BAD_REQUEST)
+    except barcode_allocation.BarcodeAllocationError as e:
+        return Response({"status": "error", "message": str(e)}, status=status.HTTP_409_CONFLICT)
+    except Exception as e:
+        logger.error(f"Error in allocate_barcodes: {str(e)}\n{traceback.format_exc()}")
+        return Response({"status": "error", "message": f"Internal server error: {str(e)}"},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def barcode_utilisation(request):
+    """
+    Used/free counts for every barcode range.
+    """
+    try:
+        return Response({"status": "success", "ranges": barcode_allocation.utilisation()},
+                        status=status.HTTP_200_OK)
+    except Exception as e:
+        logger.error(f"Error in barcode_utilisation: {str(e)}\n{traceback.format_exc()}")
+        return Response({"status": "error", "message": f"Internal server error: {str(e)}"},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 
 
 from rest_framework.decorators import api_view
@@ -177,33 +284,69 @@ def register_employee_with_billing(request):
         if not employee_serializer.is_valid():
             return Response({"status": "error", "message": employee_serializer.errors},
                             status=status.HTTP_400_BAD_REQUEST)
-        
-        employee_obj = employee_serializer.save()
+
+        # --- Barcode: reserve the given one, or allocate the next free one ---
+        barcode = str(data.get("barcode") or "").strip()
+        actor = data.get("created_by")
+        if barcode:
+            if not barcode.isdigit():
+                return Response({"status": "error", "message": "Invalid barcode format. Only numeric values allowed."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            reserved = barcode_allocation.reserve([barcode], actor).get(barcode)
+            if reserved is None:
+                # Outside every stock range, so there is no bitmap to guard it against reuse
+                return Response({"status": "error", "message": f"Barcode {barcode} is not in any valid stock range."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            if reserved is False:
+                return Response({"status": "error", "message": f"Barcode {barcode} is already used."},
+                                status=status.HTTP_409_CONFLICT)
+        else:
+            try:
+                barcode = barcode_allocation.allocate(1, actor=actor)[0]
+            except barcode_allocation.BarcodeAllocationError as e:
+                return Response({"status": "error", "message": str(e)},
+                                status=status.HTTP_409_CONFLICT)
+
+        try:
+            employee_obj = employee_serializer.save()
+        except Exception:
+            barcode_allocation.release([barcode], actor)
+            raise
 
         # --- Billing ---
         billing_payload = {
             "date": timezone.now(),
             "employee_id": data.get("employee_id"),
-            "barcode": data.get("barcode"),
+            "barcode": barcode,
             "testdetails": data.get("testdetails", []),  # pass list/dict directly
             "netAmount": data.get("totalAmount", 0),
-            "paymentMode": data.get("paymentMode", "Credit")  # or default
+            "paymentMode": data.get("paymentMode", "Credit"),  # or default
+            "package_id": data.get("package_id"),
         }
 
 
         billing_serializer = BillingSerializer(data=billing_payload)
         if not billing_serializer.is_valid():
-            # Rollback employee if billing fails
+            # Rollback employee and barcode if billing fails
             employee_obj.delete()
+            barcode_allocation.release([barcode], actor)
             return Response({"status": "error", "message": billing_serializer.errors},
                             status=status.HTTP_400_BAD_REQUEST)
-        
-        billing_obj = billing_serializer.save()
+
+        try:
+            billing_obj = billing_serializer.save()
+        except Exception:
+            employee_obj.delete()
+            barcode_allocation.release([barcode], actor)
+            raise
+        rollups.record_registrations([employee_obj], [billing_obj])
 
         return Response({
             "status": "success",
             "message": "Employee and Billing saved successfully",
-            "employee": EmployeeRegistrationSerializer(employee_obj).data,
+            "employee": EmployeeRegistrationSerializer(
+                employee_obj, context={"latest_barcodes": {employee_obj.employee_id: billing_obj.barcode}}
+            ).data,
             "billing": BillingSerializer(billing_obj).data
         }, status=status.HTTP_201_CREATED)
 
@@ -211,44 +354,285 @@ def register_employee_with_billing(request):
         return Response({"status": "error", "message": str(e)},
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-from pymongo import MongoClient
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 
 @api_view(["GET"])
 def get_packages(request):
+    """
+    Package list with normalised investigations, served from a per-process
+    cache that is rebuilt only when the package catalog version changes.
+    """
+    try:
+        version, packages = package_catalog.get_packages()
+        return Response({"status": "success", "version": version, "data": packages}, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({"status": "error", "message": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+import csv
+import io
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from rest_framework.decorators import parser_classes
+from rest_framework.parsers import MultiPartParser, FormParser
+
+try:
+    import openpyxl
+except ImportError:  # XLSX rosters need openpyxl; CSV works without it
+    openpyxl = None
+
+MAX_IMPORT_ROWS = int(os.getenv("MAX_IMPORT_ROWS", 20000))
+IMPORT_BATCH_SIZE = 1000
+
+
+def _normalise_header(value):
+    return str(value or "").strip().lower().replace(" ", "_")
+
+
+def _read_roster(upload):
+    """Rows of a CSV/XLSX roster as dicts keyed by normalised header."""
+    name = (upload.name or "").lower()
+    if name.endswith((".xlsx", ".xlsm")):
+        if openpyxl is None:
+            raise ValueError("XLSX import requires openpyxl; upload a CSV instead.")
+        workbook = openpyxl.load_workbook(upload, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = [_normalise_header(h) for h in next(rows, [])]
+        for values in rows:
+            if values and any(v not in (None, "") for v in values):
+                yield {h: ("" if v is None else str(v).strip()) for h, v in zip(headers, values) if h}
+        workbook.close()
+    else:
+        text = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+        reader = csv.DictReader(text)
+        reader.fieldnames = [_normalise_header(h) for h in reader.fieldnames or []]
+        for row in reader:
+            if any((v or "").strip() for v in row.values() if isinstance(v, str)):
+                yield {h: (v or "").strip() for h, v in row.items() if h and isinstance(v, str)}
+
+
+def _package_billing_details(package_id):
+    """(testdetails, netAmount) for a package in core_package."""
+    try:
+        package = get_collection("core_package").find_one({"_id": ObjectId(package_id)})
+    except InvalidId:
+        package = None
+    if not package:
+        raise ValueError(f"Package {package_id} not found.")
+    amount = package.get("totalAmount") or 0
+    if hasattr(amount, "to_decimal"):
+        amount = amount.to_decimal()
+    return package_catalog.clean_investigations(package.get("investigations", [])), str(amount)
+
+
+def _undo_bulk_import(company_id, started, employee_objs, billing_objs):
+    """
+    Remove whatever a failed import managed to write: its billings (the
+    barcodes were reserved for this import, so no other billing has them)
+    and the employees created since it started. Returns the barcodes that
+    have no billing row afterwards, i.e. the ones safe to release.
+    """
+    barcodes = [b.barcode for b in billing_objs]
     try:
-        client = MongoClient(MONGO_URI)
-        db = client["Corporatehealthcheckup"]
-        collection = db["core_package"]
+        billing = get_collection("core_billing")
+        billing.delete_many({"company_id": company_id, "barcode": {"$in": barcodes}})
+        get_collection("core_employeeregistration").delete_many({
+            "company_id": company_id,
+            "employee_id": {"$in": [e.employee_id for e in employee_objs]},
+            "created_date": {"$gte": started},
+        })
+        still_billed = set(billing.distinct("barcode", {"barcode": {"$in": barcodes}}))
+    except Exception as e:
+        # Keep every barcode reserved rather than risk freeing a billed one; the log lists them for manual release
+        logger.error(f"Could not undo failed bulk import (barcodes kept reserved: {barcodes}): {str(e)}\n{traceback.format_exc()}")
+        return []
+    return [b for b in barcodes if b not in still_billed]
+
 
-        packages_cursor = collection.find({})
-        packages = []
+@api_view(['POST'])
+@parser_classes([MultiPartParser, FormParser])
+def bulk_register_employees(request):
+    """
+    Import a CSV/XLSX roster: validate every row in one pass, then write
+    EmployeeRegistration and Billing in batches. Barcodes come from a roster
+    "barcode" column or, with barcode_mode=allocate, from the allocator.
+    """
+    allocated = []
+    try:
+        upload = request.FILES.get("file")
+        if not upload:
+            return Response({"status": "error", "message": "A roster file is required."},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        for pkg in packages_cursor:
-            pkg["_id"] = str(pkg["_id"])
+        company_id = request.data.get("company_id") or "CHC001"
+        payment_mode = request.data.get("paymentMode") or "Credit"
+        barcode_mode = request.data.get("barcode_mode") or "file"
+        skip_invalid = str(request.data.get("skip_invalid", "")).lower() in ("1", "true", "yes")
+        actor = request.data.get("created_by") or "bulk_import"
 
-            cleaned_investigations = []
-            for inv in pkg.get("investigations", []):
-                testname = inv.get("testname") or inv.get("testnameme") or ""
-                test_id_val = inv.get("test_id", None)
+        package_id = request.data.get("package_id")
+        if package_id:
+            testdetails, net_amount = _package_billing_details(package_id)
+        else:
+            testdetails = request.data.get("testdetails") or []
+            if isinstance(testdetails, str):
+                testdetails = json.loads(testdetails)
+            net_amount = request.data.get("totalAmount", 0)
+
+        rows = []
+        for row in _read_roster(upload):
+            rows.append(row)
+            if len(rows) > MAX_IMPORT_ROWS:
+                return Response({"status": "error", "message": f"Rosters are limited to {MAX_IMPORT_ROWS} rows."},
+                                status=status.HTTP_400_BAD_REQUEST)
+        if not rows:
+            return Response({"status": "error", "message": "The roster has no rows."},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-                if isinstance(test_id_val, dict) and "$numberLong" in test_id_val:
-                    test_id_val = int(test_id_val["$numberLong"])
+        # --- Lookups for the whole roster: one query each ---
+        employee_ids = [r.get("employee_id", "") for r in rows]
+        registered = set(get_collection("core_employeeregistration").distinct(
+            "employee_id", {"company_id": company_id, "employee_id": {"$in": employee_ids}}
+        ))
+        roster_barcodes = [r.get("barcode", "") for r in rows if r.get("barcode")]
+        billed = set(get_collection("core_billing").distinct(
+            "barcode", {"barcode": {"$in": roster_barcodes}}
+        )) if roster_barcodes else set()
+
+        # --- Validate every row ---
+        errors = {}
+        employees = {}
+        seen_ids, seen_barcodes = set(), set()
+        for index, row in enumerate(rows, start=2):  # row 1 is the header
+            row_errors = {}
+            employee_id = row.get("employee_id", "")
+            serializer = EmployeeRegistrationSerializer(data={
+                "company_id": company_id,
+                "employee_name": row.get("employee_name"),
+                "employee_id": employee_id,
+                "gender": row.get("gender"),
+                "age": row.get("age"),
+                "department": row.get("department") or None,
+                "email": row.get("email") or None,
+                "mobile": row.get("mobile") or None,
+                "created_by": actor,
+            })
+            if not serializer.is_valid():
+                row_errors.update(serializer.errors)
+            if employee_id in seen_ids:
+                row_errors.setdefault("employee_id", []).append("Duplicate employee_id in roster.")
+            elif employee_id in registered:
+                row_errors.setdefault("employee_id", []).append("Employee is already registered.")
+            seen_ids.add(employee_id)
+
+            if barcode_mode != "allocate":
+                barcode = row.get("barcode", "")
+                if not barcode:
+                    row_errors.setdefault("barcode", []).append("Barcode is required.")
+                elif not barcode.isdigit() or not barcode_range_index.contains(barcode):
+                    row_errors.setdefault("barcode", []).append("Barcode is not in any valid stock range.")
+                elif barcode in billed or barcode in seen_barcodes:
+                    row_errors.setdefault("barcode", []).append("Barcode is already used.")
+                seen_barcodes.add(barcode)
+
+            if row_errors:
+                errors[index] = {"row": index, "employee_id": employee_id, "errors": row_errors}
+            else:
+                employees[index] = serializer
+
+        def error_report():
+            return [errors[i] for i in sorted(errors)]
+
+        if errors and not skip_invalid:
+            return Response({"status": "error", "message": "Roster has invalid rows; nothing was imported.",
+                             "imported": 0, "failed": len(errors), "errors": error_report()},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-                cleaned_investigations.append({
-                    "testname": testname,
-                    "test_id": test_id_val if test_id_val is not None else None
-                })
+        # --- Barcodes: reserve roster barcodes or allocate fresh ones ---
+        if barcode_mode == "allocate":
+            allocated = barcode_allocation.allocate(len(employees), actor=actor) if employees else []
+            barcodes = dict(zip(employees, allocated))
+        else:
+            barcodes = {i: rows[i - 2]["barcode"] for i in employees}
+            reserved = barcode_allocation.reserve(barcodes.values(), actor)
+            allocated = [b for b, newly in reserved.items() if newly]
+            for index in list(employees):
+                if reserved.get(barcodes[index]) is False:
+                    errors[index] = {"row": index, "employee_id": rows[index - 2].get("employee_id"),
+                                     "errors": {"barcode": ["Barcode is already used."]}}
+                    del employees[index]
+            if errors and not skip_invalid:
+                barcode_allocation.release(allocated, actor)
+                return Response({"status": "error", "message": "Roster has invalid rows; nothing was imported.",
+                                 "imported": 0, "failed": len(errors), "errors": error_report()},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        # --- Billing rows ---
+        now = timezone.now()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)  # Mongo keeps milliseconds
+        billing_objs, employee_objs = [], []
+        for index, serializer in employees.items():
+            billing_serializer = BillingSerializer(data={
+                "company_id": company_id,
+                "date": now,
+                "employee_id": serializer.validated_data["employee_id"],
+                "barcode": barcodes[index],
+                "testdetails": testdetails,
+                "netAmount": net_amount,
+                "paymentMode": payment_mode,
+                "package_id": package_id,
+                "created_by": actor,
+            })
+            if not billing_serializer.is_valid():
+                errors[index] = {"row": index, "employee_id": serializer.validated_data["employee_id"],
+                                 "errors": billing_serializer.errors}
+                continue
+            employee_objs.append(EmployeeRegistration(**serializer.validated_data))
+            billing_objs.append(Billing(**billing_serializer.validated_data))
+
+        if errors and not skip_invalid:
+            barcode_allocation.release(allocated, actor)
+            return Response({"status": "error", "message": "Roster has invalid rows; nothing was imported.",
+                             "imported": 0, "failed": len(errors), "errors": error_report()},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-            pkg["investigations"] = cleaned_investigations
-            packages.append(pkg)
+        unused = set(allocated) - {b.barcode for b in billing_objs}
+        if unused:
+            barcode_allocation.release(unused, actor)
+        allocated = [b.barcode for b in billing_objs]
+
+        # --- Batched inserts: employees and their billings one batch at a time ---
+        try:
+            for start in range(0, len(billing_objs), IMPORT_BATCH_SIZE):
+                EmployeeRegistration.objects.bulk_create(employee_objs[start:start + IMPORT_BATCH_SIZE])
+                Billing.objects.bulk_create(billing_objs[start:start + IMPORT_BATCH_SIZE])
+        except Exception:
+            # Only barcodes left without a billing row may go back to the pool
+            allocated = _undo_bulk_import(company_id, now, employee_objs, billing_objs)
+            raise
+        rollups.record_registrations(employee_objs, billing_objs)
 
-        return Response({"status": "success", "data": packages}, status=status.HTTP_200_OK)
+        return Response({
+            "status": "success",
+            "message": f"Imported {len(billing_objs)} employees",
+            "imported": len(billing_objs),
+            "failed": len(errors),
+            "errors": error_report(),
+            "barcodes": [{"employee_id": b.employee_id, "barcode": b.barcode} for b in billing_objs]
+        }, status=status.HTTP_201_CREATED)
 
+    except (ValueError, barcode_allocation.BarcodeAllocationError) as e:
+        barcode_allocation.release(allocated)
+        return Response({"status": "error", "message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
-        return Response({"status": "error", "message": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if allocated:
+            barcode_allocation.release(allocated)
+        logger.error(f"Error in bulk_register_employees: {str(e)}\n{traceback.format_exc()}")
+        return Response({"status": "error", "message": str(e)},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
 import os
@@ -257,8 +641,6 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework import status
-from pymongo import MongoClient
-import gridfs
 from ..models import Investigation
 from ..serializers import InvestigationSerializer
 
@@ -266,8 +648,7 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
 from rest_framework.response import Response
-from pymongo import MongoClient
-import gridfs, json
+import json
 
 import os
 import json
@@ -275,103 +656,123 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework import status
-from pymongo import MongoClient
-import gridfs
 from ..models import Investigation
 from ..serializers import InvestigationSerializer
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
 from rest_framework.response import Response
-from pymongo import MongoClient
-import gridfs, json
-@api_view(['POST'])
-@parser_classes([MultiPartParser, FormParser])
-def save_investigation(request):
-    data = dict(request.data)
-    # Convert single-value lists to plain values
-    for key, val in data.items():
-        if isinstance(val, list) and len(val) == 1:
-            data[key] = val[0]
-    # Get files
-    files_mapping = {
-        'xray_file': request.FILES.get('xray_file'),
-        'xrayfilm_file': request.FILES.get('xrayfilm_file'),  # fixed name
-        'ecg_file': request.FILES.get('ecg_file'),
-        'pft_file': request.FILES.get('pft_file'),
-        'audiometric_file': request.FILES.get('audiometric_file')
-    }
-    client = MongoClient(MONGO_URI)
-    db = client["Corporatehealthcheckup"]
-    fs = gridfs.GridFS(db)
-    try:
-        # Parse vitals JSON
-        raw_val = data.get('vitals')
-        if raw_val:
-            if isinstance(raw_val, str):
-                data['vitals'] = json.loads(raw_val)
-            elif not isinstance(raw_val, dict):
-                data['vitals'] = {}
-        # Save files to GridFS
-        for field, file_obj in files_mapping.items():
-            if file_obj:
-                file_id = fs.put(file_obj.read(), filename=file_obj.name, content_type=file_obj.content_type)
-                data[field] = str(file_id)
-        # Try to find an existing investigation by barcode
-        inv = Investigation.objects.filter(barcode=data.get('barcode')).first()
-        if inv:
-            # Update existing record
-            for key, value in data.items():
-                setattr(inv, key, value)
-            inv.save()
-            created = False
-        else:
-            # Create new record
-            inv = Investigation.objects.create(**data)
-            created = True
-        serializer = InvestigationSerializer(inv)
-        status_code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
-        return Response(serializer.data, status=status_code)
-    except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-    finally:
-        client.close()
+import json
 
 
 from ..models import Billing
+from ..pagination import (
+    PaginationError, get_limit, get_cursor, encode_cursor, cursor_for, keyset_filter,
+    set_next_cursor, date_range_filter
+)
+from ..streaming import stream_json_array
+from ..listing import get_fields, list_query, paged_list
+from ..serializers import latest_billing_barcodes
 @api_view(["GET"])
 def get_all_employees(request):
     """
     Fetch all employees referenced in Billing.
     Return only employee_name, age, gender, employee_id, barcode
+    Optional: company_id, date_from/date_to (billing date), limit + cursor for pages.
     """
-    # MongoDB connection
-    client = MongoClient(MONGO_URI)
-    db = client["Corporatehealthcheckup"]
-    collection = db["core_employeeregistration"]
-    billings = Billing.objects.all()
-    employees_map = {}
-    for billing in billings:
-        emp_id = str(billing.employee_id)
-        if emp_id not in employees_map:
-            employee = collection.find_one({"employee_id": emp_id})
-            if employee:
-                employees_map[emp_id] = {
+    try:
+        limit = get_limit(request)
+        sort = [("_id", 1)]
+        cursor = get_cursor(request, sort)
+
+        billing_match = date_range_filter(request, "date")
+        company_id = request.GET.get("company_id")
+        if company_id:
+            billing_match["company_id"] = company_id
+
+        # One server-side pass: distinct employees from Billing joined to their registration
+        pipeline = []
+        if billing_match:
+            pipeline.append({"$match": billing_match})
+        # Latest billing first, as in latest_billing_barcodes, so $first is not index-order dependent
+        pipeline.append({"$sort": {"date": -1}})
+        pipeline.append({"$group": {"_id": "$employee_id", "barcode": {"$first": "$barcode"}}})
+        if cursor:
+            pipeline.append({"$match": {"_id": {"$gt": cursor[0]}}})
+        pipeline.append({"$sort": {"_id": 1}})
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline += [
+            {"$lookup": {
+                "from": "core_employeeregistration",
+                "localField": "_id",
+                "foreignField": "employee_id",
+                "as": "employee"
+            }},
+            {"$project": {
+                "barcode": 1,
+                "employee": {"$arrayElemAt": ["$employee", 0]}
+            }},
+        ]
+        docs = get_collection("core_billing").aggregate(pipeline, allowDiskUse=True, batchSize=500)
+
+        def rows(docs):
+            for doc in docs:
+                employee = doc.get("employee")
+                if not employee:
+                    continue
+                yield {
                     "employee_name": employee.get("employee_name", ""),
                     "age": employee.get("age", ""),
                     "gender": employee.get("gender", ""),
                     "employee_id": employee.get("employee_id", ""),
-                    "barcode": str(billing.barcode) if hasattr(billing, "barcode") else "",
+                    "barcode": str(doc.get("barcode") or ""),
                     "created_date": employee.get("created_date", "")
                 }
-    return Response(list(employees_map.values()))
+
+        if not limit:
+            return stream_json_array(rows(docs))
+
+        # A page is bounded by limit, so it is safe to read it before streaming
+        page = list(docs)
+        next_cursor = encode_cursor([page[-1]["_id"]]) if len(page) == limit else None
+        return set_next_cursor(stream_json_array(rows(page)), next_cursor)
+
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        logger.error(f"Error in get_all_employees: {str(e)}\n{traceback.format_exc()}")
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+REGISTERED_EMPLOYEE_FIELDS = ["id", "barcode"] + [f.attname for f in EmployeeRegistration._meta.concrete_fields if f.attname != "id"]
 
 
 @api_view(["GET"])
 def get_all_registered_employees(request):
-    employees = EmployeeRegistration.objects.all()
-    serializer = EmployeeRegistrationSerializer(employees, many=True)
-    return Response(serializer.data)
+    """
+    Employees with their latest billing barcode.
+    Optional: company_id, date_from/date_to (registration date), fields=a,b, limit + cursor.
+    """
+    try:
+        fields = get_fields(request, REGISTERED_EMPLOYEE_FIELDS)
+        want_barcode = "barcode" in fields
+        projection_fields = [f for f in fields if f != "barcode"] + (["employee_id"] if want_barcode else [])
+
+        def render_page(docs):
+            employees = [EmployeeRegistration(**model_values(doc, EmployeeRegistration)) for doc in docs]
+            # One grouped billing query per page, and only when the barcode is asked for
+            latest_barcodes = latest_billing_barcodes(e.employee_id for e in employees) if want_barcode else {}
+            return EmployeeRegistrationSerializer(
+                employees, many=True, context={"latest_barcodes": latest_barcodes}
+            ).data
+
+        return paged_list(request, "core_employeeregistration", fields, render_page,
+                          query=list_query(request, "created_date"), projection_fields=projection_fields)
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
 from rest_framework.decorators import api_view
@@ -396,27 +797,74 @@ from rest_framework.response import Response
 from rest_framework import status
 from ..models import Investigation
 from ..serializers import InvestigationSerializer
-from pymongo import MongoClient
+
+from ..mongo import model_values
+
+REVIEW_LIST_SORT = [("date", -1), ("_id", -1)]
+
+
+def _review_list_match(request, date_field="date"):
+    """Shared status/date filters for the doctor-review lists."""
+    match = date_range_filter(request, date_field)
+    record_status = request.GET.get("status")
+    if record_status:
+        match["status"] = record_status
+    return match
+
+
+def _paged_review_response(docs, limit, render):
+    """Stream rendered rows; with a limit, read the bounded page first to emit the next cursor."""
+    if not limit:
+        return stream_json_array(render(doc) for doc in docs)
+    page = list(docs)
+    next_cursor = cursor_for(page[-1], REVIEW_LIST_SORT) if len(page) == limit else None
+    return set_next_cursor(stream_json_array(render(doc) for doc in page), next_cursor)
+
 
 @api_view(['GET'])
 def get_investigations(request):
     """
     Returns all Investigation records joined with employee_name from core_employeeregistration.
+    Optional: company_id, status, date_from/date_to, limit + cursor for pages.
     """
-    client = MongoClient(MONGO_URI)
-    db = client["Corporatehealthcheckup"]
-    employee_collection = db["core_employeeregistration"]
     try:
-        investigations = Investigation.objects.all()
-        serializer = InvestigationSerializer(investigations, many=True)
-        enriched_data = []
-        for inv in serializer.data:
+        limit = get_limit(request)
+        cursor = get_cursor(request, REVIEW_LIST_SORT)
+
+        match = _review_list_match(request)
+        company_id = request.GET.get("company_id")
+        if company_id:
+            match["company_id"] = company_id
+
+        projection = {f.attname: 1 for f in Investigation._meta.concrete_fields}
+        projection["employee_name"] = {"$arrayElemAt": ["$employee.employee_name", 0]}
+
+        pipeline = [{"$match": match}]
+        if cursor:
+            pipeline.append({"$match": keyset_filter(REVIEW_LIST_SORT, cursor)})
+        pipeline.append({"$sort": dict(REVIEW_LIST_SORT)})
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline += [
             # Match employee_id instead of barcode
-            emp = employee_collection.find_one({"employee_id": inv["employee_id"]})
-            inv["employee_name"] = emp["employee_name"] if emp and "employee_name" in emp else "-"
-            enriched_data.append(inv)
-
-        return Response(enriched_data, status=status.HTTP_200_OK)
+            {"$lookup": {
+                "from": "core_employeeregistration",
+                "localField": "employee_id",
+                "foreignField": "employee_id",
+                "as": "employee"
+            }},
+            {"$project": projection},
+        ]
+        docs = get_collection("core_investigation").aggregate(pipeline, allowDiskUse=True)
+
+        def render(doc):
+            inv = dict(InvestigationSerializer(model_values(doc, Investigation)).data)
+            inv["employee_name"] = doc.get("employee_name") or "-"
+            return inv
+
+        return _paged_review_response(docs, limit, render)
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -436,6 +884,7 @@ def approve_investigation(request, barcode):
         if record.status == "pending":
             record.status = "approved"
             record.save(update_fields=['status'])  # Only update the status field
+            rollups.record_status_change(record, "pending")
         return Response({"message": "Investigation approved successfully", "status": record.status}, status=status.HTTP_200_OK)
     except Investigation.DoesNotExist:
         return Response({"error": "Investigation not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -443,91 +892,203 @@ def approve_investigation(request, barcode):
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
 
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import http_date
 from rest_framework.decorators import api_view
 from rest_framework import status
-from pymongo import MongoClient
 import gridfs
-from bson.objectid import ObjectId
+import calendar
 import mimetypes
 import os
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client["Corporatehealthcheckup"]
-fs = gridfs.GridFS(db)
+
+GRIDFS_STREAM_CHUNK = 256 * 1024
+# File ids are never reused, so a fetched file can be cached for good
+FILE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def _file_etag(file_obj):
+    return f'"{getattr(file_obj, "md5", None) or file_obj._id}"'
+
+
+def _etag_matches(header, etag):
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def _parse_range(header, size):
+    """
+    (start, end) for a single "bytes=" range. None means serve the whole file
+    (no/unsupported header); ValueError means the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first == "":
+            length = int(last)
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None  # malformed: ignore the header
+    if first == "":
+        # Suffix range: the last N bytes; none exist in an empty file
+        if length <= 0 or size == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - length, 0), size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def _iter_gridfs(file_obj, start, length):
+    file_obj.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = file_obj.read(min(GRIDFS_STREAM_CHUNK, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
 @api_view(['GET'])
 def get_file(request, file_id):
     """
-    Fetch a file from GridFS by file_id and return as HTTP response.
+    Stream a file from GridFS by file_id.
+    Supports single byte ranges (206), If-None-Match (304) and If-Range.
     """
     try:
+        fs = gridfs.GridFS(get_db())
         file_obj = fs.get(ObjectId(file_id))
+        etag = _file_etag(file_obj)
+        size = file_obj.length
+
+        cache_headers = {"ETag": etag, "Cache-Control": FILE_CACHE_CONTROL}
+        if file_obj.upload_date:
+            # upload_date is naive UTC; .timestamp() would read it in the process time zone
+            cache_headers["Last-Modified"] = http_date(calendar.timegm(file_obj.upload_date.utctimetuple()))
+
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+            for header, value in cache_headers.items():
+                response[header] = value
+            return response
+
+        range_header = request.META.get("HTTP_RANGE")
+        if_range = request.META.get("HTTP_IF_RANGE")
+        if if_range and if_range.strip() != etag:
+            range_header = None  # the client's partial copy is stale; send it all
+
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+        start, end = byte_range if byte_range else (0, size - 1)
+        length = end - start + 1 if size else 0
         content_type, _ = mimetypes.guess_type(file_obj.filename)
-        response = HttpResponse(file_obj.read(), content_type=content_type or "application/octet-stream")
+        response = StreamingHttpResponse(
+            _iter_gridfs(file_obj, start, length),
+            status=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+            content_type=content_type or file_obj.content_type or "application/octet-stream"
+        )
+        if byte_range:
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(length)
+        response["Accept-Ranges"] = "bytes"
+        for header, value in cache_headers.items():
+            response[header] = value
         response['Content-Disposition'] = f'inline; filename="{file_obj.filename}"'
         return response
-    except gridfs.NoFile:
+    except (gridfs.NoFile, InvalidId):
         return JsonResponse({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 # ----------------------------
 # Get all Ophthalmology records + auto-approve pending
 # ----------------------------
-client = MongoClient(MONGO_URI)
-db = client["Corporatehealthcheckup"]
-fs = gridfs.GridFS(db)
 @api_view(['GET'])
 def get_ophthalmology(request):
     """
     Returns all Ophthalmology records joined with EmployeeRegistration data,
     using barcode → Billing → employee_id as the link.
+    Optional: company_id (from Billing), status, date_from/date_to, limit + cursor for pages.
     """
     try:
-        client = MongoClient(MONGO_URI)
-        db = client["Corporatehealthcheckup"]
-        fs = gridfs.GridFS(db)
-        employee_collection = db["core_employeeregistration"]
-
-        ophthalmology = Ophthalmology.objects.all()
-        serializer = OphthalmologySerializer(ophthalmology, many=True)
-
-        enriched_data = []
-
-        for op in serializer.data:
-            barcode = op.get("barcode")
-            emp_data = None
-
-            # 🔹 Step 1: Find Billing record linked to this barcode
-            billing = Billing.objects.filter(barcode=barcode).order_by("-date").first()
-
-            # 🔹 Step 2: Find employee record in Mongo using employee_id
-            if billing:
-                emp = employee_collection.find_one({"employee_id": billing.employee_id})
-                if emp:
-                    emp_data = {
-                        "employee_name": emp.get("employee_name", "-"),
-                        "employee_id": emp.get("employee_id", "-"),
-                        "gender": emp.get("gender", "-"),
-                        "age": emp.get("age", "-"),
-                    }
-
-            # 🔹 Step 3: Fallbacks if employee not found
-            if not emp_data:
-                emp_data = {
-                    "employee_name": "-",
-                    "employee_id": "-",
-                    "gender": "-",
-                    "age": "-",
-                }
-
-            # 🔹 Step 4: Merge employee info into Ophthalmology record
-            op.update(emp_data)
-            op["date"] = op.get("date") or (billing.date if billing else None)
-
-            enriched_data.append(op)
-
-        return Response(enriched_data, status=status.HTTP_200_OK)
-
+        limit = get_limit(request)
+        cursor = get_cursor(request, REVIEW_LIST_SORT)
+        company_id = request.GET.get("company_id")
+
+        pipeline = [{"$match": _review_list_match(request)}]
+        if cursor:
+            pipeline.append({"$match": keyset_filter(REVIEW_LIST_SORT, cursor)})
+        pipeline.append({"$sort": dict(REVIEW_LIST_SORT)})
+        # Without a company filter the page can be cut before the joins run
+        if limit and not company_id:
+            pipeline.append({"$limit": limit})
+
+        # 🔹 Latest Billing record linked to this barcode
+        pipeline += [
+            {"$lookup": {
+                "from": "core_billing",
+                "let": {"barcode": "$barcode"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$barcode", "$$barcode"]}}},
+                    {"$sort": {"date": -1}},
+                    {"$limit": 1},
+                    {"$project": {"_id": 0, "employee_id": 1, "company_id": 1, "date": 1}},
+                ],
+                "as": "billing"
+            }},
+            {"$addFields": {"billing": {"$arrayElemAt": ["$billing", 0]}}},
+        ]
+        if company_id:
+            pipeline.append({"$match": {"billing.company_id": company_id}})
+            if limit:
+                pipeline.append({"$limit": limit})
+
+        # 🔹 Employee record using the billing's employee_id
+        projection = {f.attname: 1 for f in Ophthalmology._meta.concrete_fields}
+        projection.update({
+            "billing_date": "$billing.date",
+            "employee.employee_name": 1,
+            "employee.employee_id": 1,
+            "employee.gender": 1,
+            "employee.age": 1,
+        })
+        pipeline += [
+            {"$lookup": {
+                "from": "core_employeeregistration",
+                "localField": "billing.employee_id",
+                "foreignField": "employee_id",
+                "as": "employee"
+            }},
+            {"$addFields": {"employee": {"$arrayElemAt": ["$employee", 0]}}},
+            {"$project": projection},
+        ]
+        docs = get_collection("core_ophthalmology").aggregate(pipeline, allowDiskUse=True)
+
+        def render(doc):
+            op = dict(OphthalmologySerializer(model_values(doc, Ophthalmology)).data)
+            emp = doc.get("employee")
+            # 🔹 Fallbacks if employee not found
+            op.update({
+                "employee_name": emp.get("employee_name", "-") if emp else "-",
+                "employee_id": emp.get("employee_id", "-") if emp else "-",
+                "gender": emp.get("gender", "-") if emp else "-",
+                "age": emp.get("age", "-") if emp else "-",
+            })
+            op["date"] = op.get("date") or doc.get("billing_date")
+            return op
+
+        return _paged_review_response(docs, limit, render)
+
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -562,7 +1123,6 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework import status
-from pymongo import MongoClient
 import gridfs
 from ..models import Investigation
 from ..serializers import InvestigationSerializer
@@ -570,8 +1130,63 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
 from rest_framework.response import Response
-from pymongo import MongoClient
 import gridfs, json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+INVESTIGATION_FILE_FIELDS = ('xray_file', 'xrayfilm_file', 'ecg_file', 'pft_file', 'audiometric_file')
+GRIDFS_UPLOAD_WORKERS = int(os.getenv("GRIDFS_UPLOAD_WORKERS", 5))
+
+
+def _upload_sha256(file_obj):
+    """Hash an upload chunk by chunk (uploads are on local disk or in memory)."""
+    digest = hashlib.sha256()
+    for chunk in file_obj.chunks():
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+def _store_investigation_file(fs, file_obj, barcode, field):
+    """
+    Stream one upload into GridFS and return its file id. The same content
+    already stored for this barcode is reused instead of uploaded again.
+    """
+    sha256 = _upload_sha256(file_obj)
+    existing = get_collection("fs.files").find_one(
+        {"metadata.barcode": barcode, "metadata.sha256": sha256}, {"_id": 1}
+    )
+    if existing:
+        return str(existing["_id"])
+
+    grid_in = fs.new_file(
+        filename=file_obj.name,
+        content_type=file_obj.content_type,
+        metadata={"barcode": barcode, "field": field, "sha256": sha256}
+    )
+    try:
+        for chunk in file_obj.chunks():
+            grid_in.write(chunk)
+    except Exception:
+        grid_in.abort()
+        raise
+    grid_in.close()
+    return str(grid_in._id)
+
+
+def _store_investigation_files(fs, files_mapping, barcode):
+    """Upload the attached files concurrently; returns {field: file_id}."""
+    uploads = {field: f for field, f in files_mapping.items() if f}
+    if len(uploads) <= 1:
+        return {field: _store_investigation_file(fs, f, barcode, field) for field, f in uploads.items()}
+    with ThreadPoolExecutor(max_workers=min(GRIDFS_UPLOAD_WORKERS, len(uploads))) as pool:
+        futures = {
+            field: pool.submit(_store_investigation_file, fs, f, barcode, field)
+            for field, f in uploads.items()
+        }
+        return {field: future.result() for field, future in futures.items()}
+
+
 @api_view(['POST'])
 @parser_classes([MultiPartParser, FormParser])
 def save_investigation(request):
@@ -581,16 +1196,8 @@ def save_investigation(request):
         if isinstance(val, list) and len(val) == 1:
             data[key] = val[0]
     # Get files
-    files_mapping = {
-        'xray_file': request.FILES.get('xray_file'),
-        'xrayfilm_file': request.FILES.get('xrayfilm_file'),  # fixed name
-        'ecg_file': request.FILES.get('ecg_file'),
-        'pft_file': request.FILES.get('pft_file'),
-        'audiometric_file': request.FILES.get('audiometric_file')
-    }
-    client = MongoClient(MONGO_URI)
-    db = client["Corporatehealthcheckup"]
-    fs = gridfs.GridFS(db)
+    files_mapping = {field: request.FILES.get(field) for field in INVESTIGATION_FILE_FIELDS}
+    fs = gridfs.GridFS(get_db())
     try:
         # Parse vitals JSON
         raw_val = data.get('vitals')
@@ -600,29 +1207,27 @@ def save_investigation(request):
             elif not isinstance(raw_val, dict):
                 data['vitals'] = {}
         # Save files to GridFS
-        for field, file_obj in files_mapping.items():
-            if file_obj:
-                file_id = fs.put(file_obj.read(), filename=file_obj.name, content_type=file_obj.content_type)
-                data[field] = str(file_id)
+        data.update(_store_investigation_files(fs, files_mapping, data.get('barcode')))
         # Try to find an existing investigation by barcode
         inv = Investigation.objects.filter(barcode=data.get('barcode')).first()
         if inv:
             # Update existing record
+            previous = rollups.investigation_snapshot(inv)
             for key, value in data.items():
                 setattr(inv, key, value)
             inv.save()
             created = False
+            rollups.record_investigation(inv, previous=previous)
         else:
             # Create new record
             inv = Investigation.objects.create(**data)
             created = True
+            rollups.record_investigation(inv)
         serializer = InvestigationSerializer(inv)
         status_code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
         return Response(serializer.data, status=status_code)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-    finally:
-        client.close()
 
 
 from rest_framework.decorators import api_view
@@ -1,15 +1,22 @@
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from django.db import transaction
 from django.utils import timezone
 from datetime import datetime
 import os
 import json
 import re
 from collections import Counter
-from pymongo import MongoClient
-import certifi
+from ..mongo import get_collection, model_values
+from ..test_catalog import test_catalog
+from ..sample_status import (
+    SampleConflictError, apply_transitions, dump_testdetails, ensure_pending_transfer_flags, guarded_update,
+    is_pending_transfer, parse_testdetails, testdetails_fields, update_testdetails
+)
+from ..pagination import (
+    PaginationError, cursor_for, get_cursor, get_limit, keyset_filter, set_next_cursor
+)
+from ..listing import get_fields, list_query, paged_list
 
 from ..models import Billing, Sample, Batch, EmployeeRegistration
 from ..serializers import BillingSerializer, SampleSerializer, BatchSerializer
@@ -41,60 +48,74 @@ def get_billing_patients(request):
             company_id=company_id
         )
 
+        # Anchored prefix match so the company/employee_id and company/barcode indexes apply
         if employee_id:
-            billings = billings.filter(employee_id__icontains=employee_id)
+            billings = billings.filter(employee_id__startswith=employee_id)
         if barcode:
-            billings = billings.filter(barcode__icontains=barcode)
+            billings = billings.filter(barcode__startswith=barcode)
 
-        billing_data = []
+        # --- Billings with at least one billed test ---
+        billed = []
         for billing in billings:
-            has_uncollected = False
-            test_count = 0
+            if not billing.testdetails:
+                continue
+            tests = billing.testdetails if isinstance(billing.testdetails, list) else json.loads(billing.testdetails)
+            valid_tests = [t for t in tests if isinstance(t, dict) and t.get('test_id')]
+            if valid_tests:
+                billed.append((billing, valid_tests))
+
+        # --- Today's samples for those barcodes, in one query ---
+        processed_by_barcode = {}
+        if billed:
+            samples = Sample.objects.filter(
+                barcode__in=list({billing.barcode for billing, _ in billed}),
+                company_id=company_id,
+                created_date__gte=start_of_day,
+                created_date__lte=end_of_day
+            )
+            for sample in samples:
+                if sample.barcode in processed_by_barcode or not sample.testdetails:
+                    continue
+                sample_tests = sample.testdetails if isinstance(sample.testdetails, list) else json.loads(sample.testdetails)
+                processed_by_barcode[sample.barcode] = {
+                    st.get("test_id") for st in sample_tests
+                    if isinstance(st, dict) and st.get("samplestatus") in ["Collected", "Transferred", "Received"]
+                }
+
+        uncollected = [
+            (billing, valid_tests) for billing, valid_tests in billed
+            if any(t['test_id'] not in processed_by_barcode.get(billing.barcode, set()) for t in valid_tests)
+        ]
 
-            if billing.testdetails:
-                tests = billing.testdetails if isinstance(billing.testdetails, list) else json.loads(billing.testdetails)
-                valid_tests = [t for t in tests if isinstance(t, dict) and t.get('test_id')]
-                test_count = len(valid_tests)
+        # --- Employee details for the remaining rows, in one query ---
+        employees = {}
+        if uncollected:
+            employee_rows = EmployeeRegistration.objects.filter(
+                employee_id__in=list({billing.employee_id for billing, _ in uncollected})
+            ).values('employee_id', 'employee_name', 'age', 'gender', 'department')
+            for emp in employee_rows:
+                employees.setdefault(emp['employee_id'], emp)
 
-                if valid_tests:
-                    existing_sample = Sample.objects.filter(
-                        barcode=billing.barcode,
-                        company_id=company_id,
-                        created_date__gte=start_of_day,
-                        created_date__lte=end_of_day
-                    ).first()
-
-                    processed = set()
-                    if existing_sample and existing_sample.testdetails:
-                        sample_tests = existing_sample.testdetails if isinstance(existing_sample.testdetails, list) else json.loads(existing_sample.testdetails)
-                        for st in sample_tests:
-                            if st.get("samplestatus") in ["Collected", "Transferred", "Received"]:
-                                processed.add(st.get("test_id"))
-
-                    for t in valid_tests:
-                        if t['test_id'] not in processed:
-                            has_uncollected = True
-                            break
-
-            if has_uncollected:
-                billing_dict = BillingSerializer(billing).data
-                billing_dict['test_count'] = test_count
+        billing_data = []
+        for billing, valid_tests in uncollected:
+            billing_dict = BillingSerializer(billing).data
+            billing_dict['test_count'] = len(valid_tests)
+
+            emp = employees.get(billing.employee_id)
+            if emp:
+                billing_dict['employee_name'] = emp['employee_name']
+                billing_dict['age'] = emp['age']
+                billing_dict['gender'] = emp['gender']
+                billing_dict['department'] = emp['department']
+            else:
+                billing_dict.update({
+                    'employee_name': 'Unknown',
+                    'age': None,
+                    'gender': 'Unknown',
+                    'department': 'Unknown'
+                })
 
-                try:
-                    emp = EmployeeRegistration.objects.get(employee_id=billing.employee_id)
-                    billing_dict['employee_name'] = emp.employee_name
-                    billing_dict['age'] = emp.age
-                    billing_dict['gender'] = emp.gender
-                    billing_dict['department'] = emp.department
-                except EmployeeRegistration.DoesNotExist:
-                    billing_dict.update({
-                        'employee_name': 'Unknown',
-                        'age': None,
-                        'gender': 'Unknown',
-                        'department': 'Unknown'
-                    })
-
-                billing_data.append(billing_dict)
+            billing_data.append(billing_dict)
 
         return Response({'results': billing_data, 'count': len(billing_data)})
 
@@ -102,6 +123,18 @@ def get_billing_patients(request):
         return Response({'error': str(e)}, status=500)
     
     
+def _render_sample(doc):
+    """SampleSerializer output for a raw core_sample document."""
+    return SampleSerializer(Sample(**model_values(doc, Sample))).data
+
+
+SAMPLE_LIST_SORT = [("created_date", 1), ("_id", 1)]
+SAMPLE_LIST_PROJECTION = {
+    "barcode": 1, "company_id": 1, "employee_id": 1,
+    "created_date": 1, "collected_by": 1, "testdetails": 1,
+}
+
+
 @api_view(['GET', 'POST', 'PATCH'])
 def sample_management(request):
     """Handle sample collection, transfer, and status updates"""
@@ -118,15 +151,16 @@ def sample_management(request):
             return Response({'error': 'date and company_id are required'}, status=400)
 
         try:
+            limit = get_limit(request)
+            cursor = get_cursor(request, SAMPLE_LIST_SORT)
+            test_fields = [f.strip() for f in request.GET.get('test_fields', '').split(',') if f.strip()]
+
             # Parse date for filtering
             filter_date = datetime.strptime(date_str, '%Y-%m-%d')
             start_of_day = datetime.combine(filter_date, datetime.min.time())
             end_of_day = datetime.combine(filter_date, datetime.max.time())
 
-            # MongoDB connection
-            client = MongoClient(os.getenv('GLOBAL_DB_HOST'))
-            db = client.Corporatehealthcheckup
-            collection = db.core_sample
+            collection = get_collection("core_sample")
 
             # Build MongoDB filter
             mongo_filter = {'company_id': company_id}
@@ -137,98 +171,93 @@ def sample_management(request):
             if employee_id:
                 mongo_filter['employee_id'] = employee_id
 
-            # Fetch documents from MongoDB
-            samples = list(collection.find(mongo_filter))
+            # testdetails is stored as JSON text or a list; skip samples with no test in this status
+            mongo_filter['$or'] = [
+                {'testdetails': {'$regex': f'"samplestatus":\\s*"{re.escape(sample_status)}"'}},
+                {'testdetails.samplestatus': sample_status},
+            ]
+            if cursor:
+                mongo_filter = {'$and': [mongo_filter, keyset_filter(SAMPLE_LIST_SORT, cursor)]}
 
-            sample_data = []
+            docs = collection.find(mongo_filter, SAMPLE_LIST_PROJECTION).sort(SAMPLE_LIST_SORT)
+            if limit:
+                docs = docs.limit(limit)
+            samples = list(docs)
+            next_cursor = cursor_for(samples[-1], SAMPLE_LIST_SORT) if limit and len(samples) == limit else None
+
+            # --- Tests in the requested status, per sample ---
+            page = []
             for sample in samples:
                 try:
-                    # Parse testdetails (stored as string in MongoDB sometimes)
-                    testdetails_raw = sample.get('testdetails', '[]')
-                    if isinstance(testdetails_raw, str):
-                        tests = json.loads(testdetails_raw)
-                    else:
-                        tests = testdetails_raw if isinstance(testdetails_raw, list) else []
-
-                    # Filter tests by samplestatus
-                    valid_tests = [
-                        t for t in tests if isinstance(t, dict) and t.get('samplestatus') == sample_status
-                    ]
-                    if not valid_tests:
-                        continue
-
-                    # Default employee info
-                    employee_info = {
-                        'employee_id': None,
-                        'employee_name': 'Unknown',
-                        'age': None,
-                        'gender': 'Unknown',
-                        'department': 'Unknown'
-                    }
-
-                    # Get employee_id from sample
-                    sample_employee_id = sample.get('employee_id')
-                    sample_barcode = sample.get('barcode')
-
-                    # If missing employee_id, get from Billing using barcode
-                    if not sample_employee_id and sample_barcode:
-                        billing = Billing.objects.filter(
-                            barcode=sample_barcode,
-                            company_id=company_id
-                        ).order_by('-date').first()
-                        if billing:
-                            sample_employee_id = billing.employee_id
-
-                    # Now fetch employee details from EmployeeRegistration
-                    if sample_employee_id:
-                        try:
-                            employee = EmployeeRegistration.objects.get(employee_id=sample_employee_id)
-                            employee_info = {
-                                'employee_id': employee.employee_id,
-                                'employee_name': employee.employee_name or 'Unknown',
-                                'age': employee.age,
-                                'gender': employee.gender or 'Unknown',
-                                'department': employee.department or 'Unknown'
-                            }
-                        except EmployeeRegistration.DoesNotExist:
-                            employee_info['employee_id'] = sample_employee_id
-
-                    # Build final sample dict
-                    sample_dict = {
-                        "_id": str(sample.get('_id')),
-                        "barcode": sample.get('barcode'),
-                        "company_id": sample.get('company_id'),
-                        "employee_id": employee_info['employee_id'],
-                        "created_date": sample.get('created_date'),
-                        "collected_date": sample.get('created_date'),
-                        "collected_by": sample.get('collected_by', 'System'),
-                        "testdetails": valid_tests,
-                        # Employee information
-                        "employee_name": employee_info['employee_name'],
-                        "age": employee_info['age'],
-                        "gender": employee_info['gender'],
-                        "department": employee_info['department']
-                    }
-
-                    sample_data.append(sample_dict)
-
+                    tests = parse_testdetails(sample.get('testdetails'))
                 except Exception as e:
                     print(f"Error processing sample {sample.get('_id')}: {e}")
                     continue
+                valid_tests = [
+                    t for t in tests if isinstance(t, dict) and t.get('samplestatus') == sample_status
+                ]
+                if valid_tests:
+                    if test_fields:
+                        valid_tests = [{k: t.get(k) for k in test_fields} for t in valid_tests]
+                    page.append((sample, valid_tests))
+
+            # --- employee_id for samples that lack one: newest billing per barcode, one query ---
+            billed_employee_ids = {}
+            missing_barcodes = [s.get('barcode') for s, _ in page if not s.get('employee_id') and s.get('barcode')]
+            if missing_barcodes:
+                billings = get_collection("core_billing").find(
+                    {'barcode': {'$in': missing_barcodes}, 'company_id': company_id},
+                    {'_id': 0, 'barcode': 1, 'employee_id': 1}
+                ).sort('date', -1)
+                for billing in billings:
+                    billed_employee_ids.setdefault(billing.get('barcode'), billing.get('employee_id'))
+
+            # --- Employee details, one query ---
+            employee_ids = {s.get('employee_id') or billed_employee_ids.get(s.get('barcode')) for s, _ in page}
+            employee_ids.discard(None)
+            employees = {}
+            if employee_ids:
+                rows = get_collection("core_employeeregistration").find(
+                    {'employee_id': {'$in': list(employee_ids)}},
+                    {'_id': 0, 'employee_id': 1, 'employee_name': 1, 'age': 1, 'gender': 1, 'department': 1}
+                )
+                for emp in rows:
+                    employees.setdefault(emp.get('employee_id'), emp)
 
-            return Response({
+            sample_data = []
+            for sample, valid_tests in page:
+                sample_employee_id = sample.get('employee_id') or billed_employee_ids.get(sample.get('barcode'))
+                employee = employees.get(sample_employee_id) or {}
+
+                # Build final sample dict
+                sample_data.append({
+                    "_id": str(sample.get('_id')),
+                    "barcode": sample.get('barcode'),
+                    "company_id": sample.get('company_id'),
+                    "employee_id": sample_employee_id,
+                    "created_date": sample.get('created_date'),
+                    "collected_date": sample.get('created_date'),
+                    "collected_by": sample.get('collected_by', 'System'),
+                    "testdetails": valid_tests,
+                    # Employee information
+                    "employee_name": employee.get('employee_name') or 'Unknown',
+                    "age": employee.get('age'),
+                    "gender": employee.get('gender') or 'Unknown',
+                    "department": employee.get('department') or 'Unknown'
+                })
+
+            response = Response({
                 'results': sample_data,
-                'count': len(sample_data)
+                'count': len(sample_data),
+                'next_cursor': next_cursor
             })
+            return set_next_cursor(response, next_cursor)
 
+        except PaginationError as e:
+            return Response({'error': str(e)}, status=400)
         except Exception as e:
             print(f"Error in sample_management GET: {e}")
             return Response({'error': str(e)}, status=500)
-        finally:
-            try:
-                client.close()
-            except:
-                pass
 
     elif request.method == 'POST':
         # Create or update sample collection with required date, company_id, barcode
@@ -254,141 +283,47 @@ def sample_management(request):
             return Response({"error": "No valid tests with test_id found"}, status=400)
 
         try:
-            with transaction.atomic():
-                # Parse date for filtering
-                filter_date = datetime.strptime(date_str, '%Y-%m-%d')
-                start_of_day = datetime.combine(filter_date, datetime.min.time())
-                end_of_day = datetime.combine(filter_date, datetime.max.time())
-                
-                if timezone.is_aware(timezone.now()):
-                    start_of_day = timezone.make_aware(start_of_day)
-                    end_of_day = timezone.make_aware(end_of_day)
-
-                # Get billing record with date, company_id, and barcode
-                billing = Billing.objects.filter(
-                    barcode=barcode,
-                    company_id=company_id,
-                    date__gte=start_of_day,
-                    date__lte=end_of_day
-                ).first()
-                
-                if not billing:
-                    return Response({"error": "Billing record not found for the given date, company_id and barcode"}, status=404)
-
-                # Check if sample already exists
-                existing_sample = Sample.objects.filter(
-                    barcode=barcode,
-                    company_id=company_id,
-                    created_date__gte=start_of_day,
-                    created_date__lte=end_of_day
-                ).first()
-                
-                if existing_sample:
-                    # Update existing sample with new test statuses
-                    try:
-                        if isinstance(existing_sample.testdetails, str):
-                            existing_tests = json.loads(existing_sample.testdetails)
-                        else:
-                            existing_tests = existing_sample.testdetails or []
-                        
-                        if not isinstance(existing_tests, list):
-                            existing_tests = []
-                    except:
-                        existing_tests = []
-
-                    # Create a mapping of existing tests by test_id
-                    existing_tests_map = {}
-                    for i, test in enumerate(existing_tests):
-                        if isinstance(test, dict) and test.get('test_id'):
-                            existing_tests_map[test['test_id']] = i
-
-                    # Update existing tests or add new ones
-                    current_time = timezone.now().isoformat()
-                    for new_test in valid_testdetails:
-                        test_id = new_test.get('test_id')
-                        new_status = new_test.get('samplestatus', 'Pending')
-                        
-                        if test_id in existing_tests_map:
-                            # Update existing test
-                            test_index = existing_tests_map[test_id]
-                            existing_test = existing_tests[test_index]
-                            
-                            existing_test['samplestatus'] = new_status
-                            existing_test['lastmodified_by'] = collected_by
-                            existing_test['lastmodified_time'] = current_time
-                            
-                            if new_status == 'Collected':
-                                existing_test['collected_by'] = collected_by
-                                existing_test['samplecollected_time'] = current_time
-                                if 'specimen_type' not in existing_test or not existing_test['specimen_type']:
-                                    existing_test['specimen_type'] = new_test.get('specimen_type', 'Standard')
-                        else:
-                            # Add new test
-                            new_test_data = {
-                                'testname': new_test.get('testname', ''),
-                                'test_id': test_id,
-                                'samplestatus': new_status,
-                                'samplecollected_time': current_time if new_status == 'Collected' else None,
-                                'collected_by': collected_by if new_status == 'Collected' else None,
-                                'batch_number': None,
-                                'sampletransferred_time': None,
-                                'transferred_by': None,
-                                'received_time': None,
-                                'received_by': None,
-                                'remarks': None,
-                                'specimen_type': new_test.get('specimen_type', 'Standard'),
-                                'lastmodified_by': collected_by,
-                                'lastmodified_time': current_time
-                            }
-                            existing_tests.append(new_test_data)
-                    
-                    # Store as list directly, not JSON string
-                    existing_sample.testdetails = existing_tests
-                    existing_sample.lastmodified_by = collected_by
-                    existing_sample.lastmodified_date = timezone.now()
-                    existing_sample.save()
-                    
-                    sample = existing_sample
-                    created = False
-                else:
-                    # Create new sample
-                    current_time = timezone.now().isoformat()
-                    formatted_testdetails = []
-                    
-                    for test in valid_testdetails:
-                        test_status = test.get('samplestatus', 'Pending')
-                        test_data = {
-                            'testname': test.get('testname', ''),
-                            'test_id': test.get('test_id'),
-                            'samplestatus': test_status,
-                            'samplecollected_time': current_time if test_status == 'Collected' else None,
-                            'collected_by': collected_by if test_status == 'Collected' else None,
-                            'batch_number': None,
-                            'sampletransferred_time': None,
-                            'transferred_by': None,
-                            'received_time': None,
-                            'received_by': None,
-                            'remarks': None,
-                            'specimen_type': test.get('specimen_type', 'Standard'),
-                            'lastmodified_by': collected_by,
-                            'lastmodified_time': current_time
-                        }
-                        formatted_testdetails.append(test_data)
-
-                    sample = Sample.objects.create(
-                        barcode=barcode,
-                        company_id=company_id,
-                        testdetails=formatted_testdetails,  # Store as list directly
-                        created_by=collected_by
-                    )
-                    created = True
+            # Parse date for filtering
+            filter_date = datetime.strptime(date_str, '%Y-%m-%d')
+            start_of_day = timezone.make_aware(datetime.combine(filter_date, datetime.min.time()))
+            end_of_day = timezone.make_aware(datetime.combine(filter_date, datetime.max.time()))
+
+            # Get billing record with date, company_id, and barcode
+            billing = Billing.objects.filter(
+                barcode=barcode,
+                company_id=company_id,
+                date__gte=start_of_day,
+                date__lte=end_of_day
+            ).first()
 
-                serializer = SampleSerializer(sample)
+            if not billing:
+                return Response({"error": "Billing record not found for the given date, company_id and barcode"}, status=404)
+
+            # --- Guarded per-test transitions; creates the sample on first collection ---
+            current_time = timezone.now().isoformat()
+            outcomes, sample_doc, created = update_testdetails(
+                get_collection("core_sample"),
+                {"barcode": barcode, "company_id": company_id,
+                 "created_date": {"$gte": start_of_day, "$lte": end_of_day}},
+                lambda tests: apply_transitions(tests, valid_testdetails, collected_by, current_time, add_missing=True),
+                collected_by,
+                create={"barcode": barcode, "company_id": company_id}
+            )
+
+            if not any(o["result"] in ("applied", "added", "unchanged") for o in outcomes):
                 return Response({
-                    "message": "Sample data saved successfully",
-                    "data": serializer.data
-                }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+                    "error": "No test could be moved to the requested status",
+                    "tests": outcomes
+                }, status=status.HTTP_409_CONFLICT)
 
+            return Response({
+                "message": "Sample data saved successfully",
+                "data": _render_sample(sample_doc),
+                "tests": outcomes
+            }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+        except SampleConflictError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
         except Exception as e:
             return Response({"error": str(e)}, status=500)
 
@@ -408,118 +343,295 @@ def sample_management(request):
 
         try:
             filter_date = datetime.strptime(date_str, '%Y-%m-%d')
-            start = datetime.combine(filter_date, datetime.min.time())
-            end = datetime.combine(filter_date, datetime.max.time())
-            if timezone.is_aware(timezone.now()):
-                start = timezone.make_aware(start)
-                end = timezone.make_aware(end)
-
-            sample = Sample.objects.filter(
-                barcode=barcode, company_id=company_id,
-                created_date__gte=start, created_date__lte=end
-            ).first()
-            if not sample:
+            start = timezone.make_aware(datetime.combine(filter_date, datetime.min.time()))
+            end = timezone.make_aware(datetime.combine(filter_date, datetime.max.time()))
+
+            current_time = timezone.now().isoformat()
+            outcomes, sample_doc, _ = update_testdetails(
+                get_collection("core_sample"),
+                {"barcode": barcode, "company_id": company_id,
+                 "created_date": {"$gte": start, "$lte": end}},
+                lambda tests: apply_transitions(tests, valid_tests, transferred_by, current_time, target='Transferred'),
+                transferred_by
+            )
+            if sample_doc is None:
                 return Response({"error": "Sample not found"}, status=404)
 
-            existing = sample.testdetails if isinstance(sample.testdetails, list) else json.loads(sample.testdetails or "[]")
-            existing_map = {t['test_id']: i for i, t in enumerate(existing) if isinstance(t, dict) and t.get('test_id')}
-
-            now = timezone.now().isoformat()
-            updated = 0
-            for new_t in valid_tests:
-                tid = new_t['test_id']
-                if tid in existing_map:
-                    idx = existing_map[tid]
-                    ex = existing[idx]
-                    ex['samplestatus'] = 'Transferred'   # preserve format
-                    ex['transferred_by'] = transferred_by
-                    ex['sampletransferred_time'] = now
-                    ex['lastmodified_by'] = transferred_by
-                    ex['lastmodified_time'] = now
-                    updated += 1
-
-            sample.testdetails = existing
-            sample.lastmodified_by = transferred_by
-            sample.lastmodified_date = timezone.now()
-            sample.save()
-
-            return Response({"message": f"Updated {updated} tests", "data": SampleSerializer(sample).data})
+            updated = sum(1 for o in outcomes if o["result"] == "applied")
+            return Response({"message": f"Updated {updated} tests", "data": _render_sample(sample_doc), "tests": outcomes})
 
+        except SampleConflictError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
         except Exception as e:
             return Response({"error": str(e)}, status=500)
-        
+
+
+MAX_BULK_SAMPLES = int(os.getenv("MAX_BULK_SAMPLES", 1000))
+
+
+@api_view(['POST', 'PATCH'])
+def bulk_sample_management(request):
+    """
+    Collect (POST) or transfer/receive (PATCH) many barcodes in one request.
+    Body: date, company_id, collected_by/transferred_by/received_by,
+    samplestatus (PATCH only: Transferred or Received) and
+    samples: [{"barcode": ..., "testdetails": [...]}]. Returns a result per barcode.
+    """
+    date_str = request.data.get('date')
+    company_id = request.data.get('company_id')
+    items = request.data.get('samples', [])
+    collecting = request.method == 'POST'
+    target = None if collecting else request.data.get('samplestatus', 'Transferred')
+    actor_field = {None: 'collected_by', 'Transferred': 'transferred_by', 'Received': 'received_by'}.get(target)
+    if actor_field is None:
+        return Response({"error": "samplestatus must be Transferred or Received"}, status=400)
+    actor = request.data.get(actor_field, 'system')
+
+    if not date_str or not company_id:
+        return Response({"error": "date and company_id are required"}, status=400)
+    if not isinstance(items, list) or not items:
+        return Response({"error": "samples must be a non-empty list"}, status=400)
+    if len(items) > MAX_BULK_SAMPLES:
+        return Response({"error": f"At most {MAX_BULK_SAMPLES} samples can be sent per request"}, status=400)
+
+    try:
+        filter_date = datetime.strptime(date_str, '%Y-%m-%d')
+    except ValueError:
+        return Response({"error": "date must be in YYYY-MM-DD format"}, status=400)
+    start = timezone.make_aware(datetime.combine(filter_date, datetime.min.time()))
+    end = timezone.make_aware(datetime.combine(filter_date, datetime.max.time()))
+
+    # --- Group the valid tests per barcode; repeated barcodes are merged ---
+    invalid = []
+    requested = {}
+    for item in items:
+        item = item if isinstance(item, dict) else {}
+        barcode = str(item.get('barcode') or '').strip()
+        tests = item.get('testdetails')
+        valid_tests = [t for t in tests if isinstance(t, dict) and t.get('test_id')] if isinstance(tests, list) else []
+        if not barcode:
+            invalid.append({"barcode": None, "status": "error", "error": "barcode is required"})
+        elif not valid_tests:
+            invalid.append({"barcode": barcode, "status": "error", "error": "No valid tests with test_id found"})
+        else:
+            requested.setdefault(barcode, []).extend(valid_tests)
+
+    def _result(barcode, outcomes, created=False, changed=True):
+        if not any(o["result"] in ("applied", "added", "unchanged") for o in outcomes):
+            state = "conflict"
+        else:
+            state = "created" if created else ("updated" if changed else "unchanged")
+        return {"barcode": barcode, "status": state, "tests": outcomes}
+
+    try:
+        sample_collection = get_collection("core_sample")
+        barcodes = list(requested)
+        day = {"$gte": start, "$lte": end}
+
+        billed = set()
+        if collecting and barcodes:
+            billed = set(get_collection("core_billing").distinct(
+                "barcode", {"barcode": {"$in": barcodes}, "company_id": company_id, "date": day}
+            ))
+
+        samples = {}
+        if barcodes:
+            for doc in sample_collection.find(
+                {"barcode": {"$in": barcodes}, "company_id": company_id, "created_date": day},
+                {"barcode": 1, "testdetails": 1}
+            ):
+                samples.setdefault(doc["barcode"], doc)
+
+        now = timezone.now()
+        now_iso = now.isoformat()
+        results = {}
+        mutations = {}
+        ops = []
+        op_barcodes = []
+        written = {}  # barcode -> (_id, testdetails text this request wrote)
+        for barcode, tests in requested.items():
+            sample = samples.get(barcode)
+            mutations[barcode] = mutate = (
+                lambda current, tests=tests: apply_transitions(
+                    current, tests, actor, now_iso, target=target, add_missing=collecting
+                )
+            )
+            try:
+                if collecting and barcode not in billed:
+                    results[barcode] = {"barcode": barcode, "status": "error",
+                                        "error": "Billing record not found for the given date, company_id and barcode"}
+                    continue
+                if not collecting and not sample:
+                    results[barcode] = {"barcode": barcode, "status": "error", "error": "Sample not found"}
+                    continue
+
+                if sample is None:
+                    new_tests = []
+                    outcomes = mutate(new_tests)
+                    ops.append(InsertOne({
+                        "date": now,
+                        "company_id": company_id,
+                        "barcode": barcode,
+                        "created_by": actor,
+                        "created_date": now,
+                        "lastmodified_by": None,
+                        "lastmodified_date": None,
+                        **testdetails_fields(new_tests),
+                    }))
+                    results[barcode] = _result(barcode, outcomes, created=True)
+                else:
+                    raw = sample.get("testdetails")
+                    existing = parse_testdetails(raw)
+                    outcomes = mutate(existing)
+                    new_raw = dump_testdetails(existing)
+                    if new_raw == raw:
+                        results[barcode] = _result(barcode, outcomes, changed=False)
+                        continue
+                    # Only applies if nobody changed the sample since it was read
+                    guard, update = guarded_update(raw, existing, actor)
+                    guard["_id"] = sample["_id"]
+                    ops.append(UpdateOne(guard, update))
+                    written[barcode] = (sample["_id"], new_raw)
+                    results[barcode] = _result(barcode, outcomes)
+                op_barcodes.append(barcode)
+            except Exception as e:
+                results[barcode] = {"barcode": barcode, "status": "error", "error": str(e)}
+
+        # --- All writes in one round trip ---
+        retry = set()
+        if ops:
+            try:
+                matched = sample_collection.bulk_write(ops, ordered=False).matched_count
+            except BulkWriteError as e:
+                matched = e.details.get("nMatched", 0)
+                # Typically a sample created concurrently for the same barcode
+                retry.update(op_barcodes[err["index"]] for err in e.details.get("writeErrors", []))
+            if matched < len(written):
+                # Some guarded updates lost a race; find which and redo them on fresh data
+                current = {
+                    doc["_id"]: doc.get("testdetails")
+                    for doc in sample_collection.find(
+                        {"_id": {"$in": [_id for _id, _ in written.values()]}}, {"testdetails": 1}
+                    )
+                }
+                retry.update(b for b, (_id, new_raw) in written.items() if current.get(_id) != new_raw)
+
+        for barcode in retry:
+            try:
+                outcomes, _, created = update_testdetails(
+                    sample_collection,
+                    {"barcode": barcode, "company_id": company_id, "created_date": day},
+                    mutations[barcode],
+                    actor,
+                    create={"barcode": barcode, "company_id": company_id} if collecting else None
+                )
+                results[barcode] = _result(barcode, outcomes, created=created)
+            except Exception as e:
+                results[barcode] = {"barcode": barcode, "status": "error", "error": str(e)}
+
+        all_results = invalid + list(results.values())
+        failed = sum(1 for r in all_results if r["status"] in ("error", "conflict"))
+        return Response({
+            "results": all_results,
+            "succeeded": len(all_results) - failed,
+            "failed": failed
+        })
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=500)
+
 
 from datetime import datetime, timedelta
 
+PENDING_TRANSFER_SORT = [("lastmodified_date", 1), ("_id", 1)]
+
+
 @api_view(['GET'])
 def get_transferred_samples(request):
-    """Get transferred samples for batch generation"""
+    """
+    Get transferred samples for batch generation.
+    Served from the indexed pending_transfer flag; optional date, company_id,
+    employee_id, and limit + cursor for pages.
+    """
     employee_id = request.GET.get('employee_id')
     date_param = request.GET.get('date')
+    company_id = request.GET.get('company_id')
 
     try:
-        samples = Sample.objects.all()
+        limit = get_limit(request)
+        cursor = get_cursor(request, PENDING_TRANSFER_SORT)
+
+        ensure_pending_transfer_flags()
+        query = {'pending_transfer': True}
+        if company_id:
+            query['company_id'] = company_id
 
         # Optional date filtering
         if date_param:
             try:
                 filter_date = datetime.strptime(date_param, '%Y-%m-%d')
-                start_of_day = datetime.combine(filter_date, datetime.min.time())
-                end_of_day = datetime.combine(filter_date, datetime.max.time())
-
-                samples = samples.filter(
-                    lastmodified_date__gte=start_of_day,
-                    lastmodified_date__lte=end_of_day
-                )
             except ValueError:
                 return Response({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
+            query['lastmodified_date'] = {
+                '$gte': timezone.make_aware(datetime.combine(filter_date, datetime.min.time())),
+                '$lte': timezone.make_aware(datetime.combine(filter_date, datetime.max.time()))
+            }
+        # employee_id lives on Billing: narrow to its barcodes before the page limit applies
+        if employee_id:
+            billing_query = {'employee_id': {'$regex': re.escape(employee_id), '$options': 'i'}}
+            if company_id:
+                billing_query['company_id'] = company_id
+            query['barcode'] = {'$in': get_collection("core_billing").distinct('barcode', billing_query)}
+        if cursor:
+            query = {'$and': [query, keyset_filter(PENDING_TRANSFER_SORT, cursor)]}
+
+        docs = get_collection("core_sample").find(
+            query, {'barcode': 1, 'testdetails': 1, 'lastmodified_date': 1, 'lastmodified_by': 1}
+        ).sort(PENDING_TRANSFER_SORT)
+        if limit:
+            docs = docs.limit(limit)
+        samples = list(docs)
+        next_cursor = cursor_for(samples[-1], PENDING_TRANSFER_SORT) if limit and len(samples) == limit else None
+
+        # --- employee_id from billing, newest billing per barcode, one query ---
+        billed_employee_ids = {}
+        if samples:
+            billings = get_collection("core_billing").find(
+                {'barcode': {'$in': [s['barcode'] for s in samples]}},
+                {'_id': 0, 'barcode': 1, 'employee_id': 1}
+            ).sort('date', -1)
+            for billing in billings:
+                billed_employee_ids.setdefault(billing.get('barcode'), billing.get('employee_id'))
 
-        # Filter samples that have transferred tests and format response
         transferred_samples = []
         for sample in samples:
-            if sample.testdetails:
-                try:
-                    if isinstance(sample.testdetails, str):
-                        tests = json.loads(sample.testdetails)
-                    else:
-                        tests = sample.testdetails or []
-                except:
-                    tests = []
-
-                # Check if any test is transferred and not batched
-                has_transferred_tests = False
-                for test in tests:
-                    if (
-                        isinstance(test, dict) and 
-                        test.get('test_id') and 
-                        test.get('samplestatus') == 'Transferred' and
-                        not test.get('batch_number')
-                    ):
-                        has_transferred_tests = True
-                        break
-                
-                if has_transferred_tests:
-                    # Get employee_id from billing
-                    try:
-                        billing = Billing.objects.get(barcode=sample.barcode)
-                        sample_employee_id = billing.employee_id
-                        
-                        # Filter by employee_id if provided
-                        if employee_id and employee_id.lower() not in sample_employee_id.lower():
-                            continue
-                            
-                        transferred_samples.append({
-                            'employee_id': sample_employee_id,
-                            'barcode': sample.barcode,
-                            'testdetails': tests,
-                            'transferred_date': sample.lastmodified_date,
-                            'transferred_by': sample.lastmodified_by
-                        })
-                    except Billing.DoesNotExist:
-                        continue
+            sample_employee_id = billed_employee_ids.get(sample['barcode'])
+            if not sample_employee_id:
+                continue
+            # Filter by employee_id if provided
+            if employee_id and employee_id.lower() not in sample_employee_id.lower():
+                continue
+            try:
+                tests = parse_testdetails(sample.get('testdetails'))
+            except ValueError:
+                tests = []
+            # The flag can lag a write made outside the guarded helpers
+            if not any(is_pending_transfer(t) for t in tests):
+                continue
+
+            transferred_samples.append({
+                'employee_id': sample_employee_id,
+                'barcode': sample['barcode'],
+                'testdetails': tests,
+                'transferred_date': sample.get('lastmodified_date'),
+                'transferred_by': sample.get('lastmodified_by')
+            })
 
-        return Response({'transferred_samples': transferred_samples})
+        response = Response({'transferred_samples': transferred_samples, 'next_cursor': next_cursor})
+        return set_next_cursor(response, next_cursor)
 
+    except PaginationError as e:
+        return Response({'error': str(e)}, status=400)
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
@@ -529,60 +641,68 @@ from ..serializers import BatchSerializer
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from pymongo import MongoClient
 from collections import Counter
 import json
 import os
 import re
 from ..models import Batch
 from ..serializers import BatchSerializer
-from django.db.models import Max
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from ..batch_numbers import BatchNumberError, is_reserved, next_batch_number, reserve_batch_numbers
+
+
+def _stamp_batch_number(tests, batch_number):
+    """Put Transferred tests that are not yet in a batch into this one; True if any were."""
+    stamped = False
+    for test in tests:
+        if isinstance(test, dict) and test.get("samplestatus") == "Transferred" \
+                and test.get("batch_number") in [None, '', 'null']:
+            test["batch_number"] = batch_number
+            stamped = True
+    return stamped
+
+
+def _restamp_lost_updates(sample_collection, stamped_samples, batch_number, actor):
+    """Redo, on fresh data, the batch stamps whose sample changed after it was read."""
+    current = {
+        doc["_id"]: doc.get("testdetails")
+        for doc in sample_collection.find({"_id": {"$in": list(stamped_samples)}}, {"testdetails": 1})
+    }
+    for sample_id, new_raw in stamped_samples.items():
+        if current.get(sample_id) != new_raw:
+            update_testdetails(
+                sample_collection, {"_id": sample_id},
+                lambda tests: _stamp_batch_number(tests, batch_number), actor
+            )
+
+
+BATCH_LIST_SORT = [("created_date", -1), ("_id", -1)]
+BATCH_LIST_FIELDS = ["id"] + [f.attname for f in Batch._meta.concrete_fields if f.attname != "id"]
+
 
 @api_view(['GET', 'POST'])
 def batch_management(request):
     if request.method == 'GET':
+        # Optional: company_id, date_from/date_to (created date), fields=a,b, limit + cursor
         try:
-            batches = Batch.objects.all().order_by('-created_date')
-            serializer = BatchSerializer(batches, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            fields = get_fields(request, BATCH_LIST_FIELDS)
+            return paged_list(
+                request, "core_batch", fields,
+                lambda docs: BatchSerializer([Batch(**model_values(doc, Batch)) for doc in docs], many=True).data,
+                query=list_query(request, "created_date"), sort=BATCH_LIST_SORT
+            )
+        except PaginationError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     elif request.method == 'POST':
         try:
-            # --- MongoDB connections ---
-            mongo_url = os.getenv("GLOBAL_DB_HOST")
-            client = MongoClient(mongo_url)
-
-            sample_collection = client["Corporatehealthcheckup"]["core_sample"]
-            testdetails_collection = client["Diagnostics"]["core_testdetails"]
-
-            # --- Generate next batch number ---
-            max_batch = Batch.objects.exclude(batch_number=None).aggregate(
-                max_number=Max('batch_number')
-            )['max_number']
-
-            if max_batch and max_batch.isdigit():
-                next_number = str(int(max_batch) + 1).zfill(5)
-            else:
-                next_number = "00001"
-
-            # Check again in case of race condition
-            if Batch.objects.filter(batch_number=next_number).exists():
-                return Response(
-                    {"batch_number": [f"Batch number {next_number} already exists."]},
-                    status=status.HTTP_400_BAD_REQUEST
-    )
-
-            # --- Validate batch_number uniqueness ---
-            if Batch.objects.filter(batch_number=next_number).exists():
-                return Response(
-                    {"batch_number": [f"Batch number {next_number} already exists."]},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+            sample_collection = get_collection("core_sample")
 
             data = dict(request.data)
-            data['batch_number'] = next_number
+            company_id = request.data.get("company_id") or "CHC001"
 
             # --- Parse and deduplicate batch_details ---
             raw_batch_details = request.data.get("batch_details", [])
@@ -605,51 +725,62 @@ def batch_management(request):
                         unique_batch_list.append({"barcode": barcode})
             data["batch_details"] = unique_batch_list
 
-            # --- Collect specimen types ---
+            # --- Batch number: a reserved one from an offline site, or the next in sequence ---
+            requested_number = request.data.get("batch_number")
+            if requested_number:
+                next_number = str(requested_number).strip()
+                if not is_reserved(next_number, company_id):
+                    return Response(
+                        {"batch_number": [f"Batch number {next_number} was not reserved."]},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                if Batch.objects.filter(batch_number=next_number).exists():
+                    return Response(
+                        {"batch_number": [f"Batch number {next_number} already exists."]},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+            else:
+                next_number = next_batch_number(company_id)
+            data['batch_number'] = next_number
+
+            # --- Single pass over the batch's samples: count specimens and stamp batch_number ---
             specimen_counter = Counter()
             batch_barcodes = [item["barcode"] for item in unique_batch_list]
+            sample_updates = []
+            stamped_samples = {}
 
-            sample_records = sample_collection.find({"barcode": {"$in": batch_barcodes}})
+            sample_records = sample_collection.find(
+                {"barcode": {"$in": batch_barcodes}},
+                {"barcode": 1, "testdetails": 1}
+            )
 
             for record in sample_records:
-                testdetails_raw = record.get("testdetails")
-                if not testdetails_raw:
-                    continue
-
-                testdetails = []
                 try:
-                    if isinstance(testdetails_raw, list):
-                        testdetails = testdetails_raw
-                    elif isinstance(testdetails_raw, str):
-                        try:
-                            testdetails = json.loads(testdetails_raw)
-                        except json.JSONDecodeError:
-                            # Fix unquoted keys
-                            fixed_json = re.sub(
-                                r'([{,])(\s*)([a-zA-Z_][a-zA-Z0-9_]*)\s*:',
-                                r'\1"\3":',
-                                testdetails_raw
-                            )
-                            testdetails = json.loads(fixed_json)
-                    elif isinstance(testdetails_raw, dict):
-                        testdetails = [testdetails_raw]
+                    testdetails = parse_testdetails(record.get("testdetails"))
                 except Exception as e:
                     print(f"Error parsing testdetails for barcode {record.get('barcode')}: {str(e)}")
                     continue
 
                 for test in testdetails:
-                    if isinstance(test, dict):
-                        test_id = test.get("test_id")
-                        if test_id:
-                            core_test = testdetails_collection.find_one({"test_id": test_id})
-                            if core_test and core_test.get("specimen_type"):
-                                specimen_counter[core_test["specimen_type"]] += 1
-                        else:
-                            testname = test.get("testname")
-                            if testname:
-                                core_test = testdetails_collection.find_one({"test_name": testname})
-                                if core_test and core_test.get("specimen_type"):
-                                    specimen_counter[core_test["specimen_type"]] += 1
+                    if not isinstance(test, dict):
+                        continue
+                    test_id = test.get("test_id")
+                    if test_id:
+                        specimen_type = test_catalog.specimen_type(test_id=test_id)
+                    else:
+                        specimen_type = test_catalog.specimen_type(test_name=test.get("testname"))
+                    if specimen_type:
+                        specimen_counter[specimen_type] += 1
+
+                # Transferred tests not yet in a batch join this one
+                if _stamp_batch_number(testdetails, next_number):
+                    # Guarded on the text read, so a concurrent status change is not overwritten
+                    new_raw = dump_testdetails(testdetails)
+                    sample_updates.append(UpdateOne(
+                        {"_id": record["_id"], "testdetails": record.get("testdetails")},
+                        {"$set": testdetails_fields(testdetails)}
+                    ))
+                    stamped_samples[record["_id"]] = new_raw
 
             data["specimen_count"] = [
                 {"specimen_type": stype, "count": count}
@@ -663,35 +794,12 @@ def batch_management(request):
                 print(f"Batch {next_number} created successfully with {len(unique_batch_list)} samples")
                 print(f"Specimen count breakdown: {data['specimen_count']}")
 
-                # --- Update batch_number in core_sample for Transferred tests ---
-                for item in unique_batch_list:
-                    barcode = item.get("barcode")
-                    if not barcode:
-                        continue
-
-                    sample_doc = sample_collection.find_one({"barcode": barcode})
-                    if sample_doc:
-                        testdetails_raw = sample_doc.get("testdetails")
-                        try:
-                            testdetails = json.loads(testdetails_raw) if isinstance(testdetails_raw, str) else testdetails_raw
-                        except Exception:
-                            continue
-
-                        updated = False
-                        for test in testdetails:
-                            if (
-                                isinstance(test, dict) and
-                                test.get("samplestatus") == "Transferred" and
-                                test.get("batch_number") in [None, '', 'null']
-                            ):
-                                test["batch_number"] = next_number
-                                updated = True
-
-                        if updated:
-                            sample_collection.update_one(
-                                {"_id": sample_doc["_id"]},
-                                {"$set": {"testdetails": json.dumps(testdetails, ensure_ascii=False)}}
-                            )
+                # --- Update batch_number in core_sample for Transferred tests, in one round trip ---
+                if sample_updates:
+                    matched = sample_collection.bulk_write(sample_updates, ordered=True).matched_count
+                    if matched < len(sample_updates):
+                        _restamp_lost_updates(sample_collection, stamped_samples, next_number,
+                                              request.data.get("created_by") or "system")
 
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             else:
@@ -702,3 +810,25 @@ def batch_management(request):
             traceback.print_exc()
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+
+
+@api_view(['POST'])
+def reserve_batch_number_block(request):
+    """Reserve a contiguous block of batch numbers for a site that works offline."""
+    try:
+        count = int(request.data.get("count", 1))
+    except (TypeError, ValueError):
+        return Response({"error": "count must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        reservation = reserve_batch_numbers(
+            count,
+            company_id=request.data.get("company_id") or "CHC001",
+            site=request.data.get("site"),
+            reserved_by=request.data.get("reserved_by")
+        )
+        return Response(reservation, status=status.HTTP_201_CREATED)
+    except BatchNumberError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -5,10 +5,8 @@ from rest_framework import viewsets, status
 from django.views.decorators.csrf import csrf_exempt
 from ..serializers import RegisterSerializer
 from urllib.parse import quote_plus
-from pymongo import MongoClient
-import certifi
+from ..mongo import get_db
 from ..models import Register
-import os
 #auth
 
 from rest_framework.decorators import api_view, permission_classes
@@ -46,8 +44,7 @@ def registration(request):
 
         try:
             password = quote_plus('Smrft@2024')
-            client = MongoClient(os.getenv('GLOBAL_DB_HOST'))
-            db = client.Lab
+            db = get_db("Lab")
             collection = db['labbackend_register']
             
             # Find the user
@@ -76,9 +73,6 @@ def registration(request):
 
         except Exception as e:
             return Response({"error": f"Database error: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        finally:
-            if 'client' in locals():
-                client.close()
 
     elif request.method == 'GET':
         # Handle fetching users with the role "Sales Person"
@@ -0,0 +1,191 @@
+import json
+
+from bson.decimal128 import Decimal128
+
+INVESTIGATION_COLLECTION = "core_investigation"
+EMPLOYEE_COLLECTION = "core_employeeregistration"
+
+# (upper bound exclusive, label); ages at or above the last bound are "60+"
+AGE_GROUPS = [(30, "<30"), (40, "30-39"), (50, "40-49"), (60, "50-59")]
+OLDEST_AGE_GROUP = "60+"
+HEALTH_BUCKETS = ("normal", "risk", "high_risk")
+
+
+def age_group(age):
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return "Unknown"
+    for bound, label in AGE_GROUPS:
+        if age < bound:
+            return label
+    return OLDEST_AGE_GROUP
+
+
+def _vital(vitals, key):
+    try:
+        return float(vitals.get(key) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def health_bucket(vitals, status):
+    """
+    BMI bucket for one investigation, or None when height is missing.
+    BMI < 25 only counts as normal once the investigation is approved;
+    until then it is reported as risk.
+    """
+    if isinstance(vitals, str):
+        try:
+            vitals = json.loads(vitals)
+        except ValueError:
+            vitals = {}
+    if not isinstance(vitals, dict):
+        return None
+    weight = _vital(vitals, "weight_kg")
+    height = _vital(vitals, "height_cm")
+    if height <= 0:
+        return None
+    bmi = weight / ((height / 100) ** 2)
+    if bmi < 25 and status == "approved":
+        return "normal"
+    if bmi < 30:
+        return "risk"
+    return "high_risk"
+
+
+def _vital_expr(key):
+    """
+    Numeric vitals.<key> whether vitals is stored as a document or as JSON
+    text (the ORM's JSONField writes text); missing or bad values become 0.
+    """
+    captures = {"$let": {
+        "vars": {"m": {"$regexFind": {
+            "input": "$vitals",
+            "regex": f'"{key}"\\s*:\\s*"?\\s*(-?[0-9]+(?:\\.[0-9]+)?)',
+        }}},
+        "in": "$$m.captures",
+    }}
+    from_text = {"$arrayElemAt": [{"$ifNull": [captures, []]}, 0]}
+    raw = {"$cond": [{"$eq": [{"$type": "$vitals"}, "string"]}, from_text, f"$vitals.{key}"]}
+    return {"$convert": {"input": raw, "to": "double", "onError": 0, "onNull": 0}}
+
+
+def _first_present(*fields, default=None):
+    """First of `fields` that is neither missing, null nor "" (the rollups' fallback rule)."""
+    expr = default
+    for field in reversed(fields):
+        expr = {"$cond": [{"$in": [{"$ifNull": [field, ""]}, [""]]}, expr, field]}
+    return expr
+
+
+def _age_group_expr(field):
+    # int() semantics, as age_group(): numbers truncate, non-integer text is Unknown
+    age = {"$convert": {"input": field, "to": "long", "onError": None, "onNull": None}}
+    return {"$let": {"vars": {"age": age}, "in": {"$switch": {
+        "branches": [
+            {"case": {"$eq": ["$$age", None]}, "then": "Unknown"},
+            *({"case": {"$lt": ["$$age", bound]}, "then": label} for bound, label in AGE_GROUPS),
+        ],
+        "default": OLDEST_AGE_GROUP,
+    }}}}
+
+
+def _count_by(field):
+    return [{"$group": {"_id": field, "count": {"$sum": 1}}}]
+
+
+def dashboard_pipeline(match):
+    """
+    One pass over the matching investigations, joined to their employee,
+    producing totals and the gender/department/age-group/health breakdowns.
+    """
+    return [
+        {"$match": match},
+        {"$lookup": {
+            "from": EMPLOYEE_COLLECTION,
+            "localField": "employee_id",
+            "foreignField": "employee_id",
+            "as": "employee",
+        }},
+        {"$project": {
+            "status": 1,
+            "gender": _first_present("$gender", {"$arrayElemAt": ["$employee.gender", 0]}, default="Unknown"),
+            "age": _first_present("$age", {"$arrayElemAt": ["$employee.age", 0]}),
+            "department": _first_present({"$arrayElemAt": ["$employee.department", 0]}, default="Unknown"),
+            "weight": _vital_expr("weight_kg"),
+            "height": _vital_expr("height_cm"),
+        }},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "by_gender": _count_by("$gender"),
+            "by_department": _count_by("$department"),
+            "by_age_group": _count_by(_age_group_expr("$age")),
+            "health_status": [
+                {"$match": {"height": {"$gt": 0}}},
+                {"$project": {"bucket": {"$let": {
+                    "vars": {"bmi": {"$divide": ["$weight", {"$pow": [{"$divide": ["$height", 100]}, 2]}]}},
+                    "in": {"$switch": {
+                        "branches": [
+                            {"case": {"$and": [{"$lt": ["$$bmi", 25]}, {"$eq": ["$status", "approved"]}]},
+                             "then": "normal"},
+                            {"case": {"$lt": ["$$bmi", 30]}, "then": "risk"},
+                        ],
+                        "default": "high_risk",
+                    }},
+                }}}},
+                *_count_by("$bucket"),
+            ],
+        }},
+    ]
+
+
+def facet_counts(rows):
+    return {str(row["_id"]): row["count"] for row in rows}
+
+
+BILLING_COLLECTION = "core_billing"
+# ?group_by= names -> billing fields
+REVENUE_GROUPS = {"company": "$company_id", "package": "$package_id", "paymentMode": "$paymentMode"}
+REVENUE_PERIODS = {"day": "%Y-%m-%d", "month": "%Y-%m"}
+
+
+def _amount_expr(field):
+    """
+    Decimal amount; Decimal128 values pass straight through, and legacy
+    string amounts not yet converted by convert_amounts_to_decimal count too.
+    """
+    value = {"$cond": [{"$eq": [{"$type": field}, "string"]}, {"$trim": {"input": field}}, field]}
+    zero = Decimal128("0")
+    return {"$convert": {"input": value, "to": "decimal", "onError": zero, "onNull": zero}}
+
+
+def _revenue_totals(key):
+    return [
+        {"$group": {"_id": key, "billed_amount": {"$sum": "$amount"}, "billings": {"$sum": 1}}},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def revenue_pipeline(match, period, group_by, time_zone):
+    """
+    Billed amount per local day/month and the chosen group_by keys, plus
+    per-paymentMode and overall totals, summed server-side with $group.
+    """
+    key = {"period": {"$dateToString": {"format": REVENUE_PERIODS[period], "date": "$date", "timezone": time_zone}}}
+    key.update({name: REVENUE_GROUPS[name] for name in group_by})
+    return [
+        {"$match": match},
+        {"$project": {
+            "date": 1,
+            "company_id": 1,
+            "package_id": {"$ifNull": ["$package_id", None]},
+            "paymentMode": {"$ifNull": ["$paymentMode", "Credit"]},
+            "amount": _amount_expr("$netAmount"),
+        }},
+        {"$facet": {
+            "rows": _revenue_totals(key),
+            "by_payment_mode": _revenue_totals("$paymentMode"),
+            "total": _revenue_totals(None),
+        }},
+    ]
@@ -1,6 +1,17 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Warm the test catalog when serving requests, not for one-off manage.py commands
+        command = sys.argv[1] if len(sys.argv) > 1 else ""
+        is_manage = os.path.basename(sys.argv[0]) == "manage.py"
+        if os.getenv("TEST_CATALOG_WARM_ON_START", "1") == "1" and (not is_manage or command == "runserver"):
+            from .test_catalog import test_catalog
+            test_catalog.warm()
@@ -0,0 +1,306 @@
+import logging
+import os
+
+from bson.binary import Binary
+from django.utils import timezone
+from pymongo.errors import DuplicateKeyError
+
+from .barcode_index import barcode_range_index
+from .mongo import get_collection
+
+logger = logging.getLogger(__name__)
+
+ALLOCATION_COLLECTION = "core_barcodeallocation"
+BILLING_COLLECTION = "core_billing"
+
+# One bit per barcode; 64M bits is an 8 MB bitmap, well under the 16 MB document limit
+MAX_RANGE_SIZE = int(os.getenv("BARCODE_MAX_RANGE_SIZE", 64_000_000))
+MAX_CAS_RETRIES = 20
+
+# Maps every fully-used byte to 0 and every byte with a free bit to 1, so
+# bytes.find() can jump straight to the first byte with room in C.
+_HAS_FREE_BIT = bytes(0 if b == 0xFF else 1 for b in range(256))
+
+
+class BarcodeAllocationError(Exception):
+    pass
+
+
+def _allocations():
+    return get_collection(ALLOCATION_COLLECTION)
+
+
+def _format(value, width):
+    return str(value).zfill(width)
+
+
+def _range_bounds(range_doc):
+    start = int(range_doc["startbarcode"])
+    end = int(range_doc["endbarcode"])
+    return start, end
+
+
+def _billed_barcodes(range_doc):
+    """Barcodes already billed inside a range, used to seed a new bitmap."""
+    start, end = _range_bounds(range_doc)
+    start_str, end_str = range_doc["startbarcode"], range_doc["endbarcode"]
+    query = {}
+    if len(start_str) == len(end_str):
+        # Same-width ranges sort lexicographically, so the string bounds are exact
+        query = {"barcode": {"$gte": start_str, "$lte": end_str}}
+    used = set()
+    for barcode in get_collection(BILLING_COLLECTION).distinct("barcode", query):
+        barcode = str(barcode).strip()
+        if barcode.isdigit() and start <= int(barcode) <= end:
+            used.add(int(barcode) - start)
+    return used
+
+
+def _build_doc(range_doc):
+    layout = _layout(range_doc)
+    bitmap = bytearray((layout["size"] + 7) // 8)
+    used = _billed_barcodes(range_doc)
+    for offset in used:
+        bitmap[offset >> 3] |= 1 << (offset & 7)
+    return dict(
+        layout,
+        _id=range_doc["range_id"],
+        bitmap=Binary(bytes(bitmap)),
+        used_count=len(used),
+        version=0,
+        created_date=timezone.now(),
+        lastmodified_date=timezone.now(),
+    )
+
+
+def _layout(range_doc):
+    start, end = _range_bounds(range_doc)
+    size = end - start + 1
+    if size > MAX_RANGE_SIZE:
+        raise BarcodeAllocationError(f"Barcode range {range_doc['range_id']} is too large to track ({size} barcodes).")
+    return {
+        "startbarcode": range_doc["startbarcode"],
+        "endbarcode": range_doc["endbarcode"],
+        "start": start,
+        "size": size,
+        "width": len(range_doc["startbarcode"]),
+    }
+
+
+def _matches(doc, layout):
+    return all(doc.get(field) == value for field, value in layout.items())
+
+
+def _relayout(doc, layout, range_doc):
+    """
+    CAS the stored bitmap onto a range that was edited in place: keep the
+    bits of barcodes still inside it, drop the rest, and mark billed
+    barcodes in any newly added part as used. False if another writer won.
+    """
+    # Bit n of byte k is offset 8k+n, i.e. a little-endian integer
+    bits = int.from_bytes(bytes(doc["bitmap"]), "little") & ((1 << doc["size"]) - 1)
+    shift = doc["start"] - layout["start"]
+    bits = bits << shift if shift >= 0 else bits >> -shift
+    bits &= (1 << layout["size"]) - 1
+    for offset in _billed_barcodes(range_doc):
+        bits |= 1 << offset
+    update = dict(
+        layout,
+        bitmap=Binary(bits.to_bytes((layout["size"] + 7) // 8, "little")),
+        used_count=bin(bits).count("1"),
+        lastmodified_date=timezone.now(),
+    )
+    result = _allocations().update_one(
+        {"_id": doc["_id"], "version": doc["version"]}, {"$set": update, "$inc": {"version": 1}}
+    )
+    return result.modified_count == 1
+
+
+def _load(range_doc):
+    """
+    Fetch the bitmap document for a range, seeding it from Billing on first
+    use and re-laying it out when the range's bounds have changed since.
+    """
+    layout = _layout(range_doc)
+    for _ in range(MAX_CAS_RETRIES):
+        doc = _allocations().find_one({"_id": range_doc["range_id"]})
+        if doc is None:
+            doc = _build_doc(range_doc)
+            try:
+                _allocations().insert_one(doc)
+            except DuplicateKeyError:
+                continue  # another worker seeded it first
+            return doc
+        if _matches(doc, layout):
+            return doc
+        _relayout(doc, layout, range_doc)
+    raise BarcodeAllocationError(f"Could not load barcode range {range_doc['range_id']} due to concurrent updates; retry.")
+
+
+def _save(doc, bitmap, used_delta, actor=None):
+    """Compare-and-swap the bitmap on its version; False means another writer won."""
+    update = {
+        "$set": {"bitmap": Binary(bytes(bitmap)), "lastmodified_date": timezone.now()},
+        "$inc": {"used_count": used_delta, "version": 1},
+    }
+    if actor:
+        update["$set"]["lastmodified_by"] = actor
+    result = _allocations().update_one({"_id": doc["_id"], "version": doc["version"]}, update)
+    return result.modified_count == 1
+
+
+def _is_set(bitmap, offset):
+    return bool(bitmap[offset >> 3] & (1 << (offset & 7)))
+
+
+def _free_offsets(bitmap, size, count):
+    """First `count` free offsets in the bitmap."""
+    found = []
+    flags = bytes(bitmap).translate(_HAS_FREE_BIT)
+    pos = flags.find(b"\x01")
+    while pos != -1 and len(found) < count:
+        byte = bitmap[pos]
+        for bit in range(8):
+            offset = (pos << 3) + bit
+            if offset >= size or len(found) == count:
+                break
+            if not byte & (1 << bit):
+                found.append(offset)
+        pos = flags.find(b"\x01", pos + 1)
+    return found
+
+
+def _allocate_in_range(range_doc, count, actor=None):
+    for _ in range(MAX_CAS_RETRIES):
+        doc = _load(range_doc)
+        if doc["used_count"] >= doc["size"]:
+            return []
+        bitmap = bytearray(doc["bitmap"])
+        offsets = _free_offsets(bitmap, doc["size"], count)
+        if not offsets:
+            return []
+        for offset in offsets:
+            bitmap[offset >> 3] |= 1 << (offset & 7)
+        if _save(doc, bitmap, len(offsets), actor):
+            return [_format(doc["start"] + offset, doc["width"]) for offset in offsets]
+    raise BarcodeAllocationError(f"Could not reserve barcodes in range {range_doc['range_id']} due to concurrent updates; retry.")
+
+
+def _update_bits(barcodes, set_bits, actor=None):
+    """Set or clear bits for specific barcodes. Returns {barcode: changed}."""
+    by_range = {}
+    outcome = {}
+    for barcode in barcodes:
+        range_doc = barcode_range_index.find_range(barcode)
+        if range_doc is None:
+            outcome[barcode] = None
+            continue
+        by_range.setdefault(range_doc["range_id"], (range_doc, []))[1].append(barcode)
+
+    for range_doc, members in by_range.values():
+        for _ in range(MAX_CAS_RETRIES):
+            doc = _load(range_doc)
+            bitmap = bytearray(doc["bitmap"])
+            changed = {}
+            delta = 0
+            for barcode in members:
+                offset = int(barcode) - doc["start"]
+                if not 0 <= offset < doc["size"]:
+                    raise BarcodeAllocationError(f"Barcode {barcode} is outside range {range_doc['range_id']}.")
+                if _is_set(bitmap, offset) == set_bits:
+                    changed[barcode] = False
+                    continue
+                if set_bits:
+                    bitmap[offset >> 3] |= 1 << (offset & 7)
+                    delta += 1
+                else:
+                    bitmap[offset >> 3] &= ~(1 << (offset & 7))
+                    delta -= 1
+                changed[barcode] = True
+            if delta == 0 or _save(doc, bitmap, delta, actor):
+                outcome.update(changed)
+                break
+        else:
+            raise BarcodeAllocationError(f"Could not update barcodes in range {range_doc['range_id']} due to concurrent updates; retry.")
+    return outcome
+
+
+def allocate(count=1, range_id=None, actor=None):
+    """
+    Reserve the next `count` unused barcodes, filling ranges in barcode order.
+    Raises BarcodeAllocationError if the ranges cannot supply them all.
+    """
+    if count < 1:
+        raise BarcodeAllocationError("count must be at least 1.")
+    ranges = barcode_range_index.ranges()
+    if range_id:
+        ranges = [r for r in ranges if r["range_id"] == range_id]
+        if not ranges:
+            raise BarcodeAllocationError(f"Barcode range {range_id} not found.")
+
+    allocated = []
+    try:
+        for range_doc in ranges:
+            allocated.extend(_allocate_in_range(range_doc, count - len(allocated), actor))
+            if len(allocated) == count:
+                return allocated
+    except BarcodeAllocationError:
+        if allocated:
+            release(allocated, actor)
+        raise
+
+    if allocated:
+        release(allocated, actor)
+    raise BarcodeAllocationError(f"Only {len(allocated)} free barcodes available, {count} requested.")
+
+
+def reserve(barcodes, actor=None):
+    """
+    Mark specific barcodes as used. Returns {barcode: True} when newly reserved,
+    False when already used, and None when the barcode is outside every range.
+    """
+    return _update_bits([str(b) for b in barcodes], True, actor)
+
+
+def release(barcodes, actor=None):
+    """Return barcodes to the free pool (e.g. when a billing is rolled back)."""
+    return _update_bits([str(b) for b in barcodes], False, actor)
+
+
+def resync(range_doc, actor=None):
+    """
+    Mark every billed barcode in a range as used, under the version CAS.
+    Only ever sets bits, so allocated-but-unbilled barcodes and reservations
+    made during the scan are kept. Also repairs used_count. Returns it.
+    """
+    billed = _billed_barcodes(range_doc)  # offsets from the range start, which _load keeps in step
+    for _ in range(MAX_CAS_RETRIES):
+        doc = _load(range_doc)
+        bitmap = bytearray(doc["bitmap"])
+        for offset in billed:
+            bitmap[offset >> 3] |= 1 << (offset & 7)
+        used = sum(bin(byte).count("1") for byte in bytes(bitmap))
+        if bytes(bitmap) == bytes(doc["bitmap"]) and used == doc["used_count"]:
+            return used
+        if _save(doc, bitmap, used - doc["used_count"], actor):
+            return used
+    raise BarcodeAllocationError(f"Could not resync range {range_doc['range_id']} due to concurrent updates; retry.")
+
+
+def utilisation():
+    """Per-range usage for every configured barcode range."""
+    report = []
+    for range_doc in barcode_range_index.ranges():
+        doc = _load(range_doc)
+        used = doc["used_count"]
+        size = doc["size"]
+        report.append({
+            "range_id": range_doc["range_id"],
+            "startbarcode": range_doc["startbarcode"],
+            "endbarcode": range_doc["endbarcode"],
+            "size": size,
+            "used": used,
+            "free": size - used,
+            "utilisation_pct": round(used * 100 / size, 2) if size else 0.0,
+        })
+    return report
@@ -0,0 +1,125 @@
+import bisect
+import logging
+import os
+import threading
+import time
+
+from .mongo import get_collection
+
+logger = logging.getLogger(__name__)
+
+BARCODERANGE_COLLECTION = "core_barcoderange"
+
+# Ranges change rarely, so a worker reloads them at most once per TTL.  A miss
+# forces an earlier reload (throttled) so a freshly added range is usable
+# without waiting for the TTL to expire.
+BARCODE_INDEX_TTL = int(os.getenv("BARCODE_INDEX_TTL", 60))
+BARCODE_INDEX_MISS_REFRESH = int(os.getenv("BARCODE_INDEX_MISS_REFRESH", 5))
+
+
+def _to_int(value):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+class BarcodeRangeIndex:
+    """
+    Sorted in-process index of the (startbarcode, endbarcode) ranges in
+    core_barcoderange. Lookups are a bisect over the range starts instead of a
+    $expr/$toInt collection scan per barcode.
+    """
+
+    def __init__(self, collection_getter, ttl=BARCODE_INDEX_TTL, miss_refresh=BARCODE_INDEX_MISS_REFRESH):
+        self._get_collection = collection_getter
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self._lock = threading.Lock()
+        self._ranges = []      # [(start, end, range_doc)] sorted by start
+        self._starts = []      # start of each range, for bisect
+        self._max_ends = []    # running max of end, to stop scanning overlaps early
+        self._loaded_at = None
+
+    def load(self):
+        """Reload all ranges from MongoDB and swap them in atomically."""
+        ranges = []
+        cursor = self._get_collection().find({}, {"startbarcode": 1, "endbarcode": 1})
+        for doc in cursor:
+            start = _to_int(doc.get("startbarcode"))
+            end = _to_int(doc.get("endbarcode"))
+            if start is None or end is None or start > end:
+                logger.warning(f"Skipping invalid barcode range {doc.get('_id')}: {doc.get('startbarcode')}-{doc.get('endbarcode')}")
+                continue
+            ranges.append((start, end, {
+                "range_id": str(doc["_id"]),
+                "startbarcode": str(doc.get("startbarcode")),
+                "endbarcode": str(doc.get("endbarcode")),
+            }))
+        ranges.sort(key=lambda r: (r[0], r[1]))
+
+        max_ends = []
+        running = None
+        for _, end, _ in ranges:
+            running = end if running is None else max(running, end)
+            max_ends.append(running)
+
+        with self._lock:
+            self._ranges = ranges
+            self._starts = [r[0] for r in ranges]
+            self._max_ends = max_ends
+            self._loaded_at = time.monotonic()
+        return len(ranges)
+
+    def invalidate(self):
+        """Force a reload on the next lookup (call after ranges are edited)."""
+        with self._lock:
+            self._loaded_at = None
+
+    def _age(self):
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def _ensure_loaded(self):
+        age = self._age()
+        if age is None or age > self.ttl:
+            self.load()
+
+    def _search(self, barcode_int):
+        with self._lock:
+            ranges, starts, max_ends = self._ranges, self._starts, self._max_ends
+        i = bisect.bisect_right(starts, barcode_int) - 1
+        # Walk left only while an earlier range could still reach this barcode
+        while i >= 0 and max_ends[i] >= barcode_int:
+            start, end, doc = ranges[i]
+            if start <= barcode_int <= end:
+                return doc
+            i -= 1
+        return None
+
+    def find_range(self, barcode):
+        """Return the range containing barcode (dict with range_id/start/end), or None."""
+        barcode_int = _to_int(barcode)
+        if barcode_int is None:
+            return None
+        self._ensure_loaded()
+        match = self._search(barcode_int)
+        if match is None:
+            age = self._age()
+            if age is None or age > self.miss_refresh:
+                self.load()
+                match = self._search(barcode_int)
+        return match
+
+    def contains(self, barcode):
+        return self.find_range(barcode) is not None
+
+    def ranges(self):
+        """Snapshot of all loaded ranges, sorted by start."""
+        self._ensure_loaded()
+        with self._lock:
+            return [doc for _, _, doc in self._ranges]
+
+
+barcode_range_index = BarcodeRangeIndex(lambda: get_collection(BARCODERANGE_COLLECTION))
@@ -0,0 +1,91 @@
+import os
+import re
+
+from django.utils import timezone
+
+from .mongo import get_collection
+from .sequences import next_values
+
+BATCH_COLLECTION = "core_batch"
+RESERVATION_COLLECTION = "core_batchreservation"
+
+BATCH_NUMBER_WIDTH = 5
+# Number batches per company ("CHC001-00001") instead of one global series
+BATCH_NUMBER_PER_COMPANY = os.getenv("BATCH_NUMBER_PER_COMPANY", "false").lower() in ("1", "true", "yes")
+MAX_RESERVATION_SIZE = int(os.getenv("BATCH_MAX_RESERVATION_SIZE", 1000))
+
+
+class BatchNumberError(Exception):
+    pass
+
+
+def _sequence_name(company_id):
+    return f"batch_number:{company_id}" if BATCH_NUMBER_PER_COMPANY else "batch_number"
+
+
+def _prefix(company_id):
+    return f"{company_id}-" if BATCH_NUMBER_PER_COMPANY else ""
+
+
+def format_batch_number(value, company_id=None):
+    return f"{_prefix(company_id)}{str(value).zfill(BATCH_NUMBER_WIDTH)}"
+
+
+def parse_batch_number(batch_number, company_id=None):
+    """Sequence value of a batch number in this company's series, or None."""
+    prefix = _prefix(company_id)
+    batch_number = str(batch_number or "").strip()
+    if not batch_number.startswith(prefix):
+        return None
+    digits = batch_number[len(prefix):]
+    return int(digits) if digits.isdigit() else None
+
+
+def _highest_existing(company_id):
+    """Seed for a new counter: the highest batch number already issued in the series."""
+    query = {"batch_number": {"$regex": f"^{re.escape(_prefix(company_id))}[0-9]+$"}}
+    highest = 0
+    for doc in get_collection(BATCH_COLLECTION).find(query, {"_id": 0, "batch_number": 1}):
+        value = parse_batch_number(doc["batch_number"], company_id)
+        if value is not None and value > highest:
+            highest = value
+    return highest
+
+
+def next_batch_number(company_id=None):
+    first, _ = next_values(_sequence_name(company_id), 1, seed=lambda: _highest_existing(company_id))
+    return format_batch_number(first, company_id)
+
+
+def reserve_batch_numbers(count, company_id=None, site=None, reserved_by=None):
+    """Take a contiguous block of numbers for a site that creates batches offline."""
+    if count < 1 or count > MAX_RESERVATION_SIZE:
+        raise BatchNumberError(f"count must be between 1 and {MAX_RESERVATION_SIZE}")
+    name = _sequence_name(company_id)
+    first, last = next_values(name, count, seed=lambda: _highest_existing(company_id))
+    reservation = {
+        "sequence": name,
+        "company_id": company_id,
+        "first": first,
+        "last": last,
+        "site": site,
+        "reserved_by": reserved_by,
+        "reserved_date": timezone.now(),
+    }
+    result = get_collection(RESERVATION_COLLECTION).insert_one(reservation)
+    reservation["_id"] = str(result.inserted_id)
+    reservation["first_batch_number"] = format_batch_number(first, company_id)
+    reservation["last_batch_number"] = format_batch_number(last, company_id)
+    return reservation
+
+
+def is_reserved(batch_number, company_id=None):
+    """True if the number falls inside a block handed out by reserve_batch_numbers()."""
+    value = parse_batch_number(batch_number, company_id)
+    if value is None:
+        return False
+    return get_collection(RESERVATION_COLLECTION).find_one({
+        "sequence": _sequence_name(company_id),
+        "first": {"$lte": value},
+        "last": {"$gte": value},
+    }, {"_id": 1}) is not None
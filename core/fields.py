@@ -0,0 +1,69 @@
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+from django.core import exceptions
+from django.db import models
+
+from .mongo import get_collection
+
+# Amount fields stored as Decimal128, by collection; legacy documents hold strings
+AMOUNT_FIELDS = {
+    "core_billing": "netAmount",
+    "core_package": "totalAmount",
+}
+
+
+class Decimal128Field(models.DecimalField):
+    """
+    DecimalField stored as BSON Decimal128 instead of the text the ORM
+    would write, so Mongo can $group/$sum it without per-row conversion.
+    """
+
+    def to_python(self, value):
+        if isinstance(value, Decimal128):
+            value = value.to_decimal()
+        return super().to_python(value)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or isinstance(value, Decimal):
+            return value
+        try:
+            return self.to_python(value)
+        except exceptions.ValidationError:
+            return value
+
+    def _to_decimal128(self, value):
+        value = self.to_python(value)
+        if value is None:
+            return None
+        return Decimal128(value.quantize(Decimal(1).scaleb(-self.decimal_places)))
+
+    def get_db_prep_save(self, value, connection):
+        return self._to_decimal128(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        return self._to_decimal128(value)
+
+
+def convert_stored_amounts():
+    """
+    One-off data migration: rewrite string/float amounts as Decimal128 in
+    place with an update pipeline. Returns {collection: (converted, left_as_is)};
+    values that are not numbers are left untouched and counted.
+    """
+    results = {}
+    for collection_name, field in AMOUNT_FIELDS.items():
+        collection = get_collection(collection_name)
+        legacy = {field: {"$type": ["string", "double", "int", "long"]}}
+        converted = {"$convert": {
+            "input": {"$cond": [{"$eq": [{"$type": f"${field}"}, "string"]}, {"$trim": {"input": f"${field}"}}, f"${field}"]},
+            "to": "decimal",
+            "onError": None,
+        }}
+        result = collection.update_many(legacy, [{"$set": {field: {"$let": {
+            "vars": {"amount": converted},
+            "in": {"$cond": [{"$eq": ["$$amount", None]}, f"${field}", {"$round": ["$$amount", 2]}]},
+        }}}}])
+        left = collection.count_documents(legacy)
+        results[collection_name] = (result.modified_count, left)
+    return results
@@ -0,0 +1,58 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from .mongo import get_db
+
+# Indexes the raw-pymongo query paths rely on, keyed by collection.
+# Applied by `manage.py ensure_mongo_indexes`; create_indexes is idempotent.
+MONGO_INDEXES = {
+    "core_employeeregistration": [
+        IndexModel([("employee_id", ASCENDING)], name="employee_id"),
+        IndexModel([("company_id", ASCENDING), ("created_date", ASCENDING)], name="company_id_created_date"),
+    ],
+    "core_billing": [
+        IndexModel([("employee_id", ASCENDING), ("date", DESCENDING)], name="employee_id_date"),
+        IndexModel([("company_id", ASCENDING), ("date", DESCENDING)], name="company_id_date"),
+        IndexModel([("barcode", ASCENDING), ("date", DESCENDING)], name="barcode_date"),
+        IndexModel([("company_id", ASCENDING), ("employee_id", ASCENDING), ("date", DESCENDING)], name="company_id_employee_id_date"),
+        IndexModel([("company_id", ASCENDING), ("barcode", ASCENDING), ("date", DESCENDING)], name="company_id_barcode_date"),
+    ],
+    "core_investigation": [
+        IndexModel([("date", DESCENDING), ("_id", DESCENDING)], name="date_id"),
+        IndexModel([("company_id", ASCENDING), ("date", DESCENDING)], name="company_id_date"),
+    ],
+    "fs.files": [
+        IndexModel([("metadata.barcode", ASCENDING), ("metadata.sha256", ASCENDING)], name="barcode_sha256"),
+    ],
+    "core_ophthalmology": [
+        IndexModel([("date", DESCENDING), ("_id", DESCENDING)], name="date_id"),
+    ],
+    "core_sample": [
+        # Only flagged samples are indexed, so the queue stays as small as today's pending work
+        IndexModel([("pending_transfer", ASCENDING), ("lastmodified_date", ASCENDING), ("_id", ASCENDING)],
+                   name="pending_transfer_lastmodified_date_id",
+                   partialFilterExpression={"pending_transfer": True}),
+        IndexModel([("company_id", ASCENDING), ("created_date", ASCENDING), ("_id", ASCENDING)], name="company_id_created_date_id"),
+        IndexModel([("company_id", ASCENDING), ("barcode", ASCENDING), ("created_date", DESCENDING)], name="company_id_barcode_created_date"),
+    ],
+    "core_dailyrollup": [
+        IndexModel([("company_id", ASCENDING), ("day", ASCENDING)], name="company_id_day"),
+        IndexModel([("day", ASCENDING)], name="day"),
+    ],
+    "core_batch": [
+        IndexModel([("created_date", DESCENDING), ("_id", DESCENDING)], name="created_date_id"),
+    ],
+    "core_batchreservation": [
+        IndexModel([("sequence", ASCENDING), ("first", ASCENDING)], name="sequence_first"),
+    ],
+}
+
+
+def ensure_indexes(collections=None):
+    """Create the registered indexes; returns {collection: [index names]}."""
+    db = get_db()
+    created = {}
+    for name, indexes in MONGO_INDEXES.items():
+        if collections and name not in collections:
+            continue
+        created[name] = db[name].create_indexes(indexes)
+    return created
@@ -0,0 +1,77 @@
+from .mongo import get_collection
+from .pagination import (
+    PaginationError, cursor_for, date_range_filter, get_cursor, get_limit, keyset_filter, set_next_cursor
+)
+from .streaming import stream_json_array
+
+# Natural insertion order, which is what the unpaginated endpoints returned
+INSERTION_ORDER = [("_id", 1)]
+STREAM_BATCH_SIZE = 1000
+
+
+def get_fields(request, allowed):
+    """Validated ?fields=a,b sparse fieldset, or the full `allowed` list."""
+    raw = request.GET.get("fields")
+    if not raw:
+        return list(allowed)
+    fields = [f.strip() for f in raw.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise PaginationError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def list_query(request, date_field=None, company_field="company_id"):
+    """Mongo filter for the shared ?company_id= and ?date_from=/?date_to= list filters."""
+    query = date_range_filter(request, date_field) if date_field else {}
+    company_id = request.GET.get("company_id")
+    if company_id and company_field:
+        query[company_field] = company_id
+    return query
+
+
+def _chunks(docs, size):
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def paged_list(request, collection_name, fields, render_page, query=None, sort=INSERTION_ORDER,
+               projection_fields=None):
+    """
+    Stream a keyset-paginated listing of `collection_name`.
+    `fields` are the output fields; `projection_fields` (default: `fields`)
+    are read from Mongo. `render_page(docs)` turns a list of raw documents
+    into output rows, so per-page joins stay one query per page. Without
+    ?limit= the whole result is streamed in bounded batches.
+    """
+    limit = get_limit(request)
+    cursor = get_cursor(request, sort)
+
+    query = dict(query or {})
+    if cursor:
+        query = {"$and": [query, keyset_filter(sort, cursor)]} if query else keyset_filter(sort, cursor)
+
+    projection = {f: 1 for f in (projection_fields or fields)}
+    projection.update({f: 1 for f, _ in sort})
+    if "_id" not in projection:
+        projection["_id"] = 0
+
+    docs = get_collection(collection_name).find(query, projection).sort(sort).batch_size(STREAM_BATCH_SIZE)
+
+    def _rows(pages):
+        for page in pages:
+            for row in render_page(page):
+                yield {f: row.get(f) for f in fields}
+
+    if not limit:
+        return stream_json_array(_rows(_chunks(docs, STREAM_BATCH_SIZE)))
+
+    page = list(docs.limit(limit))
+    next_cursor = cursor_for(page[-1], sort) if len(page) == limit else None
+    return set_next_cursor(stream_json_array(_rows([page])), next_cursor)
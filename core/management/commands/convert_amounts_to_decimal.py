@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.fields import convert_stored_amounts
+from core.package_catalog import packages_changed
+
+
+class Command(BaseCommand):
+    help = "One-off backfill: store Billing.netAmount and Package.totalAmount as Decimal128."
+
+    def handle(self, *args, **options):
+        for collection_name, (converted, left) in convert_stored_amounts().items():
+            self.stdout.write(self.style.SUCCESS(f"{collection_name}: converted {converted} amount(s)"))
+            if left:
+                self.stdout.write(self.style.WARNING(f"{collection_name}: {left} non-numeric amount(s) left as is"))
+        packages_changed()
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.indexes import ensure_indexes
+
+
+class Command(BaseCommand):
+    help = "Create the MongoDB indexes registered in core.indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("collections", nargs="*", help="Only these collections (default: all)")
+
+    def handle(self, *args, **options):
+        for collection, names in ensure_indexes(options["collections"] or None).items():
+            self.stdout.write(f"{collection}: {', '.join(names)}")
+        self.stdout.write(self.style.SUCCESS("Indexes are up to date"))
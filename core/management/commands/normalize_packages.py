@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.package_catalog import normalise_stored_packages
+
+
+class Command(BaseCommand):
+    help = "One-off backfill: normalise investigations on every core_package document."
+
+    def handle(self, *args, **options):
+        updated = normalise_stored_packages()
+        self.stdout.write(self.style.SUCCESS(f"Normalised {updated} package(s)"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.sample_status import rebuild_pending_transfer_flags
+
+
+class Command(BaseCommand):
+    help = "Backfill/repair the pending_transfer flag on every core_sample document."
+
+    def handle(self, *args, **options):
+        changed = rebuild_pending_transfer_flags()
+        self.stdout.write(self.style.SUCCESS(f"Updated pending_transfer on {changed} sample(s)"))
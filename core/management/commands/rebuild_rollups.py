@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute core_dailyrollup from the raw employee, billing and investigation collections. "
+        "Run once without options after deploying; the dashboard reads rollups only after that."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", help="Only this company_id")
+        parser.add_argument("--from", dest="day_from", help="First day to rebuild (YYYY-MM-DD)")
+        parser.add_argument("--to", dest="day_to", help="Last day to rebuild (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        written = rebuild_rollups(options["company"], options["day_from"], options["day_to"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} daily rollup(s)"))
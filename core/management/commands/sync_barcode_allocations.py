@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.barcode_allocation import resync
+from core.barcode_index import barcode_range_index
+
+
+class Command(BaseCommand):
+    help = "Mark every billed barcode as used in the core_barcodeallocation bitmaps (never frees any)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--range-id", help="Only sync this barcode range")
+
+    def handle(self, *args, **options):
+        barcode_range_index.load()
+        ranges = barcode_range_index.ranges()
+        if options.get("range_id"):
+            ranges = [r for r in ranges if r["range_id"] == options["range_id"]]
+
+        for range_doc in ranges:
+            used = resync(range_doc)
+            self.stdout.write(f"{range_doc['startbarcode']}-{range_doc['endbarcode']}: {used} used")
+        self.stdout.write(self.style.SUCCESS(f"Synced {len(ranges)} barcode range(s)"))
@@ -1,6 +1,8 @@
 from django.db import models
 from bson import ObjectId 
 
+from .fields import Decimal128Field
+
 class AuditModel(models.Model):
     created_by = models.CharField(max_length=100, blank=True, null=True)
     created_date = models.DateTimeField(auto_now_add=True)
@@ -19,7 +21,7 @@ class Register(AuditModel):
 class Package(AuditModel):
     package_name = models.CharField(max_length=100, blank=True, null=True)
     investigations = models.JSONField(blank=True, null=True)
-    totalAmount = models.CharField(max_length=100)
+    totalAmount = Decimal128Field(max_digits=10, decimal_places=2)
 
     def __str__(self):
         return f"Package: {self.package_name} - {self.totalAmount}"
@@ -45,8 +47,9 @@ class Billing(AuditModel):
     employee_id = models.CharField(max_length=50)
     barcode = models.CharField(max_length=50)
     testdetails = models.JSONField(default=list)
-    netAmount = models.DecimalField(max_digits=10, decimal_places=2)
+    netAmount = Decimal128Field(max_digits=10, decimal_places=2)
     paymentMode = models.CharField(max_length=50,default="Credit")
+    package_id = models.CharField(max_length=50, blank=True, null=True)
     def __str__(self):
         return f"Billing({self.employee_id} - {self.barcode})" 
 
@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from django.db import models
+from django.utils import timezone
+from pymongo import MongoClient, monitoring
+from dotenv import load_dotenv
+load_dotenv()
+
+# MongoDB config
+MONGO_URI = os.getenv("GLOBAL_DB_HOST")
+DB_NAME = os.getenv("CHC_DB_NAME", "Corporatehealthcheckup")
+
+# Pool sizing (per worker process)
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", 50)),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", 0)),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 300000)),
+    "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)),
+    "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 10000)),
+}
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Collects live connection pool counters from pymongo's CMAP events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections_open = 0
+            self.checked_out = 0
+            self.max_checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.total_wait_ms = 0.0
+            self.max_wait_ms = 0.0
+            self.pools_cleared = 0
+
+    # Checkout happens on the requesting thread, so the start time is thread-local
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        wait_ms = (time.monotonic() - started) * 1000 if started else 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_open = max(0, self.connections_open - 1)
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pools_cleared += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "connections_open": self.connections_open,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_ms": round(self.total_wait_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 3),
+                "pools_cleared": self.pools_cleared,
+            }
+
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_pool_stats = None
+
+
+def get_client():
+    """
+    Return the process-wide MongoClient, creating it on first use.
+    The client is rebuilt after a fork so gunicorn workers never share sockets
+    inherited from the master process.
+    """
+    global _client, _client_pid, _pool_stats
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            _pool_stats = PoolStatsListener()
+            _client = MongoClient(MONGO_URI, event_listeners=[_pool_stats], **MONGO_POOL_OPTIONS)
+            _client_pid = pid
+    return _client
+
+
+def get_db(name=DB_NAME):
+    return get_client()[name]
+
+
+def get_collection(name, db_name=DB_NAME):
+    return get_client()[db_name][name]
+
+
+def pool_stats():
+    """Pool configuration plus live counters for this worker process."""
+    stats = _pool_stats.snapshot() if _pool_stats is not None and _client_pid == os.getpid() else None
+    return {
+        "pid": os.getpid(),
+        "config": MONGO_POOL_OPTIONS,
+        "stats": stats,
+    }
+
+
+def model_values(doc, model):
+    """
+    Shape a raw pymongo document the way the ORM would load it, so model
+    serializers render it identically: JSON fields stored as text are decoded
+    and naive (UTC) datetimes are made aware.
+    """
+    values = {}
+    for field in model._meta.concrete_fields:
+        value = doc.get(field.attname)
+        if isinstance(field, models.JSONField) and isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        elif isinstance(field, models.DateTimeField) and isinstance(value, datetime) and timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        values[field.attname] = value
+    return values
@@ -0,0 +1,74 @@
+import json
+
+from bson.decimal128 import Decimal128
+
+from .mongo import get_collection
+from .versioned_cache import VersionedCache, bump_version
+
+PACKAGE_COLLECTION = "core_package"
+PACKAGE_CACHE_KEY = "packages"
+
+
+def clean_investigations(investigations):
+    """Reconcile testname/testnameme and unwrap $numberLong test ids."""
+    if isinstance(investigations, str):
+        try:
+            investigations = json.loads(investigations)
+        except ValueError:
+            investigations = []
+    cleaned_investigations = []
+    for inv in investigations or []:
+        if not isinstance(inv, dict):
+            continue
+        testname = inv.get("testname") or inv.get("testnameme") or ""
+        test_id_val = inv.get("test_id", None)
+
+        if isinstance(test_id_val, dict) and "$numberLong" in test_id_val:
+            test_id_val = int(test_id_val["$numberLong"])
+
+        cleaned_investigations.append({
+            "testname": testname,
+            "test_id": test_id_val if test_id_val is not None else None
+        })
+    return cleaned_investigations
+
+
+def _load_packages():
+    packages = []
+    for pkg in get_collection(PACKAGE_COLLECTION).find({}):
+        pkg["_id"] = str(pkg["_id"])
+        # Already normalised at write time; re-applying is cheap and covers
+        # documents written before the backfill ran.
+        pkg["investigations"] = clean_investigations(pkg.get("investigations", []))
+        if isinstance(pkg.get("totalAmount"), Decimal128):
+            pkg["totalAmount"] = str(pkg["totalAmount"].to_decimal())
+        packages.append(pkg)
+    return packages
+
+
+_package_cache = VersionedCache(PACKAGE_CACHE_KEY, _load_packages)
+
+
+def get_packages():
+    """(version, [package]) from the per-process cache."""
+    return _package_cache.get()
+
+
+def packages_changed():
+    """Call after any write to core_package."""
+    _package_cache.invalidate()
+    return bump_version(PACKAGE_CACHE_KEY)
+
+
+def normalise_stored_packages():
+    """Rewrite stored packages whose investigations are not yet normalised."""
+    collection = get_collection(PACKAGE_COLLECTION)
+    updated = 0
+    for pkg in collection.find({}, {"investigations": 1}):
+        cleaned = clean_investigations(pkg.get("investigations", []))
+        if cleaned != pkg.get("investigations"):
+            collection.update_one({"_id": pkg["_id"]}, {"$set": {"investigations": cleaned}})
+            updated += 1
+    if updated:
+        packages_changed()
+    return updated
@@ -0,0 +1,103 @@
+import base64
+from datetime import datetime
+
+from bson import json_util
+from django.utils import timezone
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def get_limit(request, default=None):
+    """
+    Page size from ?limit=. Returns `default` when absent so endpoints that used
+    to return everything keep doing so unless the client asks for pages.
+    """
+    raw = request.GET.get("limit")
+    if raw in (None, ""):
+        return default
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise PaginationError("limit must be an integer")
+    if limit < 1:
+        raise PaginationError("limit must be at least 1")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except Exception:
+        raise PaginationError("Invalid cursor")
+    if not isinstance(values, list):
+        raise PaginationError("Invalid cursor")
+    return values
+
+
+def get_cursor(request, sort):
+    """Decoded ?cursor= values for the given sort spec, or None."""
+    token = request.GET.get("cursor")
+    if not token:
+        return None
+    values = decode_cursor(token)
+    if len(values) != len(sort):
+        raise PaginationError("Cursor does not match this listing")
+    return values
+
+
+def keyset_filter(sort, values):
+    """
+    Mongo filter selecting documents strictly after `values` in `sort` order,
+    e.g. sort=[("date", -1), ("_id", -1)] -> date < d OR (date == d AND _id < i).
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+        clause[field] = {"$gt" if direction == 1 else "$lt": values[i]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def cursor_for(doc, sort):
+    return encode_cursor([doc.get(field) for field, _ in sort])
+
+
+def set_next_cursor(response, next_cursor):
+    if next_cursor:
+        response[NEXT_CURSOR_HEADER] = next_cursor
+        response["Access-Control-Expose-Headers"] = NEXT_CURSOR_HEADER
+    return response
+
+
+def _parse_day(value, name):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise PaginationError(f"{name} must be in YYYY-MM-DD format")
+
+
+def date_range_filter(request, field, from_param="date_from", to_param="date_to"):
+    """
+    Mongo filter for ?date_from=/?date_to= (inclusive local days) on `field`.
+    Bounds are timezone-aware so pymongo converts them to UTC correctly.
+    """
+    date_from = request.GET.get(from_param)
+    date_to = request.GET.get(to_param)
+    bounds = {}
+    if date_from:
+        start = datetime.combine(_parse_day(date_from, from_param), datetime.min.time())
+        bounds["$gte"] = timezone.make_aware(start)
+    if date_to:
+        end = datetime.combine(_parse_day(date_to, to_param), datetime.max.time())
+        bounds["$lte"] = timezone.make_aware(end)
+    return {field: bounds} if bounds else {}
@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import time
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+
+def _accepted_encodings(header):
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class PrecompressedBody:
+    """
+    A response body serialized and compressed once, served to many requests
+    with ETag/Last-Modified revalidation and Accept-Encoding negotiation.
+    """
+
+    def __init__(self, body, content_type="application/json", last_modified=None):
+        self.content_type = content_type
+        self.last_modified = int(last_modified or time.time())
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body, quality=11)
+
+    def etag(self, encoding="identity"):
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+    def _not_modified(self, request):
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            tags = [t[2:] if t.startswith("W/") else t for t in tags]
+            return "*" in tags or any(t.strip('"').split("-")[0] == self.digest for t in tags)
+        if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE") or "")
+        return if_modified_since is not None and self.last_modified <= if_modified_since
+
+    def _pick_encoding(self, request):
+        accepted = _accepted_encodings(request.META.get("HTTP_ACCEPT_ENCODING"))
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+    def response(self, request, cache_control="no-cache"):
+        encoding = self._pick_encoding(request)
+        if self._not_modified(request):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(self.variants[encoding], content_type=self.content_type)
+            if encoding != "identity":
+                response["Content-Encoding"] = encoding
+        response["ETag"] = self.etag(encoding)
+        response["Last-Modified"] = http_date(self.last_modified)
+        response["Cache-Control"] = cache_control
+        response["Vary"] = "Accept-Encoding"
+        return response
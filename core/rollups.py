@@ -0,0 +1,313 @@
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from bson.decimal128 import Decimal128
+from django.utils import timezone
+from pymongo import UpdateOne
+
+from .analytics import EMPLOYEE_COLLECTION, HEALTH_BUCKETS, INVESTIGATION_COLLECTION, age_group, health_bucket
+from .mongo import get_collection
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_COLLECTION = "core_dailyrollup"
+BILLING_COLLECTION = "core_billing"
+REBUILD_BATCH_SIZE = 1000
+DEFAULT_COMPANY_ID = "CHC001"
+# Written by a full rebuild; until it exists the rollups only cover days since deploy
+SEEDED_MARKER_ID = "_seeded"
+
+
+def _rollups():
+    return get_collection(ROLLUP_COLLECTION)
+
+
+def local_day(value=None):
+    """YYYY-MM-DD of a datetime in the project time zone (stored datetimes are UTC)."""
+    value = value or timezone.now()
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return timezone.localtime(value).date().isoformat()
+
+
+# Counter names become field names, which may not contain "." or start with "$";
+# they are stored as full-width look-alikes and mapped back by _name() on read
+_KEY_ESCAPES = ((".", "\uff0e"), ("$", "\uff04"))
+
+
+def _key(value):
+    key = str(value if value not in (None, "") else "Unknown")
+    for char, escaped in _KEY_ESCAPES:
+        key = key.replace(char, escaped)
+    return key
+
+
+def _name(key):
+    for char, escaped in _KEY_ESCAPES:
+        key = key.replace(escaped, char)
+    return key
+
+
+def _amount(value):
+    try:
+        return Decimal(str(value if value not in (None, "") else 0))
+    except InvalidOperation:
+        return Decimal(0)
+
+
+class _Delta:
+    """Counter and amount increments for one company-day rollup."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.amounts = defaultdict(Decimal)
+
+    def update_op(self, company_id, day):
+        inc = dict(self.counts)
+        inc.update({f"billed_amount.{mode}": Decimal128(amount) for mode, amount in self.amounts.items()})
+        return UpdateOne(
+            {"_id": f"{company_id}:{day}"},
+            {"$inc": inc, "$setOnInsert": {"company_id": company_id, "day": day}},
+            upsert=True
+        )
+
+
+def _write(deltas):
+    ops = []
+    for (company_id, day), delta in deltas.items():
+        delta.counts = Counter({k: v for k, v in delta.counts.items() if v})  # an edit may cancel out
+        if delta.counts or delta.amounts:
+            ops.append(delta.update_op(company_id, day))
+    if ops:
+        _rollups().bulk_write(ops, ordered=False)
+
+
+def _add_billing(deltas, billing):
+    delta = deltas[(billing.get("company_id") or DEFAULT_COMPANY_ID, local_day(billing.get("date")))]
+    delta.counts["billings"] += 1
+    delta.amounts[_key(billing.get("paymentMode") or "Credit")] += _amount(billing.get("netAmount"))
+
+
+def _add_registration(deltas, employee):
+    company_id = employee.get("company_id") or DEFAULT_COMPANY_ID
+    deltas[(company_id, local_day(employee.get("created_date")))].counts["registrations"] += 1
+
+
+def _first_present(*values):
+    for value in values:
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def _add_investigation(deltas, investigation, employee, sign=1):
+    # Same fallbacks as analytics.dashboard_pipeline: investigation value first, then the employee's
+    employee = employee or {}
+    company_id = investigation.get("company_id") or DEFAULT_COMPANY_ID
+    counts = deltas[(company_id, local_day(investigation.get("date")))].counts
+    counts["assessments"] += sign
+    counts[f"by_gender.{_key(_first_present(investigation.get('gender'), employee.get('gender')))}"] += sign
+    counts[f"by_department.{_key(employee.get('department'))}"] += sign
+    counts[f"by_age_group.{age_group(_first_present(investigation.get('age'), employee.get('age')))}"] += sign
+    bucket = health_bucket(investigation.get("vitals"), investigation.get("status"))
+    if bucket:
+        counts[f"health_status.{bucket}"] += sign
+
+
+def _values(obj, fields):
+    return obj if isinstance(obj, dict) else {f: getattr(obj, f, None) for f in fields}
+
+
+_EMPLOYEE_FIELDS = ("company_id", "created_date", "gender", "department")
+_BILLING_FIELDS = ("company_id", "date", "paymentMode", "netAmount")
+_INVESTIGATION_FIELDS = ("company_id", "date", "employee_id", "gender", "age", "vitals", "status")
+
+
+def record_registrations(employees=(), billings=()):
+    """Count new employees and billings (models or dicts) into their day's rollup."""
+    try:
+        deltas = defaultdict(_Delta)
+        for employee in employees:
+            _add_registration(deltas, _values(employee, _EMPLOYEE_FIELDS))
+        for billing in billings:
+            _add_billing(deltas, _values(billing, _BILLING_FIELDS))
+        _write(deltas)
+    except Exception as e:
+        # Rollups are derived data; the write path must not fail on them (rebuild_rollups repairs)
+        logger.error(f"Rollup update failed for registrations: {str(e)}")
+
+
+def _employee_for(employee_id):
+    return get_collection(EMPLOYEE_COLLECTION).find_one(
+        {"employee_id": employee_id}, {"_id": 0, "gender": 1, "age": 1, "department": 1}
+    )
+
+
+def investigation_snapshot(investigation):
+    """The rollup-relevant fields of an investigation, taken before it is edited."""
+    return dict(_values(investigation, _INVESTIGATION_FIELDS))
+
+
+def record_investigation(investigation, previous=None):
+    """
+    Count a saved investigation into its day's rollup. For an edit, pass the
+    investigation_snapshot() taken before it so the old values are taken out.
+    """
+    try:
+        investigation = _values(investigation, _INVESTIGATION_FIELDS)
+        deltas = defaultdict(_Delta)
+        if previous:
+            _add_investigation(deltas, previous, _employee_for(previous.get("employee_id")), sign=-1)
+        _add_investigation(deltas, investigation, _employee_for(investigation.get("employee_id")))
+        _write(deltas)
+    except Exception as e:
+        logger.error(f"Rollup update failed for investigation: {str(e)}")
+
+
+def record_status_change(investigation, previous_status):
+    """Move an investigation between health buckets after its status changed."""
+    try:
+        investigation = _values(investigation, _INVESTIGATION_FIELDS)
+        before = health_bucket(investigation.get("vitals"), previous_status)
+        after = health_bucket(investigation.get("vitals"), investigation.get("status"))
+        if before == after:
+            return
+        deltas = defaultdict(_Delta)
+        company_id = investigation.get("company_id") or DEFAULT_COMPANY_ID
+        counts = deltas[(company_id, local_day(investigation.get("date")))].counts
+        if before:
+            counts[f"health_status.{before}"] -= 1
+        if after:
+            counts[f"health_status.{after}"] += 1
+        _write(deltas)
+    except Exception as e:
+        logger.error(f"Rollup update failed for status change: {str(e)}")
+
+
+def _bounds(day_from, day_to):
+    bounds = {}
+    if day_from:
+        bounds["$gte"] = timezone.make_aware(datetime.combine(datetime.strptime(day_from, "%Y-%m-%d"), datetime.min.time()))
+    if day_to:
+        bounds["$lte"] = timezone.make_aware(datetime.combine(datetime.strptime(day_to, "%Y-%m-%d"), datetime.max.time()))
+    return bounds
+
+
+def _scope(field, company_id, day_from, day_to):
+    query = {}
+    if company_id:
+        query["company_id"] = company_id
+    bounds = _bounds(day_from, day_to)
+    if bounds:
+        query[field] = bounds
+    return query
+
+
+def rebuild_rollups(company_id=None, day_from=None, day_to=None):
+    """
+    Recompute rollups from the raw collections for a company and/or day
+    range (all of them by default). Returns the number of rollup documents written.
+    """
+    deltas = defaultdict(_Delta)
+
+    employees = get_collection(EMPLOYEE_COLLECTION).find(
+        _scope("created_date", company_id, day_from, day_to), {"_id": 0, "company_id": 1, "created_date": 1}
+    ).batch_size(REBUILD_BATCH_SIZE)
+    for employee in employees:
+        _add_registration(deltas, employee)
+
+    billings = get_collection(BILLING_COLLECTION).find(
+        _scope("date", company_id, day_from, day_to),
+        {"_id": 0, "company_id": 1, "date": 1, "paymentMode": 1, "netAmount": 1}
+    ).batch_size(REBUILD_BATCH_SIZE)
+    for billing in billings:
+        _add_billing(deltas, billing)
+
+    investigations = get_collection(INVESTIGATION_COLLECTION).find(
+        _scope("date", company_id, day_from, day_to), {"_id": 0, **{f: 1 for f in _INVESTIGATION_FIELDS}}
+    ).batch_size(REBUILD_BATCH_SIZE)
+    chunk = []
+    for investigation in investigations:
+        chunk.append(investigation)
+        if len(chunk) >= REBUILD_BATCH_SIZE:
+            _add_investigation_chunk(deltas, chunk)
+            chunk = []
+    _add_investigation_chunk(deltas, chunk)
+
+    rollups = _rollups()
+    scope = {}
+    if company_id:
+        scope["company_id"] = company_id
+    if day_from or day_to:
+        scope["day"] = {k: v for k, v in (("$gte", day_from), ("$lte", day_to)) if v}
+    rollups.delete_many(scope)
+    _write(deltas)
+    if not scope:
+        rollups.replace_one({"_id": SEEDED_MARKER_ID}, {"seeded_at": timezone.now()}, upsert=True)
+    return len(deltas)
+
+
+def _add_investigation_chunk(deltas, chunk):
+    if not chunk:
+        return
+    employees = {}
+    for employee in get_collection(EMPLOYEE_COLLECTION).find(
+        {"employee_id": {"$in": list({inv.get("employee_id") for inv in chunk})}},
+        {"_id": 0, "employee_id": 1, "gender": 1, "age": 1, "department": 1}
+    ):
+        employees.setdefault(employee.get("employee_id"), employee)
+    for investigation in chunk:
+        _add_investigation(deltas, investigation, employees.get(investigation.get("employee_id")))
+
+
+_seeded = False
+
+
+def is_seeded():
+    """True once a full rebuild_rollups has run, so the rollups cover history too."""
+    global _seeded
+    if not _seeded:
+        _seeded = _rollups().count_documents({"_id": SEEDED_MARKER_ID}, limit=1) > 0
+    return _seeded
+
+
+def _merge(target, counters):
+    for key, value in (counters or {}).items():
+        name = _name(key)
+        target[name] = target.get(name, 0) + value
+
+
+def read_dashboard(company_id=None, day_from=None, day_to=None):
+    """Dashboard analytics summed from the daily rollups in range."""
+    query = {"_id": {"$ne": SEEDED_MARKER_ID}}
+    if company_id:
+        query["company_id"] = company_id
+    if day_from or day_to:
+        query["day"] = {k: v for k, v in (("$gte", day_from), ("$lte", day_to)) if v}
+
+    analytics = {
+        'total_employees': 0,
+        'total_assessments': 0,
+        'total_billings': 0,
+        'by_gender': {},
+        'by_department': {},
+        'by_age_group': {},
+        'health_status': dict.fromkeys(HEALTH_BUCKETS, 0),
+        'billed_amount': {},
+    }
+    billed = defaultdict(Decimal)
+    for rollup in _rollups().find(query):
+        analytics['total_employees'] += rollup.get("registrations", 0)
+        analytics['total_assessments'] += rollup.get("assessments", 0)
+        analytics['total_billings'] += rollup.get("billings", 0)
+        for name in ('by_gender', 'by_department', 'by_age_group', 'health_status'):
+            _merge(analytics[name], rollup.get(name))
+        for mode, amount in (rollup.get("billed_amount") or {}).items():
+            billed[_name(mode)] += amount.to_decimal() if isinstance(amount, Decimal128) else _amount(amount)
+    analytics['billed_amount'] = {mode: str(amount) for mode, amount in billed.items()}
+    # Buckets emptied by later changes are dropped, as the live query never reports zeros
+    for name in ('by_gender', 'by_department', 'by_age_group'):
+        analytics[name] = {k: v for k, v in analytics[name].items() if v}
+    return analytics
@@ -0,0 +1,257 @@
+import json
+import re
+import threading
+
+from django.utils import timezone
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .mongo import get_collection
+from .sequences import SEQUENCE_COLLECTION
+
+SAMPLE_COLLECTION = "core_sample"
+MAX_CAS_RETRIES = 20
+
+# Each status can only be reached from the one before it
+PRIOR_STATUS = {
+    "Collected": "Pending",
+    "Transferred": "Collected",
+    "Received": "Transferred",
+}
+# (actor field, time field) stamped when a test reaches the status
+STATUS_STAMPS = {
+    "Collected": ("collected_by", "samplecollected_time"),
+    "Transferred": ("transferred_by", "sampletransferred_time"),
+    "Received": ("received_by", "received_time"),
+}
+
+
+class SampleConflictError(Exception):
+    pass
+
+
+def parse_testdetails(raw):
+    """testdetails as a list, whether stored as a list, a dict or JSON text."""
+    if not raw:
+        return []
+    if isinstance(raw, list):
+        return raw
+    if isinstance(raw, dict):
+        return [raw]
+    if isinstance(raw, str):
+        try:
+            parsed = json.loads(raw)
+        except json.JSONDecodeError:
+            # Fix unquoted keys
+            fixed_json = re.sub(
+                r'([{,])(\s*)([a-zA-Z_][a-zA-Z0-9_]*)\s*:',
+                r'\1"\3":',
+                raw
+            )
+            parsed = json.loads(fixed_json)
+        return parse_testdetails(parsed) if not isinstance(parsed, str) else []
+    return []
+
+
+def dump_testdetails(tests):
+    return json.dumps(tests, ensure_ascii=False)
+
+
+def new_test_entry(test, actor, now):
+    """testdetails entry for a test seen for the first time on this sample."""
+    test_status = test.get('samplestatus', 'Pending')
+    return {
+        'testname': test.get('testname', ''),
+        'test_id': test.get('test_id'),
+        'samplestatus': test_status,
+        'samplecollected_time': now if test_status == 'Collected' else None,
+        'collected_by': actor if test_status == 'Collected' else None,
+        'batch_number': None,
+        'sampletransferred_time': None,
+        'transferred_by': None,
+        'received_time': None,
+        'received_by': None,
+        'remarks': None,
+        'specimen_type': test.get('specimen_type', 'Standard'),
+        'lastmodified_by': actor,
+        'lastmodified_time': now
+    }
+
+
+def _index_by_test_id(tests):
+    return {t['test_id']: i for i, t in enumerate(tests) if isinstance(t, dict) and t.get('test_id')}
+
+
+def apply_transitions(tests, incoming_tests, actor, now, target=None, add_missing=False):
+    """
+    Move each incoming test (matched on test_id) to `target`, or to its own
+    samplestatus, but only from the status before it in
+    Pending -> Collected -> Transferred -> Received. Edits `tests` in place
+    and returns one {"test_id", "result", "samplestatus"} per incoming test,
+    where result is applied, added, unchanged, conflict or not_found.
+    """
+    existing_map = _index_by_test_id(tests)
+    outcomes = []
+    for new_test in incoming_tests:
+        test_id = new_test.get('test_id')
+        new_status = target or new_test.get('samplestatus', 'Pending')
+
+        idx = existing_map.get(test_id)
+        if idx is None:
+            if not add_missing:
+                outcomes.append({"test_id": test_id, "result": "not_found", "samplestatus": None})
+            elif new_status in ('Pending', 'Collected'):
+                tests.append(new_test_entry(dict(new_test, samplestatus=new_status), actor, now))
+                existing_map[test_id] = len(tests) - 1
+                outcomes.append({"test_id": test_id, "result": "added", "samplestatus": new_status})
+            else:
+                outcomes.append({"test_id": test_id, "result": "conflict", "samplestatus": None})
+            continue
+
+        existing_test = tests[idx]
+        current = existing_test.get('samplestatus') or 'Pending'
+        if current == new_status:
+            outcomes.append({"test_id": test_id, "result": "unchanged", "samplestatus": current})
+            continue
+        if PRIOR_STATUS.get(new_status) != current:
+            outcomes.append({"test_id": test_id, "result": "conflict", "samplestatus": current})
+            continue
+
+        existing_test['samplestatus'] = new_status
+        by_field, time_field = STATUS_STAMPS[new_status]
+        existing_test[by_field] = actor
+        existing_test[time_field] = now
+        existing_test['lastmodified_by'] = actor
+        existing_test['lastmodified_time'] = now
+        if new_status == 'Collected' and not existing_test.get('specimen_type'):
+            existing_test['specimen_type'] = new_test.get('specimen_type', 'Standard')
+        outcomes.append({"test_id": test_id, "result": "applied", "samplestatus": new_status})
+    return outcomes
+
+
+def is_pending_transfer(test):
+    """Transferred but not yet put in a batch."""
+    return (
+        isinstance(test, dict) and bool(test.get('test_id'))
+        and test.get('samplestatus') == 'Transferred'
+        and test.get('batch_number') in (None, '', 'null')
+    )
+
+
+def testdetails_fields(tests):
+    """
+    Fields written with every testdetails change. pending_transfer is a
+    denormalised, indexed flag for the batching queue, kept in step here.
+    """
+    return {
+        "testdetails": dump_testdetails(tests),
+        "pending_transfer": any(is_pending_transfer(t) for t in tests),
+    }
+
+
+def guarded_update(raw_testdetails, tests, actor):
+    """
+    (filter, update) that only matches while testdetails still holds the text
+    that was read, so a concurrent writer makes the update miss instead of
+    being overwritten. lastmodified_date comes from the server clock.
+    """
+    fields = testdetails_fields(tests)
+    fields["lastmodified_by"] = actor
+    return (
+        {"testdetails": raw_testdetails},
+        {"$set": fields, "$currentDate": {"lastmodified_date": True}}
+    )
+
+
+def rebuild_pending_transfer_flags(batch_size=1000, query=None):
+    """Recompute pending_transfer on every sample (or those matching `query`); returns how many changed."""
+    collection = get_collection(SAMPLE_COLLECTION)
+    ops = []
+    changed = 0
+    for doc in collection.find(query or {}, {"testdetails": 1, "pending_transfer": 1}).batch_size(batch_size):
+        try:
+            tests = parse_testdetails(doc.get("testdetails"))
+        except ValueError:
+            tests = []
+        pending = any(is_pending_transfer(t) for t in tests)
+        if doc.get("pending_transfer") is not pending:
+            # Guarded on the text read; a writer that changed it has already set the flag
+            ops.append(UpdateOne(
+                {"_id": doc["_id"], "testdetails": doc.get("testdetails")},
+                {"$set": {"pending_transfer": pending}}
+            ))
+        if len(ops) >= batch_size:
+            changed += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        changed += collection.bulk_write(ops, ordered=False).modified_count
+    if query is None:
+        _mark_flags_seeded()
+    return changed
+
+
+# Marker in core_sequence: once present, every sample carries pending_transfer
+PENDING_TRANSFER_SEEDED_ID = "pending_transfer_seeded"
+_flags_seeded = False
+_seed_lock = threading.Lock()
+
+
+def _mark_flags_seeded():
+    get_collection(SEQUENCE_COLLECTION).replace_one(
+        {"_id": PENDING_TRANSFER_SEEDED_ID}, {"seeded_at": timezone.now()}, upsert=True
+    )
+
+
+def ensure_pending_transfer_flags():
+    """
+    First-use seed for samples written before pending_transfer existed, so
+    the batching queue does not lose them until rebuild_pending_transfers
+    runs. The seed scans core_sample once per deployment, then leaves a
+    marker; every later write keeps the flag current.
+    """
+    global _flags_seeded
+    if _flags_seeded:
+        return
+    with _seed_lock:
+        if _flags_seeded:
+            return
+        if get_collection(SEQUENCE_COLLECTION).count_documents({"_id": PENDING_TRANSFER_SEEDED_ID}, limit=1) == 0:
+            rebuild_pending_transfer_flags(query={"pending_transfer": {"$exists": False}})
+            _mark_flags_seeded()
+        _flags_seeded = True
+
+
+def update_testdetails(collection, query, mutate, actor, create=None):
+    """
+    Read-check-write one sample's testdetails. `mutate(tests)` edits the list
+    in place and returns a result; the write is retried on fresh data when
+    another writer changed the sample in between. With `create` (base
+    fields), a missing sample is inserted. Returns (result, doc, created);
+    doc is None when the sample does not exist and `create` is not given.
+    """
+    for _ in range(MAX_CAS_RETRIES):
+        doc = collection.find_one(query)
+        tests = parse_testdetails(doc.get("testdetails")) if doc else []
+        result = mutate(tests)
+
+        if doc is None:
+            if create is None:
+                return result, None, False
+            now = timezone.now()
+            doc = dict(create, created_by=actor, created_date=now, date=now,
+                       lastmodified_by=None, lastmodified_date=None, **testdetails_fields(tests))
+            try:
+                collection.insert_one(doc)
+            except DuplicateKeyError:
+                continue  # created concurrently; apply on top of it
+            return result, doc, True
+
+        new_raw = dump_testdetails(tests)
+        if new_raw == doc.get("testdetails"):
+            return result, doc, False
+        guard, update = guarded_update(doc.get("testdetails"), tests, actor)
+        guard["_id"] = doc["_id"]
+        updated = collection.find_one_and_update(guard, update, return_document=ReturnDocument.AFTER)
+        if updated is not None:
+            return result, updated, False
+    raise SampleConflictError("Sample is being updated concurrently, please retry")
@@ -0,0 +1,38 @@
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .mongo import get_collection
+
+SEQUENCE_COLLECTION = "core_sequence"
+
+
+def next_values(name, count=1, seed=None):
+    """
+    Atomically take `count` consecutive values from the named counter and
+    return (first, last). A missing counter starts from `seed()` (the last
+    value already in use, computed once) or 0.
+    """
+    collection = get_collection(SEQUENCE_COLLECTION)
+    doc = collection.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"value": count}},
+        return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        start = seed() if seed else 0
+        try:
+            collection.insert_one({"_id": name, "value": start})
+        except DuplicateKeyError:
+            pass  # another worker created it first; its seed is just as good
+        doc = collection.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"value": count}},
+            return_document=ReturnDocument.AFTER
+        )
+    last = doc["value"]
+    return last - count + 1, last
+
+
+def current_value(name):
+    doc = get_collection(SEQUENCE_COLLECTION).find_one({"_id": name})
+    return doc["value"] if doc else 0
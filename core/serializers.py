@@ -33,6 +33,31 @@ class PackageSerializer(serializers.ModelSerializer):
 
 
 from .models import EmployeeRegistration
+from .mongo import get_collection
+
+
+def latest_billing_barcodes(employee_ids):
+    """Latest billing barcode per employee_id, in one grouped query."""
+    employee_ids = list({e for e in employee_ids if e})
+    if not employee_ids:
+        return {}
+    pipeline = [
+        {"$match": {"employee_id": {"$in": employee_ids}}},
+        {"$sort": {"date": -1}},
+        {"$group": {"_id": "$employee_id", "barcode": {"$first": "$barcode"}}},
+    ]
+    return {doc["_id"]: doc["barcode"] for doc in get_collection("core_billing").aggregate(pipeline)}
+
+
+class EmployeeRegistrationListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Resolve every row's barcode up front instead of one Billing query per employee
+        employees = list(data.all() if hasattr(data, "all") else data)
+        if "latest_barcodes" not in self.context:
+            self.context["latest_barcodes"] = latest_billing_barcodes(e.employee_id for e in employees)
+        return super().to_representation(employees)
+
+
 class EmployeeRegistrationSerializer(serializers.ModelSerializer):
     id = ObjectIdField(read_only=True)
     barcode = serializers.SerializerMethodField()  # single CharField, not list
@@ -40,8 +65,12 @@ class EmployeeRegistrationSerializer(serializers.ModelSerializer):
     class Meta:
         model = EmployeeRegistration
         fields = '__all__'  # includes all + barcode
+        list_serializer_class = EmployeeRegistrationListSerializer
 
     def get_barcode(self, obj):
+        latest_barcodes = self.context.get("latest_barcodes")
+        if latest_barcodes is not None:
+            return latest_barcodes.get(obj.employee_id)
         billing = Billing.objects.filter(employee_id=obj.employee_id).order_by("-date").first()
         return billing.barcode if billing else None
 
@@ -0,0 +1,45 @@
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+# Flush to the client roughly every 64 KB instead of once per item
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class MongoJSONEncoder(JSONEncoder):
+    """DRF's encoder plus the BSON types raw pymongo documents carry."""
+
+    def default(self, obj):
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, Decimal128):
+            return str(obj.to_decimal())
+        return super().default(obj)
+
+
+def iter_json_array(items):
+    encoder = MongoJSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    buffer = ["["]
+    size = 1
+    first = True
+    for item in items:
+        chunk = encoder.encode(item)
+        if not first:
+            chunk = "," + chunk
+        first = False
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    buffer.append("]")
+    yield "".join(buffer).encode("utf-8")
+
+
+def stream_json_array(items, status=200):
+    """
+    Stream `items` as a JSON array without materialising the whole list.
+    """
+    return StreamingHttpResponse(iter_json_array(items), status=status, content_type="application/json")
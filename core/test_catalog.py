@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from .mongo import get_collection
+from .versioned_cache import first_seen
+
+logger = logging.getLogger(__name__)
+
+DIAGNOSTICS_DB = "Diagnostics"
+CORE_TEST_COLLECTION = "core_test"
+TESTDETAILS_COLLECTION = "core_testdetails"
+TEST_CATALOG_CACHE_KEY = "test_catalog"
+
+TEST_CATALOG_REFRESH_SECONDS = int(os.getenv("TEST_CATALOG_REFRESH_SECONDS", 300))
+
+
+class CatalogSnapshot:
+    """Immutable view of the Diagnostics test catalog at one point in time."""
+
+    def __init__(self, tests, by_id, by_name, version):
+        self.tests = tests        # core_test rows with a name, in collection order
+        self.by_id = by_id        # str(test_id) -> entry
+        self.by_name = by_name    # test_name -> entry
+        self.version = version    # content hash; changes only when the data does
+        self.loaded_at = time.time()
+        # When this content was first loaded by any worker; identical across workers
+        self.modified_at = first_seen(TEST_CATALOG_CACHE_KEY, version)
+
+
+def _load_snapshot():
+    entries_by_id = {}
+    entries_by_name = {}
+    tests = []
+
+    core_tests = get_collection(CORE_TEST_COLLECTION, DIAGNOSTICS_DB).find(
+        {}, {"_id": 0, "test_id": 1, "test_name": 1, "MRP": 1, "L2L_Rate_Card": 1}
+    )
+    for t in core_tests:
+        name = t.get("test_name")
+        if not name:
+            continue
+        entry = {
+            "test_id": t.get("test_id"),
+            "name": name,
+            "MRP": t.get("MRP", 0),
+            "L2L_Rate_Card": t.get("L2L_Rate_Card", 0),
+            "specimen_type": None,
+        }
+        tests.append(entry)
+        entries_by_name[name] = entry
+        if entry["test_id"] is not None:
+            entries_by_id[str(entry["test_id"])] = entry
+
+    details = get_collection(TESTDETAILS_COLLECTION, DIAGNOSTICS_DB).find(
+        {}, {"_id": 0, "test_id": 1, "test_name": 1, "specimen_type": 1}
+    )
+    for d in details:
+        test_id, name = d.get("test_id"), d.get("test_name")
+        entry = (entries_by_id.get(str(test_id)) if test_id is not None else None) or entries_by_name.get(name)
+        if entry is None:
+            # Tests only present in core_testdetails still need their specimen type
+            entry = {"test_id": test_id, "name": name, "MRP": None, "L2L_Rate_Card": None, "specimen_type": None}
+        entry["specimen_type"] = d.get("specimen_type") or entry["specimen_type"]
+        if test_id is not None:
+            entries_by_id.setdefault(str(test_id), entry)
+        if name:
+            entries_by_name.setdefault(name, entry)
+
+    digest = hashlib.sha256(json.dumps(
+        [tests, sorted(entries_by_id.items(), key=lambda kv: kv[0])], sort_keys=True, default=str
+    ).encode()).hexdigest()[:32]
+    return CatalogSnapshot(tests, entries_by_id, entries_by_name, digest)
+
+
+class TestCatalog:
+    """
+    Process-local snapshot of Diagnostics.core_test + core_testdetails.
+    Loaded on first use (or warm()), then refreshed by a daemon thread every
+    refresh interval; readers never wait on Mongo after the first load.
+    """
+
+    def __init__(self, refresh_seconds=TEST_CATALOG_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._refresher_pid = None
+
+    def refresh(self):
+        snapshot = _load_snapshot()
+        self._snapshot = snapshot
+        return snapshot
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Test catalog refresh failed: {str(e)}")
+
+    def _ensure_refresher(self):
+        # Threads do not survive fork, so each worker starts its own
+        pid = os.getpid()
+        if self._refresher_pid != pid:
+            self._refresher_pid = pid
+            threading.Thread(target=self._refresh_forever, name="test-catalog-refresh", daemon=True).start()
+
+    def snapshot(self):
+        if self._snapshot is None or self._refresher_pid != os.getpid():
+            with self._lock:
+                if self._snapshot is None:
+                    self.refresh()
+                self._ensure_refresher()
+        return self._snapshot
+
+    def warm(self):
+        """Load in the background so the first request does not pay for it."""
+        def _warm():
+            try:
+                self.snapshot()
+            except Exception as e:
+                logger.error(f"Test catalog warm-up failed: {str(e)}")
+        threading.Thread(target=_warm, name="test-catalog-warm", daemon=True).start()
+
+    def lookup(self, test_id=None, test_name=None):
+        """Catalog entry by test_id, falling back to test name."""
+        snapshot = self.snapshot()
+        entry = snapshot.by_id.get(str(test_id)) if test_id not in (None, "") else None
+        if entry is None and test_name:
+            entry = snapshot.by_name.get(test_name)
+        return entry
+
+    def specimen_type(self, test_id=None, test_name=None):
+        entry = self.lookup(test_id, test_name)
+        return entry.get("specimen_type") if entry else None
+
+
+test_catalog = TestCatalog()
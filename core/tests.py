@@ -1,3 +1,391 @@
-from django.test import TestCase
+import copy
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from . import barcode_allocation, rollups
+from .Views.registration import _parse_range
+from .sample_status import (
+    SampleConflictError, apply_transitions, dump_testdetails, parse_testdetails, update_testdetails
+)
+
+NOW = "2024-01-01T10:00:00+05:30"
+
+
+def _test(test_id, samplestatus, **extra):
+    return dict({"test_id": test_id, "testname": f"Test {test_id}", "samplestatus": samplestatus}, **extra)
+
+
+class ApplyTransitionsTests(SimpleTestCase):
+    def test_each_status_moves_forward_from_the_one_before_it(self):
+        for current, target in (("Pending", "Collected"), ("Collected", "Transferred"), ("Transferred", "Received")):
+            tests = [_test(1, current)]
+            outcomes = apply_transitions(tests, [{"test_id": 1}], "alice", NOW, target=target)
+            self.assertEqual(outcomes, [{"test_id": 1, "result": "applied", "samplestatus": target}])
+            self.assertEqual(tests[0]["samplestatus"], target)
+
+    def test_transition_stamps_actor_and_time(self):
+        tests = [_test(1, "Collected")]
+        apply_transitions(tests, [{"test_id": 1}], "bob", NOW, target="Transferred")
+        self.assertEqual(tests[0]["transferred_by"], "bob")
+        self.assertEqual(tests[0]["sampletransferred_time"], NOW)
+        self.assertEqual(tests[0]["lastmodified_by"], "bob")
+
+    def test_skipping_or_going_back_is_a_conflict(self):
+        for current, target in (("Pending", "Transferred"), ("Collected", "Received"), ("Received", "Collected"),
+                                ("Transferred", "Collected")):
+            tests = [_test(1, current)]
+            outcomes = apply_transitions(tests, [{"test_id": 1}], "alice", NOW, target=target)
+            self.assertEqual(outcomes, [{"test_id": 1, "result": "conflict", "samplestatus": current}])
+            self.assertEqual(tests[0]["samplestatus"], current)
+
+    def test_same_status_is_unchanged(self):
+        tests = [_test(1, "Collected", collected_by="alice")]
+        outcomes = apply_transitions(tests, [{"test_id": 1}], "bob", NOW, target="Collected")
+        self.assertEqual(outcomes[0]["result"], "unchanged")
+        self.assertEqual(tests[0]["collected_by"], "alice")
+
+    def test_missing_status_counts_as_pending(self):
+        tests = [{"test_id": 1, "testname": "Test 1"}]
+        outcomes = apply_transitions(tests, [{"test_id": 1, "samplestatus": "Collected"}], "alice", NOW)
+        self.assertEqual(outcomes[0]["result"], "applied")
+
+    def test_unknown_test(self):
+        tests = [_test(1, "Pending")]
+        outcomes = apply_transitions(tests, [{"test_id": 2}], "alice", NOW, target="Collected")
+        self.assertEqual(outcomes, [{"test_id": 2, "result": "not_found", "samplestatus": None}])
+        self.assertEqual(len(tests), 1)
+
+    def test_add_missing_only_adds_pending_or_collected(self):
+        tests = []
+        outcomes = apply_transitions(
+            tests, [{"test_id": 1, "samplestatus": "Collected"}, {"test_id": 2, "samplestatus": "Transferred"}],
+            "alice", NOW, add_missing=True
+        )
+        self.assertEqual([o["result"] for o in outcomes], ["added", "conflict"])
+        self.assertEqual(len(tests), 1)
+        self.assertEqual(tests[0]["collected_by"], "alice")
+
+    def test_repeated_test_id_in_one_request_sees_the_earlier_change(self):
+        tests = []
+        outcomes = apply_transitions(
+            tests, [{"test_id": 1, "samplestatus": "Pending"}, {"test_id": 1, "samplestatus": "Collected"}],
+            "alice", NOW, add_missing=True
+        )
+        self.assertEqual([o["result"] for o in outcomes], ["added", "applied"])
+        self.assertEqual(len(tests), 1)
+
+
+class _FakeSampleCollection:
+    """In-memory core_sample supporting the calls update_testdetails makes."""
+
+    def __init__(self, docs=(), before_write=None):
+        self.docs = {doc["_id"]: copy.deepcopy(doc) for doc in docs}
+        self.before_write = before_write  # simulates another writer between read and write
+        self.writes = 0
+
+    def find_one(self, query):
+        for doc in self.docs.values():
+            if all(doc.get(k) == v for k, v in query.items()):
+                return copy.deepcopy(doc)
+        return None
+
+    def find_one_and_update(self, guard, update, return_document=None):
+        if self.before_write:
+            self.before_write(self)
+        self.writes += 1
+        doc = self.find_one(guard)
+        if doc is None:
+            return None
+        stored = self.docs[doc["_id"]]
+        stored.update(update.get("$set", {}))
+        for field in update.get("$currentDate", {}):
+            stored[field] = NOW
+        return copy.deepcopy(stored)
+
+    def insert_one(self, doc):
+        self.docs[doc.get("_id", len(self.docs) + 1)] = copy.deepcopy(doc)
+
+
+def _collect(test_id):
+    return lambda tests: apply_transitions(tests, [{"test_id": test_id}], "alice", NOW, target="Collected")
+
+
+class UpdateTestdetailsTests(SimpleTestCase):
+    def _sample(self, *tests):
+        return {"_id": 1, "barcode": "100", "testdetails": dump_testdetails(list(tests))}
+
+    def test_writes_the_mutation(self):
+        collection = _FakeSampleCollection([self._sample(_test(1, "Pending"))])
+        outcomes, doc, created = update_testdetails(collection, {"barcode": "100"}, _collect(1), "alice")
+        self.assertEqual(outcomes[0]["result"], "applied")
+        self.assertFalse(created)
+        self.assertEqual(parse_testdetails(doc["testdetails"])[0]["samplestatus"], "Collected")
+        self.assertFalse(doc["pending_transfer"])
+        self.assertEqual(doc["lastmodified_by"], "alice")
+
+    def test_lost_update_is_retried_on_fresh_data(self):
+        def concurrent_writer(collection):
+            # Another desk collects test 2 between our read and our write, once
+            collection.before_write = None
+            stored = collection.docs[1]
+            tests = parse_testdetails(stored["testdetails"])
+            tests[1]["samplestatus"] = "Collected"
+            stored["testdetails"] = dump_testdetails(tests)
+
+        collection = _FakeSampleCollection(
+            [self._sample(_test(1, "Pending"), _test(2, "Pending"))], before_write=concurrent_writer
+        )
+        outcomes, doc, _ = update_testdetails(collection, {"barcode": "100"}, _collect(1), "alice")
+        self.assertEqual(collection.writes, 2)
+        self.assertEqual(outcomes[0]["result"], "applied")
+        statuses = [t["samplestatus"] for t in parse_testdetails(doc["testdetails"])]
+        self.assertEqual(statuses, ["Collected", "Collected"])
+
+    def test_retry_reapplies_the_mutation_to_the_fresh_status(self):
+        def concurrent_writer(collection):
+            collection.before_write = None
+            stored = collection.docs[1]
+            stored["testdetails"] = dump_testdetails([_test(1, "Collected")])
+
+        collection = _FakeSampleCollection([self._sample(_test(1, "Pending"))], before_write=concurrent_writer)
+        outcomes, _, _ = update_testdetails(collection, {"barcode": "100"}, _collect(1), "alice")
+        self.assertEqual(outcomes[0]["result"], "unchanged")
+
+    def test_gives_up_after_max_retries(self):
+        def always_changed(collection):
+            collection.docs[1]["testdetails"] += " "
+
+        collection = _FakeSampleCollection([self._sample(_test(1, "Pending"))], before_write=always_changed)
+        with self.assertRaises(SampleConflictError):
+            update_testdetails(collection, {"barcode": "100"}, _collect(1), "alice")
+
+    def test_no_write_when_nothing_changes(self):
+        collection = _FakeSampleCollection([self._sample(_test(1, "Collected"))])
+        outcomes, _, _ = update_testdetails(collection, {"barcode": "100"}, _collect(1), "alice")
+        self.assertEqual(outcomes[0]["result"], "unchanged")
+        self.assertEqual(collection.writes, 0)
+
+    def test_missing_sample_without_create(self):
+        collection = _FakeSampleCollection()
+        _, doc, created = update_testdetails(collection, {"barcode": "100"}, _collect(1), "alice")
+        self.assertIsNone(doc)
+        self.assertFalse(created)
+
+    def test_missing_sample_with_create(self):
+        collection = _FakeSampleCollection()
+        mutate = lambda tests: apply_transitions(  # noqa: E731
+            tests, [{"test_id": 1, "samplestatus": "Collected"}], "alice", NOW, add_missing=True
+        )
+        outcomes, doc, created = update_testdetails(
+            collection, {"barcode": "100"}, mutate, "alice", create={"barcode": "100", "company_id": "CHC001"}
+        )
+        self.assertTrue(created)
+        self.assertEqual(outcomes[0]["result"], "added")
+        self.assertEqual(doc["created_by"], "alice")
+
+
+def _bitmap(size, used=()):
+    bitmap = bytearray((size + 7) // 8)
+    for offset in used:
+        bitmap[offset >> 3] |= 1 << (offset & 7)
+    return bitmap
+
+
+class FreeOffsetsTests(SimpleTestCase):
+    def test_empty_range_not_a_multiple_of_eight(self):
+        self.assertEqual(barcode_allocation._free_offsets(_bitmap(10), 10, 20), list(range(10)))
+
+    def test_padding_bits_past_the_end_are_never_returned(self):
+        self.assertEqual(barcode_allocation._free_offsets(_bitmap(10, range(9)), 10, 5), [9])
+
+    def test_full_range(self):
+        self.assertEqual(barcode_allocation._free_offsets(_bitmap(10, range(10)), 10, 1), [])
+        self.assertEqual(barcode_allocation._free_offsets(_bitmap(16, range(16)), 16, 1), [])
+
+    def test_skips_full_bytes_and_finds_holes(self):
+        used = set(range(24)) - {3, 17}
+        self.assertEqual(barcode_allocation._free_offsets(_bitmap(24, used), 24, 5), [3, 17])
+
+    def test_stops_at_count(self):
+        self.assertEqual(barcode_allocation._free_offsets(_bitmap(64), 64, 3), [0, 1, 2])
+
+
+class _FakeAllocations:
+    """In-memory core_barcodeallocation with version-checked update_one."""
+
+    def __init__(self, doc, before_save=None):
+        self.doc = doc
+        self.before_save = before_save
+
+    def find_one(self, query):
+        return copy.deepcopy(self.doc)
+
+    def update_one(self, query, update):
+        if self.before_save:
+            self.before_save(self)
+        matched = query["version"] == self.doc["version"]
+        if matched:
+            self.doc.update(update["$set"])
+            for field, delta in update["$inc"].items():
+                self.doc[field] += delta
+        return mock.Mock(modified_count=int(matched))
+
+
+RANGE = {"range_id": "R1", "startbarcode": "1000", "endbarcode": "1009"}
+
+
+class UpdateBitsTests(SimpleTestCase):
+    def setUp(self):
+        self.allocations = _FakeAllocations({
+            "_id": "R1", "startbarcode": "1000", "endbarcode": "1009", "start": 1000, "size": 10, "width": 4,
+            "bitmap": bytes(_bitmap(10)), "used_count": 0, "version": 0,
+        })
+        self.range = dict(RANGE)  # edit in place to simulate a range changed under the same range_id
+        self.billed = set()
+
+        def find_range(barcode):
+            if not barcode.isdigit():
+                return None
+            inside = int(self.range["startbarcode"]) <= int(barcode) <= int(self.range["endbarcode"])
+            return self.range if inside else None
+
+        patches = [
+            mock.patch.object(barcode_allocation, "_allocations", return_value=self.allocations),
+            mock.patch.object(barcode_allocation, "_billed_barcodes", side_effect=lambda r: set(self.billed)),
+            mock.patch.object(barcode_allocation.barcode_range_index, "find_range", side_effect=find_range),
+            mock.patch.object(barcode_allocation.barcode_range_index, "ranges", side_effect=lambda: [self.range]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_reserve_then_release(self):
+        self.assertEqual(barcode_allocation.reserve(["1009"]), {"1009": True})
+        self.assertEqual(barcode_allocation.reserve(["1009"]), {"1009": False})
+        self.assertEqual(self.allocations.doc["used_count"], 1)
+        self.assertEqual(barcode_allocation.release(["1009"]), {"1009": True})
+        self.assertEqual(self.allocations.doc["used_count"], 0)
+        self.assertEqual(barcode_allocation.release(["1009"]), {"1009": False})
+
+    def test_barcode_outside_every_range(self):
+        self.assertEqual(barcode_allocation.reserve(["2000", "abc"]), {"2000": None, "abc": None})
+
+    def test_allocate_fills_the_range_then_reports_it_full(self):
+        barcodes = barcode_allocation.allocate(10)
+        self.assertEqual(barcodes, [str(b) for b in range(1000, 1010)])
+        self.assertEqual(barcode_allocation._allocate_in_range(RANGE, 1), [])
+
+    def test_lost_save_is_retried_on_fresh_bitmap(self):
+        def concurrent_reserve(allocations):
+            # Another worker reserves 1000 between our read and our save, once
+            allocations.before_save = None
+            bitmap = bytearray(allocations.doc["bitmap"])
+            bitmap[0] |= 1
+            allocations.doc.update(bitmap=bytes(bitmap), used_count=1, version=allocations.doc["version"] + 1)
+
+        self.allocations.before_save = concurrent_reserve
+        self.assertEqual(barcode_allocation.reserve(["1000", "1005"]), {"1000": False, "1005": True})
+        self.assertEqual(self.allocations.doc["used_count"], 2)
+        self.assertEqual(barcode_allocation._free_offsets(self.allocations.doc["bitmap"], 10, 10),
+                         [1, 2, 3, 4, 6, 7, 8, 9])
+
+    def test_lowered_start_keeps_existing_reservations(self):
+        barcode_allocation.reserve(["1003"])
+        self.range["startbarcode"] = "0900"
+        self.assertEqual(barcode_allocation.reserve(["0950"]), {"0950": True})
+        self.assertEqual(barcode_allocation.reserve(["1003"]), {"1003": False})
+        self.assertEqual(self.allocations.doc["size"], 110)
+        self.assertEqual(self.allocations.doc["used_count"], 2)
+
+    def test_raised_end_extends_the_bitmap_with_billed_barcodes_used(self):
+        barcode_allocation.reserve(["1009"])
+        self.range["endbarcode"] = "1020"
+        self.billed = {15}  # 1015 was billed before the range covered it
+        self.assertEqual(barcode_allocation.reserve(["1020", "1015"]), {"1020": True, "1015": False})
+        self.assertEqual(barcode_allocation.reserve(["1009"]), {"1009": False})
+
+    def test_shrunk_range_never_allocates_past_its_end(self):
+        barcode_allocation.reserve(["1008"])
+        self.range["endbarcode"] = "1004"
+        self.assertEqual(barcode_allocation.allocate(5), ["1000", "1001", "1002", "1003", "1004"])
+        self.assertEqual(self.allocations.doc["used_count"], 5)
+        with self.assertRaises(barcode_allocation.BarcodeAllocationError):
+            barcode_allocation.allocate(1)
+
+    def test_offset_outside_the_stored_bitmap_is_rejected(self):
+        with mock.patch.object(barcode_allocation, "_load", return_value=dict(self.allocations.doc, size=4)):
+            with self.assertRaises(barcode_allocation.BarcodeAllocationError):
+                barcode_allocation.reserve(["1005"])
+
+    def test_allocate_releases_earlier_ranges_when_a_later_one_fails(self):
+        self.range = dict(RANGE, endbarcode="1001")
+        second = dict(RANGE, range_id="R2")
+        failing = barcode_allocation.BarcodeAllocationError("concurrent updates")
+        with mock.patch.object(barcode_allocation.barcode_range_index, "ranges", return_value=[self.range, second]), \
+                mock.patch.object(barcode_allocation, "_allocate_in_range", side_effect=[["1000", "1001"], failing]), \
+                mock.patch.object(barcode_allocation, "release") as release:
+            with self.assertRaises(barcode_allocation.BarcodeAllocationError):
+                barcode_allocation.allocate(5)
+        release.assert_called_once_with(["1000", "1001"], None)
+
+    def test_resync_only_adds_billed_barcodes(self):
+        barcode_allocation.reserve(["1002"])  # allocated, not billed yet
+        self.billed = {5}
+        self.assertEqual(barcode_allocation.resync(self.range), 2)
+        self.assertEqual(barcode_allocation._free_offsets(self.allocations.doc["bitmap"], 10, 10),
+                         [0, 1, 3, 4, 6, 7, 8, 9])
+
+    def test_resync_keeps_a_reservation_made_during_the_scan(self):
+        def concurrent_reserve(allocations):
+            allocations.before_save = None
+            bitmap = bytearray(allocations.doc["bitmap"])
+            bitmap[0] |= 1
+            allocations.doc.update(bitmap=bytes(bitmap), used_count=1, version=allocations.doc["version"] + 1)
+
+        self.billed = {5}
+        self.allocations.before_save = concurrent_reserve
+        self.assertEqual(barcode_allocation.resync(self.range), 2)
+        self.assertEqual(self.allocations.doc["used_count"], 2)
+        self.assertEqual(barcode_allocation._free_offsets(self.allocations.doc["bitmap"], 10, 10),
+                         [1, 2, 3, 4, 6, 7, 8, 9])
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_no_or_unsupported_header_serves_the_whole_file(self):
+        for header in (None, "", "items=0-1", "bytes=0-1,4-5", "bytes=a-b", "bytes=-x"):
+            self.assertIsNone(_parse_range(header, 10), header)
+
+    def test_explicit_ranges(self):
+        self.assertEqual(_parse_range("bytes=0-4", 10), (0, 4))
+        self.assertEqual(_parse_range("bytes=5-", 10), (5, 9))
+        self.assertEqual(_parse_range("bytes=8-100", 10), (8, 9))
+
+    def test_suffix_ranges(self):
+        self.assertEqual(_parse_range("bytes=-3", 10), (7, 9))
+        self.assertEqual(_parse_range("bytes=-30", 10), (0, 9))
+
+    def test_unsatisfiable_ranges(self):
+        for header, size in (("bytes=10-", 10), ("bytes=5-2", 10), ("bytes=-0", 10), ("bytes=-5", 0),
+                             ("bytes=0-", 0)):
+            with self.assertRaises(ValueError, msg=f"{header} on {size} bytes"):
+                _parse_range(header, size)
+
+
+class RollupKeyTests(SimpleTestCase):
+    def test_names_survive_the_field_name_escaping(self):
+        for name in ("Dept. of Ops", "$pay", "a.b.$c", "Unknown"):
+            key = rollups._key(name)
+            self.assertNotIn(".", key)
+            self.assertFalse(key.startswith("$"))
+            self.assertEqual(rollups._name(key), name)
+
+    def test_missing_values_are_unknown(self):
+        self.assertEqual(rollups._key(None), "Unknown")
+        self.assertEqual(rollups._key(""), "Unknown")
+
+    def test_merge_reports_original_names(self):
+        merged = {}
+        rollups._merge(merged, {rollups._key("R.&D."): 2})
+        rollups._merge(merged, {rollups._key("R.&D."): 1})
+        self.assertEqual(merged, {"R.&D.": 3})
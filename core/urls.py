@@ -1,7 +1,7 @@
 #urls.py
 from django.urls import path
 from core import views
-from .Views import sample,package,registration,security
+from .Views import sample,package,registration,security,health,export
 
 urlpatterns = [
 
@@ -9,6 +9,9 @@ urlpatterns = [
     path("get_core_test/", package.get_core_test, name="get_core_test"),
     path("create_package/", package.create_package, name="create_package"),
     path("api/validate-barcode/<str:barcode>/", registration.validate_barcode, name="validate-barcode"),
+    path("api/validate-barcodes/", registration.validate_barcodes_bulk, name="validate-barcodes-bulk"),
+    path("api/barcodes/allocate/", registration.allocate_barcodes, name="allocate-barcodes"),
+    path("api/barcodes/utilisation/", registration.barcode_utilisation, name="barcode-utilisation"),
     path('get_all_employees/',registration.get_all_employees, name="get_all_billings"),
     path('get_all_registered_employees/',registration.get_all_registered_employees, name="get_all_registered_employees"),
 
@@ -16,10 +19,12 @@ urlpatterns = [
     # Sample URLs
     path('billing/patients/', sample.get_billing_patients, name='get_billing_patients'),
     path('samples/', sample.sample_management, name='sample_management'),
+    path('samples/bulk/', sample.bulk_sample_management, name='bulk_sample_management'),
     path('samples/transferred/', sample.get_transferred_samples, name='get_transferred_samples'),
     
     # Batch URLs
-    path('batch/', sample.batch_management, name='batch_management'),    
+    path('batch/', sample.batch_management, name='batch_management'),
+    path('batch/reserve/', sample.reserve_batch_number_block, name='reserve_batch_number_block'),
     path("save_investigation/",registration.save_investigation, name="save_investigation"),
     path('save_ophthalmology/', registration.save_Ophthalmology, name='save_ophthalmology'),
     path('approve_investigation/<str:barcode>/', registration.approve_investigation, name='approve_investigation'),
@@ -30,6 +35,7 @@ urlpatterns = [
     path("get_packages/",registration.get_packages, name="get_packages"),
     path("save_investigation/",registration.save_investigation, name="save_investigation"),
     path("chc_empregisterandbilling/",registration.register_employee_with_billing,name="register_employee_with_billing"),
+    path("chc_empregisterandbilling/bulk/",registration.bulk_register_employees,name="bulk_register_employees"),
     path('registration/', security.registration, name='registration'),
     path('login/', security.login, name='login'),
     path('get_all_ophthalmology/', registration.get_all_ophthalmology),
@@ -38,5 +44,14 @@ urlpatterns = [
     path('investigations/', views.get_investigations, name='get_investigations'),
     path('billings/', views.get_billings, name='get_billings'),
     path('dashboard-analytics/', views.get_dashboard_analytics, name='dashboard_analytics'),
+    path('revenue-analytics/', views.get_revenue_analytics, name='revenue_analytics'),
+
+    # Export URLs
+    path('export/billing/', export.export_billing, name='export_billing'),
+    path('export/samples/', export.export_sample_tests, name='export_sample_tests'),
+    path('export/investigations/', export.export_investigation_vitals, name='export_investigation_vitals'),
+
+    # Monitoring
+    path('health/mongo-pool/', health.mongo_pool_stats, name='mongo_pool_stats'),
 ]
 
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from .mongo import get_collection
+
+CACHE_VERSION_COLLECTION = "core_cacheversion"
+
+# How often a worker re-reads a version counter; a write is visible to every
+# worker within this many seconds.
+CACHE_VERSION_CHECK_INTERVAL = float(os.getenv("CACHE_VERSION_CHECK_INTERVAL", 2))
+
+
+def get_version(key):
+    doc = get_collection(CACHE_VERSION_COLLECTION).find_one({"_id": key}, {"version": 1})
+    return doc["version"] if doc else 0
+
+
+def bump_version(key):
+    """Invalidate `key` in every worker; returns the new version."""
+    doc = get_collection(CACHE_VERSION_COLLECTION).find_one_and_update(
+        {"_id": key},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return doc["version"]
+
+
+def first_seen(key, digest):
+    """
+    Unix time at which any worker first loaded content `digest` for `key`.
+    Every worker gets the same answer, so it can serve as Last-Modified.
+    """
+    doc = get_collection(CACHE_VERSION_COLLECTION).find_one_and_update(
+        {"_id": f"{key}@{digest}"},
+        {"$setOnInsert": {"first_seen": time.time()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return doc["first_seen"]
+
+
+class VersionedCache:
+    """
+    Process-local copy of a value rebuilt only when its version counter in
+    core_cacheversion changes. Checking the counter is a single _id lookup,
+    and is itself throttled to once per check interval.
+    """
+
+    def __init__(self, key, loader, check_interval=CACHE_VERSION_CHECK_INTERVAL):
+        self.key = key
+        self.loader = loader
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._value = None
+        self._checked_at = None
+
+    def get(self):
+        """Return (version, value), reloading if the stored version moved."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return self._version, self._value
+        with self._lock:
+            if self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._version, self._value
+            version = get_version(self.key)
+            if version != self._version or self._value is None:
+                self._value = self.loader()
+                self._version = version
+            self._checked_at = time.monotonic()
+            return self._version, self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = None
+            self._version = None
@@ -1,96 +1,180 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from .models import EmployeeRegistration, Billing, Investigation, Ophthalmology
+from rest_framework import status
 from django.core import serializers
-import json
+from django.conf import settings
+from .analytics import (
+    BILLING_COLLECTION, EMPLOYEE_COLLECTION, HEALTH_BUCKETS, INVESTIGATION_COLLECTION, REVENUE_GROUPS,
+    REVENUE_PERIODS, dashboard_pipeline, facet_counts, revenue_pipeline
+)
+from .listing import get_fields, list_query, paged_list
+from .mongo import get_collection, model_values
+from . import package_catalog, rollups
+from .pagination import PaginationError, date_range_filter
+
+EMPLOYEE_LIST_FIELDS = ['company_id', 'employee_name', 'employee_id', 'gender', 'age', 'department', 'email', 'mobile']
+INVESTIGATION_LIST_FIELDS = [
+    'employee_id', 'vitals', 'gender', 'age', 'barcode', 'date', 'status',
+    'patient_history', 'ecg_notes', 'pft_notes', 'audiometry_notes', 'company_id',
+]
+BILLING_LIST_FIELDS = ['company_id', 'date', 'employee_id', 'barcode', 'testdetails', 'netAmount', 'paymentMode']
+
+
+def _model_rows(model):
+    """render_page for paged_list: raw documents shaped as the ORM would load them."""
+    return lambda docs: [model_values(doc, model) for doc in docs]
+
+
+def _billing_rows(docs):
+    rows = _model_rows(Billing)(docs)
+    for row in rows:
+        if row.get('netAmount') is not None:
+            row['netAmount'] = str(row['netAmount'].to_decimal() if hasattr(row['netAmount'], 'to_decimal') else row['netAmount'])
+    return rows
+
+
+def _list_response(request, collection_name, model, allowed_fields, date_field, render_page=None):
+    """
+    Shared list endpoint: optional company_id, date_from/date_to,
+    fields=a,b (sparse fieldset), limit + cursor for pages.
+    """
+    try:
+        fields = get_fields(request, allowed_fields)
+        query = list_query(request, date_field)
+        return paged_list(request, collection_name, fields, render_page or _model_rows(model), query=query)
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 
 @api_view(['GET'])
 def get_employees(request):
-    employees = EmployeeRegistration.objects.all()
-    data = []
-    for emp in employees:
-        data.append({
-            'company_id': emp.company_id,
-            'employee_name': emp.employee_name,
-            'employee_id': emp.employee_id,
-            'gender': emp.gender,
-            'age': emp.age,
-            'department': emp.department,
-            'email': emp.email,
-            'mobile': emp.mobile,
-        })
-    return Response(data)
+    return _list_response(request, EMPLOYEE_COLLECTION, EmployeeRegistration, EMPLOYEE_LIST_FIELDS, "created_date")
 
 @api_view(['GET'])
 def get_investigations(request):
-    investigations = Investigation.objects.all()
-    data = []
-    for inv in investigations:
-        data.append({
-            'employee_id': inv.employee_id,
-            'vitals': inv.vitals,
-            'gender': inv.gender,
-            'age': inv.age,
-            'barcode': inv.barcode,
-            'date': inv.date,
-            'status': inv.status,
-            'patient_history': inv.patient_history,
-            'ecg_notes': inv.ecg_notes,
-            'pft_notes': inv.pft_notes,
-            'audiometry_notes': inv.audiometry_notes,
-            'company_id': inv.company_id,
-        })
-    return Response(data)
+    return _list_response(request, INVESTIGATION_COLLECTION, Investigation, INVESTIGATION_LIST_FIELDS, "date")
 
 @api_view(['GET'])
 def get_billings(request):
-    billings = Billing.objects.all()
-    data = []
-    for bill in billings:
-        data.append({
-            'company_id': bill.company_id,
-            'date': bill.date,
-            'employee_id': bill.employee_id,
-            'barcode': bill.barcode,
-            'testdetails': bill.testdetails,
-            'netAmount': str(bill.netAmount),
-            'paymentMode': bill.paymentMode,
-        })
-    return Response(data)
+    return _list_response(request, "core_billing", Billing, BILLING_LIST_FIELDS, "date", _billing_rows)
 
 @api_view(['GET'])
 def get_dashboard_analytics(request):
-    """Aggregated analytics endpoint"""
-    investigations = Investigation.objects.all()
-    employees = EmployeeRegistration.objects.all()
-    
-    analytics = {
-        'total_employees': employees.count(),
-        'total_assessments': investigations.count(),
-        'by_gender': {},
-        'by_department': {},
-        'by_age_group': {},
-        'health_status': {
-            'normal': 0,
-            'risk': 0,
-            'high_risk': 0
+    """
+    Aggregated analytics endpoint, summed from the daily rollups.
+    Optional: company_id, date_from/date_to, source=live to recompute from
+    the raw collections in one aggregation pipeline instead. Until
+    rebuild_rollups has seeded the rollups, the live pipeline is used.
+    """
+    try:
+        match = date_range_filter(request, "date")
+        employee_match = date_range_filter(request, "created_date")
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    company_id = request.GET.get("company_id")
+    if request.GET.get("source") != "live":
+        try:
+            if rollups.is_seeded():
+                return Response(rollups.read_dashboard(
+                    company_id, request.GET.get("date_from"), request.GET.get("date_to")
+                ))
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if company_id:
+        match["company_id"] = company_id
+        employee_match["company_id"] = company_id
+
+    try:
+        facets = next(get_collection(INVESTIGATION_COLLECTION).aggregate(dashboard_pipeline(match)), {})
+        # Same billing totals the rollups keep, from the revenue pipeline (billings share the date field)
+        billing = next(get_collection(BILLING_COLLECTION).aggregate(
+            revenue_pipeline(match, "day", [], settings.TIME_ZONE)
+        ), {})
+        billing_total = billing.get("total") or [{}]
+        total = facets.get("total") or [{"count": 0}]
+        health_status = dict.fromkeys(HEALTH_BUCKETS, 0)
+        health_status.update(facet_counts(facets.get("health_status", [])))
+
+        analytics = {
+            'total_employees': get_collection(EMPLOYEE_COLLECTION).count_documents(employee_match),
+            'total_assessments': total[0]["count"],
+            'by_gender': facet_counts(facets.get("by_gender", [])),
+            'by_department': facet_counts(facets.get("by_department", [])),
+            'by_age_group': facet_counts(facets.get("by_age_group", [])),
+            'health_status': health_status,
+            'total_billings': billing_total[0].get("billings", 0),
+            'billed_amount': {
+                str(r["_id"]): _revenue_row(r)["billed_amount"] for r in billing.get("by_payment_mode", [])
+            },
         }
+        return Response(analytics)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _revenue_row(row):
+    amount = row.get("billed_amount")
+    return {
+        "billed_amount": str(amount.to_decimal() if hasattr(amount, "to_decimal") else amount or 0),
+        "billings": row.get("billings", 0),
     }
-    
-    # Calculate metrics
-    for inv in investigations:
-        vitals = inv.vitals if isinstance(inv.vitals, dict) else json.loads(inv.vitals)
-        
-        # BMI calculation
-        weight = float(vitals.get('weight_kg', 0))
-        height = float(vitals.get('height_cm', 0))
-        if height > 0:
-            bmi = weight / ((height/100) ** 2)
-            if bmi < 25 and inv.status == 'approved':
-                analytics['health_status']['normal'] += 1
-            elif bmi < 30:
-                analytics['health_status']['risk'] += 1
-            else:
-                analytics['health_status']['high_risk'] += 1
-    
-    return Response(analytics)
+
+
+@api_view(['GET'])
+def get_revenue_analytics(request):
+    """
+    Billed revenue grouped by day or month and optional keys.
+    Params: company_id, date_from/date_to, period=day|month,
+    group_by=company,package,paymentMode (default company).
+    """
+    period = request.GET.get("period") or "day"
+    group_by = [g.strip() for g in (request.GET.get("group_by") or "company").split(",") if g.strip()]
+    if period not in REVENUE_PERIODS:
+        return Response({"error": f"period must be one of: {', '.join(REVENUE_PERIODS)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    unknown = [g for g in group_by if g not in REVENUE_GROUPS]
+    if unknown:
+        return Response({"error": f"Unknown group_by: {', '.join(unknown)}"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        match = list_query(request, "date")
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        facets = next(get_collection(BILLING_COLLECTION).aggregate(
+            revenue_pipeline(match, period, group_by, settings.TIME_ZONE)
+        ), {})
+        package_names = {}
+        if "package" in group_by:
+            package_names = {p["_id"]: p.get("package_name") for p in package_catalog.get_packages()[1]}
+
+        rows = []
+        for row in facets.get("rows", []):
+            key = row["_id"]
+            out = {"period": key.get("period")}
+            if "company" in group_by:
+                out["company_id"] = key.get("company")
+            if "package" in group_by:
+                out["package_id"] = key.get("package")
+                out["package_name"] = package_names.get(key.get("package"))
+            if "paymentMode" in group_by:
+                out["paymentMode"] = key.get("paymentMode")
+            out.update(_revenue_row(row))
+            rows.append(out)
+
+        total = facets.get("total") or [{}]
+        return Response({
+            "period": period,
+            "group_by": group_by,
+            "total": _revenue_row(total[0]),
+            # Credit billings are invoiced later, so they are reported apart from collected modes
+            "by_payment_mode": {str(r["_id"]): _revenue_row(r) for r in facets.get("by_payment_mode", [])},
+            "rows": rows,
+        })
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)